@@ -35,17 +35,27 @@ import errno
 import datetime
 import re
 import imp
+import multiprocessing
 from fabric.api import task, warn, put, puts, get, local, run, execute, \
     settings, abort, hosts, env, runs_once, parallel, hide
 
 import config
-from internalutil import _list
-from clockoffset import adjust_timestamps
+from internalutil import _list, map_jobs, run_graph, DemuxWriter
+from clockoffset import adjust_timestamps, ts_correct_virtual, \
+    materialise_timestamps, get_clock_offsets, CLOCK_OFFSET_FILE_EXT
 from filefinder import get_testid_file_list
 from flowcache import append_flow_cache, lookup_flow_cache
+from flowindex import get_flows
+from capturepass import run_capture_passes, get_spool_file, write_pktsizes, \
+    write_ackseq, write_filtered_pcap, PktSizeSink, AckSeqSink, \
+    write_http_gets, write_restimes, HttpGetSink
+from derivedcache import must_derive, record_derived
+from logsplit import split_siftr, split_web10g, get_split_flows, \
+    write_split_fields, get_log_header, get_directions, SIFTR_BASE_FIELDS, \
+    WEB10G_EXT, WEB10G_BASE_FIELDS
 from sourcefilter import SourceFilter
 from analyseutil import get_out_dir, get_out_name, filter_min_values, \
-    select_bursts, get_address_pair_analysis
+    select_bursts, get_address_pair_analysis, merge_sorted_files
 from plot import plot_time_series, plot_dash_goodput, plot_incast_ACK_series
 
 import gzip
@@ -53,6 +63,13 @@ import socket
 import csv
 from ctypes import *
 
+try:
+    import numpy as np
+except ImportError:
+    # fall back to reading ttprobe records one at a time and computing
+    # dupACKs line by line
+    np = None
+
 
 # structure for ttprobe binary format
 class TTprobe(Structure):
@@ -77,6 +94,145 @@ class TTprobe(Structure):
             ('addr_family', c_uint8),
             ]
 
+## Number of ttprobe records read at once by the vectorised reader
+TTPROBE_BLOCK_RECORDS = 262144
+
+
+## Get NumPy structured dtype with the same layout as TTprobe. Ports are
+## read as big endian, so we don't need ntohs()
+#  @return NumPy dtype
+def get_ttprobe_dtype():
+    names = []
+    formats = []
+    offsets = []
+    for name, ctype in TTprobe._fields_:
+        names.append(name)
+        offsets.append(getattr(TTprobe, name).offset)
+        if name in ('src_addr', 'dst_addr'):
+            formats.append(('u1', 16))
+        elif name in ('src_port', 'dst_port'):
+            formats.append('>u2')
+        else:
+            formats.append(np.dtype(ctype))
+
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                     'itemsize': sizeof(TTprobe)})
+
+
+## Read binary ttprobe file in large blocks. An incomplete record at the
+## end of the file is ignored
+#  @param ttprobe_file ttprobe file name
+#  @return Generator of NumPy arrays of records
+def read_ttprobe_blocks(ttprobe_file):
+    dtype = get_ttprobe_dtype()
+    block_size = TTPROBE_BLOCK_RECORDS * dtype.itemsize
+    with gzip.open(ttprobe_file, 'rb') as f:
+        rest = ''
+        while True:
+            data = f.read(block_size)
+            if data == '':
+                break
+            data = rest + data
+            n = len(data) // dtype.itemsize
+            rest = data[n * dtype.itemsize:]
+            if n > 0:
+                yield np.frombuffer(data, dtype=dtype, count=n)
+
+
+## Get flows of ttprobe records. Only the distinct 5-tuples are converted
+## into flow strings
+#  @param recs NumPy array of ttprobe records
+#  @return (List of flow strings, array with index of flow string for each
+#          record)
+def get_ttprobe_record_flows(recs):
+    keys = np.zeros(len(recs), dtype=[('src_addr', 'u1', 16),
+                                      ('src_port', '>u2'),
+                                      ('dst_addr', 'u1', 16),
+                                      ('dst_port', '>u2'),
+                                      ('addr_family', 'u1')])
+    for name in keys.dtype.names:
+        keys[name] = recs[name]
+
+    void_keys = keys.view(np.dtype((np.void, keys.dtype.itemsize)))
+    uniq, idx, inverse = np.unique(void_keys, return_index=True,
+                                   return_inverse=True)
+    flows = []
+    for i in idx:
+        k = keys[i]
+        flows.append('%s,%s,%s,%s' % (
+            arraytoIP(k['src_addr'], k['addr_family']), k['src_port'],
+            arraytoIP(k['dst_addr'], k['addr_family']), k['dst_port']))
+
+    return (flows, inverse)
+
+
+## Format floats like Python 2 str() does
+#  @param vals NumPy array of floats
+#  @return NumPy array of strings
+def _float_str(vals):
+    strs = np.char.mod('%.12g', vals)
+    # str() always shows a decimal point
+    no_point = np.char.find(strs, '.') < 0
+    no_point &= np.char.find(strs, 'e') < 0
+
+    return np.where(no_point, np.char.add(strs, '.0'), strs)
+
+
+## Format ttprobe records as CSV lines (same format as the record by record
+## code in extract_ttprobe_fields_data())
+#  @param recs NumPy array of ttprobe records
+#  @param fields List of field numbers (strings)
+#  @return NumPy array of lines (without newline)
+def format_ttprobe_records(recs, fields):
+    if len(recs) == 0:
+        return []
+
+    lines = np.char.add(np.char.mod('%d', recs['tv_sec']),
+                        np.char.add('.', np.char.mod('%06d', recs['tv_usec'])))
+    mss = recs['mss_cache'].astype(np.uint64)
+    fval = None
+    for field in fields:
+        if field == '1':
+            fval = np.char.mod('%d', recs['direction'])
+        elif field == '8':
+            fval = np.char.mod('%d', recs['mss_cache'])
+        elif field == '9':
+            fval = _float_str(recs['srtt'] / 1000.0)
+        elif field == '10':
+            fval = np.char.mod('%d', recs['snd_cwnd'].astype(np.uint64) * mss)
+        elif field == '11':
+            fval = np.char.mod('%d', recs['ssthresh'])
+        elif field == '12':
+            fval = np.char.mod('%d', recs['snd_wnd'].astype(np.uint64) * mss)
+        elif field == '13':
+            fval = np.char.mod('%d', recs['rcv_wnd'].astype(np.uint64) * mss)
+        elif field == '14':
+            fval = np.char.mod('%d', recs['sock_state'])
+        elif field == '15':
+            fval = np.char.mod('%d', recs['snd_una'])
+        elif field == '16':
+            fval = np.char.mod('%d', recs['snd_nxt'])
+        elif field == '17':
+            fval = np.char.mod('%d', recs['length'])
+        # unknown fields repeat the previous value
+        if fval is None:
+            lines = np.char.add(lines, ',')
+        else:
+            lines = np.char.add(lines, np.char.add(',', fval))
+
+    return lines
+
+
+## Select ttprobe records we want to extract: socket state is not SYN_SENT
+## (==2) and direction is in io_filter
+#  @param recs NumPy array of ttprobe records
+#  @param io_filter 'i', 'o' or 'io'
+#  @return Boolean NumPy array
+def select_ttprobe_records(recs, io_filter):
+    return (recs['sock_state'] != 2) & \
+        np.in1d(recs['direction'], [ord(c) for c in io_filter])
+
+
 ## Guess ttprobe file format
 #  @param file_name ttprobe File name to be checked
 #  @return ttprobe file format i.e. 'ttprobe' or 'binary'
@@ -124,7 +280,18 @@ def arraytoIP(ip, addr_family):
 def get_ttprobe_flows(ttprobe_file=''):
     # guss ttprobe file format
     ttprobe_format = guess_ttprobe_file_format(ttprobe_file)
-    if ttprobe_format == 'binary':
+    if ttprobe_format == 'binary' and np is not None:
+        flows_set = set()
+        try:
+            for recs in read_ttprobe_blocks(ttprobe_file):
+                flows_set.update(get_ttprobe_record_flows(recs)[0])
+        except IOError:
+            print('Cannot open file %s' % ttprobe_file)
+        flows = list(flows_set)
+        flows.sort()
+        return flows
+
+    elif ttprobe_format == 'binary':
         x = TTprobe()
         # the idea of using set data stracture is to get a unique flow without need
         # for duplication checking
@@ -171,7 +338,25 @@ def extract_ttprobe_fields_data(ttprobe_file, attributes, rflow, io_filter, out)
     puts('Extracting fields (%s) from ttprobe file %s' % (attributes, ttprobe_file))
     fields = attributes.split(',')
     ttprobe_format = guess_ttprobe_file_format(ttprobe_file)
-    if ttprobe_format == 'binary':
+    if ttprobe_format == 'binary' and np is not None:
+        try:
+            with open(out, 'w') as fout:
+                for recs in read_ttprobe_blocks(ttprobe_file):
+                    flows, inverse = get_ttprobe_record_flows(recs)
+                    if rflow not in flows:
+                        continue
+                    sel = select_ttprobe_records(recs, io_filter) & \
+                        (inverse == flows.index(rflow))
+                    lines = format_ttprobe_records(recs[sel], fields)
+                    if len(lines) > 0:
+                        fout.write('\n'.join(lines) + '\n')
+
+        except IOError:
+            print('Cannot open file %s' % ttprobe_file)
+
+        return 0
+
+    elif ttprobe_format == 'binary':
         x = TTprobe()
         try:
             with gzip.open(ttprobe_file, 'rb') as f:
@@ -246,6 +431,132 @@ def extract_ttprobe_fields_data(ttprobe_file, attributes, rflow, io_filter, out)
         return 0
 
 
+## Extract fields from ttprobe file for all flows with a single pass over
+## the file. The output is the same as calling extract_ttprobe_fields_data()
+## for each flow, but per-flow data is buffered and written with a
+## DemuxWriter, so only one output file is open at a time
+#  @param ttprobe_file ttprobe file name
+#  @param attributes Fields to be extracted
+#  @param io_filter 'i', 'o' or 'io'
+#  @param out_name Function that maps a flow to the output file name, or to
+#                  None if the flow should not be extracted
+#  @return (Sorted list of all flows in file, list of output files written)
+def demux_ttprobe_fields_data(ttprobe_file, attributes, io_filter, out_name):
+
+    puts('Extracting fields (%s) for all flows from ttprobe file %s' %
+         (attributes, ttprobe_file))
+    fields = attributes.split(',')
+    writer = DemuxWriter()
+    # output file name for each flow seen so far
+    outs = {}
+
+    def get_out(flow):
+        out = outs.get(flow, '')
+        if out == '':
+            out = outs[flow] = out_name(flow)
+            if out is not None:
+                # make sure we also create files for flows without data
+                writer.set_header(out, '')
+        return out
+
+    ttprobe_format = guess_ttprobe_file_format(ttprobe_file)
+    try:
+        if ttprobe_format == 'binary' and np is not None:
+            for recs in read_ttprobe_blocks(ttprobe_file):
+                flows, inverse = get_ttprobe_record_flows(recs)
+                wanted = np.array([get_out(flow) is not None for flow in flows])
+                sel = select_ttprobe_records(recs, io_filter) & wanted[inverse]
+                recs = recs[sel]
+                inverse = inverse[sel]
+                if len(recs) == 0:
+                    continue
+
+                # group lines by flow, keeping the time order within a flow
+                order = np.argsort(inverse, kind='mergesort')
+                lines = format_ttprobe_records(recs[order], fields)
+                inverse = inverse[order]
+                bounds = np.flatnonzero(np.diff(inverse)) + 1
+                starts = np.concatenate(([0], bounds))
+                ends = np.concatenate((bounds, [len(inverse)]))
+                for start, end in zip(starts, ends):
+                    writer.write(get_out(flows[inverse[start]]),
+                                 '\n'.join(lines[start:end]) + '\n')
+
+        elif ttprobe_format == 'binary':
+            x = TTprobe()
+            with gzip.open(ttprobe_file, 'rb') as f:
+                while f.readinto(x) == sizeof(x):
+                    flow = '%s,%s,%s,%s' % (arraytoIP(x.src_addr, x.addr_family),
+                        socket.ntohs(x.src_port),
+                        arraytoIP(x.dst_addr, x.addr_family),
+                        socket.ntohs(x.dst_port)
+                        )
+                    out = get_out(flow)
+                    # ignore the values when TCP socket state is SYN_SENT (==2)
+                    if out is None or x.sock_state == 2 or \
+                       chr(x.direction) not in io_filter:
+                        continue
+
+                    fval = ''
+                    line = '%u.%06u' % (x.tv_sec, x.tv_usec)
+                    for field in fields:
+                        if field == '1':
+                            fval = x.direction
+                        if field == '8':
+                            fval = x.mss_cache
+                        if field == '9':
+                            fval = x.srtt / 1000.0
+                        if field == '10':
+                            fval = x.snd_cwnd * x.mss_cache
+                        elif field == '11':
+                            fval = x.ssthresh
+                        elif field == '12':
+                            fval = x.snd_wnd * x.mss_cache
+                        elif field == '13':
+                            fval = x.rcv_wnd * x.mss_cache
+                        elif field == '14':
+                            fval = x.sock_state
+                        elif field == '15':
+                            fval = x.snd_una
+                        elif field == '16':
+                            fval = x.snd_nxt
+                        elif field == '17':
+                            fval = x.length
+                        line += ',' + str(fval)
+                    writer.write(out, line + '\n')
+
+        elif ttprobe_format == 'ttprobe':
+            with gzip.open(ttprobe_file, 'rb') as f:
+                ttprobe_cvs_reader = csv.reader(f, delimiter=',')
+                for row in ttprobe_cvs_reader:
+                    flow = '%s,%s,%s,%s' % (row[2], row[3], row[4], row[5])
+                    out = get_out(flow)
+                    # ignore the values when TCP socket state is SYN_SENT (==2)
+                    if out is None or row[13] == '2' or row[0] not in io_filter:
+                        continue
+
+                    line = row[1]
+                    for field in fields:
+                        # if field is srtt, then convert to second
+                        if int(field) == 9:
+                            line += ',%s' % (int(row[int(field) - 1]) / 1000.0)
+                        else:
+                            line += ',' + row[int(field) - 1]
+                    writer.write(out, line + '\n')
+
+    except IOError:
+        print('Cannot open file %s' % ttprobe_file)
+
+    writer.close()
+
+    flows = outs.keys()
+    flows.sort()
+    written = [out for out in outs.values() if out is not None]
+    written.sort()
+
+    return (flows, written)
+
+
 ## Extract data from ttprobe files
 #  @param test_id Test ID prefix of experiment to analyse
 #  @param out_dir Output directory for results
@@ -291,12 +602,40 @@ def extract_ttprobe(test_id='', out_dir='', replot_only='0', source_filter='',
             #ttprobe_file_format = guess_ttprobe_file_format(ttprobe_file)
             # get input directory name and create result directory if necessary
             out_dirname = get_out_dir(ttprobe_file, out_dir)
+            params = {'attributes': attributes, 'io_filter': io_filter,
+                      'post_proc': getattr(post_proc, '__name__', '')}
 
-            # unique flows
+            # output file name for flow, None if we don't extract the flow
+            def out_name(flow):
+                src, src_port, dst, dst_port = flow.split(',')
+                src, src_internal = get_address_pair_analysis(test_id, src, do_abort='0')
+                dst, dst_internal = get_address_pair_analysis(test_id, dst, do_abort='0')
+                if src == '' or dst == '':
+                    return None
+
+                flow_name = flow.replace(',', '_')
+                out = out_dirname + test_id + '_' + flow_name + '_ttprobe.' + out_file_ext
+                if must_derive(replot_only, [out], 'ttprobe', [ttprobe_file],
+                               params):
+                    return out
+                else:
+                    return None
+
+            # unique flows. extract data for all flows with one pass over the
+            # file, which also gives us the flows if they are not cached yet
             flows = lookup_flow_cache(ttprobe_file)
-            if flows is None:
-                flows = get_ttprobe_flows(ttprobe_file)
-                append_flow_cache(ttprobe_file, flows)
+            if flows is None or \
+               len([flow for flow in flows if out_name(flow) is not None]) > 0:
+                (all_flows, written) = demux_ttprobe_fields_data(ttprobe_file,
+                                           attributes, io_filter, out_name)
+                if flows is None:
+                    flows = all_flows
+                    append_flow_cache(ttprobe_file, flows)
+
+                for out in written:
+                    if post_proc is not None:
+                        post_proc(ttprobe_file, out)
+                    record_derived([out], 'ttprobe', [ttprobe_file], params)
 
             for flow in flows:
 
@@ -316,19 +655,15 @@ def extract_ttprobe(test_id='', out_dir='', replot_only='0', source_filter='',
                 else:
                     long_flow_name = flow_name
                 out = out_dirname + test_id + '_' + flow_name + '_ttprobe.' + out_file_ext
-                if replot_only == '0' or not os.path.isfile(out):
-                    extract_ttprobe_fields_data(ttprobe_file, attributes, flow, io_filter, out)
-
-                    if post_proc is not None:
-                        post_proc(ttprobe_file, out)
 
                 if sfil.is_in(flow_name):
-                    if ts_correct == '1':
+                    if ts_correct != '0':
                         host = local(
                             'echo %s | sed "s/.*_\([a-z0-9\.]*\)_ttprobe.log.gz/\\1/"' %
                             (ttprobe_file),
                             capture=True)
-                        out = adjust_timestamps(test_id, out, host, ',', out_dir)
+                        out = adjust_timestamps(test_id, out, host, ',', out_dir,
+                                                ts_correct_virtual(ts_correct))
 
                     out_files[long_flow_name] = out
                     out_groups[out] = group
@@ -393,12 +728,13 @@ def _extract_dash_goodput(test_id='', out_dir='', replot_only='0', dash_log_list
         #(requires modified httperf output)
         # the sed here parses the nominal cycle length, nominal rate in kbps
         # and block number from the file name
-        if replot_only == '0' or not os.path.isfile(out):
+        if must_derive(replot_only, [out], 'dash_goodput', [dash_file]):
             local(
                 'zcat %s | grep video_files | grep -v NA | '
                 'awk \'{ print $1 "," $5 "," $7 "," $10 "," $14 }\' | '
                 'sed "s/\/video_files-\([0-9]*\)-\([0-9]*\)\/\([0-9]*\)/\\1,\\2,\\3/" > %s' %
                 (dash_file, out))
+            record_derived([out], 'dash_goodput', [dash_file])
 
         host = local(
             'echo %s | sed "s/.*_\([a-z0-9\.]*\)_[0-9]*%s/\\1/"' %
@@ -407,8 +743,9 @@ def _extract_dash_goodput(test_id='', out_dir='', replot_only='0', dash_log_list
             'echo %s | sed "s/.*\/\(.*\)_%s_.*/\\1/"' %
             (dash_file, host), capture=True)
 
-        if ts_correct == '1':
-            out = adjust_timestamps(test_id, out, host, ',', out_dir)
+        if ts_correct != '0':
+            out = adjust_timestamps(test_id, out, host, ',', out_dir,
+                                    ts_correct_virtual(ts_correct))
 
         if dash_log_list != '':
             # need to build test_id_arr
@@ -457,6 +794,8 @@ def extract_dash_goodput(test_id='', out_dir='', replot_only='0', dash_log_list=
 #  @param ts_correct '0' use timestamps as they are (default)
 #                    '1' correct timestamps based on clock offsets estimated
 #                        from broadcast pings
+#                    '2' like '1', but clock offsets are only applied when
+#                        reading the data for plotting (no .tscorr files)
 #  @param plot_params Parameters passed to plot function via environment variables
 #  @param plot_script Specify the script used for plotting, must specify full path
 @task
@@ -505,6 +844,87 @@ def analyse_dash_goodput(test_id='', out_dir='', replot_only='0', dash_log_list=
     puts('\n[MAIN] COMPLETED plotting DASH goodput %s \n' % out_name)
 
 
+## Compute RTTs of a flow in both directions with the spp tool
+#  @param test_id Test ID
+#  @param out_dirname Output directory
+#  @param dump1 tcpdump file of source
+#  @param dump2 tcpdump file of destination
+#  @param filter1 Filter for dump1
+#  @param filter2 Filter for dump2
+#  @param proto Protocol ('tcp' or 'udp')
+#  @param src_internal Internal source address
+#  @param dst_internal Internal destination address
+#  @param name Flow name
+#  @param out_rtt Output file with source as reference point
+#  @param rev_out_rtt Output file with destination as reference point
+#  @param replot_only '1' means reuse existing spool directories
+def _spp_rtt(test_id, out_dirname, dump1, dump2, filter1, filter2, proto,
+             src_internal, dst_internal, name, out_rtt, rev_out_rtt,
+             replot_only='0'):
+
+    # control the fields used by spp for generating the packet
+    # ids (hashes)
+    if proto == 'udp':
+        pid_fields = 2111
+    else:
+        pid_fields = 511
+
+    out1 = out_dirname + test_id + '_' + src_internal + '_filtered_' + name + \
+        '_ref.dmp'
+    out2 = out_dirname + test_id + '_' + dst_internal + '_filtered_' + name + \
+        '_mon.dmp'
+
+    # create filtered tcpdumps from the capture pass spool files
+    write_filtered_pcap(dump1, out_dirname, filter1, out1, replot_only)
+    write_filtered_pcap(dump2, out_dirname, filter2, out2, replot_only)
+
+    # compute rtts with spp
+    local('spp -# %s -a %s -f %s -A %s -F %s > %s' %
+          (pid_fields, src_internal, out1, dst_internal, out2, out_rtt))
+    local('spp -# %s -a %s -f %s -A %s -F %s > %s' %
+          (pid_fields, dst_internal, out2, src_internal, out1, rev_out_rtt))
+
+    # remove filtered tcpdumps
+    local('rm -f %s %s' % (out1, out2))
+
+
+## Extract RTTs of a flow in both directions (see _extract_rtt). Called in
+## worker processes
+#  @param args Tuple of test ID, out_dir, replot_only, ts_correct, burst_sep,
+#              sburst, eburst, group ID, output directory, the
+#              two dump files, the two filters, protocol, flow name, the
+#              internal source and destination addresses, the two output
+#              files and a list of (flow name, output file, host) tuples for
+#              the directions selected by the source filter
+#  @return Map of flow names to interim data file names and
+#          map of file names and group IDs
+def _extract_rtt_flow(args):
+    (test_id, out_dir, replot_only, ts_correct, burst_sep, sburst, eburst,
+     group, out_dirname, dump1, dump2, filter1, filter2, proto, name,
+     src_internal, dst_internal, out_rtt, rev_out_rtt, selected) = args
+
+    params = {'filter1': filter1, 'filter2': filter2}
+    if must_derive(replot_only, [out_rtt, rev_out_rtt], 'rtt',
+                   [dump1, dump2], params):
+        _spp_rtt(test_id, out_dirname, dump1, dump2, filter1, filter2, proto,
+                 src_internal, dst_internal, name, out_rtt, rev_out_rtt,
+                 replot_only)
+
+        record_derived([out_rtt, rev_out_rtt], 'rtt', [dump1, dump2], params)
+
+    out_files = {}
+    out_groups = {}
+    for long_name, out, host in selected:
+        if ts_correct != '0':
+            out = adjust_timestamps(test_id, out, host, ' ', out_dir)
+
+        (out_files,
+         out_groups) = select_bursts(long_name, group, out, burst_sep, sburst,
+                                     eburst, out_files, out_groups)
+
+    return (out_files, out_groups)
+
+
 ## Extract RTT for flows using SPP
 ## The extracted files have an extension of .rtts. The format is CSV with the
 ## columns:
@@ -526,10 +946,13 @@ def analyse_dash_goodput(test_id='', out_dir='', replot_only='0', dash_log_list=
 #                       seconds since the first burst @ t = 0 (e.g. incast query/response bursts)
 #  @param sburst Start plotting with burst N (bursts are numbered from 1)
 #  @param eburst End plotting with burst N (bursts are numbered from 1)
+#  @param jobs Number of worker processes used for capture passes and flows
+#              ('0' means number of CPUs, '1' means no worker processes)
 #  @return Test ID list, map of flow names to interim data file names and 
 #          map of file names and group IDs
 def _extract_rtt(test_id='', out_dir='', replot_only='0', source_filter='',
-                udp_map='', ts_correct='1', burst_sep='0.0', sburst='1', eburst='0'):
+                udp_map='', ts_correct='1', burst_sep='0.0', sburst='1', eburst='0',
+                jobs='1'):
     "Extract RTT of flows with SPP"
 
     ifile_ext = '.dmp.gz'
@@ -539,6 +962,8 @@ def _extract_rtt(test_id='', out_dir='', replot_only='0', source_filter='',
     out_files = {}
     out_groups = {}
     udp_reverse_map = {}
+    # flow names of selected flows, i.e. the keys of out_files
+    out_names = set()
 
     test_id_arr = test_id.split(';')
     if len(test_id_arr) == 0 or test_id_arr[0] == '':
@@ -547,8 +972,6 @@ def _extract_rtt(test_id='', out_dir='', replot_only='0', source_filter='',
     # Initialise source filter data structure
     sfil = SourceFilter(source_filter)
 
-    #local('which spp')
-
     if udp_map != '':
         entries = udp_map.split(';')
         for entry in entries:
@@ -565,28 +988,21 @@ def _extract_rtt(test_id='', out_dir='', replot_only='0', source_filter='',
                                 ifile_ext, 
                                 'grep -v "router.dmp.gz" | grep -v "ctl.dmp.gz"')
 
+        # decode tcpdump files once for all metrics
+        if replot_only == '0':
+            run_capture_passes([(tcpdump_file, get_out_dir(tcpdump_file, out_dir))
+                                for tcpdump_file in tcpdump_files], jobs)
+
+        # list of flows to extract, the work for each flow is independent
+        work = []
+
         for tcpdump_file in tcpdump_files:
             # get input directory name and create result directory if necessary
             out_dirname = get_out_dir(tcpdump_file, out_dir) 
             dir_name = os.path.dirname(tcpdump_file)
 
             # get unique flows
-            flows = lookup_flow_cache(tcpdump_file)
-            if flows == None:
-                flows = _list(local('zcat %s | tcpdump -nr - "tcp" | '
-                                'awk \'{ if ( $2 == "IP" ) { print $3 " " $5 " tcp" } }\' | '
-                                'sed "s/://" | '
-                                'sed "s/\.\([0-9]*\) /,\\1 /g" | sed "s/ /,/g" | '
-                                'LC_ALL=C sort -u' %
-                                tcpdump_file, capture=True))
-                flows += _list(local('zcat %s | tcpdump -nr - "udp" | '
-                                 'awk \'{ if ( $2 == "IP" ) { print $3 " " $5 " udp" } }\' | '
-                                 'sed "s/://" | '
-                                 'sed "s/\.\([0-9]*\) /,\\1 /g" | sed "s/ /,/g" | '
-                                 'LC_ALL=C sort -u' %
-                                 tcpdump_file, capture=True))
-
-                append_flow_cache(tcpdump_file, flows)
+            flows = get_flows(tcpdump_file)
 
             # since client sends first packet to server, client-to-server flows
             # will always be first
@@ -621,17 +1037,11 @@ def _extract_rtt(test_id='', out_dir='', replot_only='0', source_filter='',
                     dump1 = dir_name + '/' + test_id + '_' + src + ifile_ext 
                     dump2 = dir_name + '/' + test_id + '_' + dst + ifile_ext 
 
-                    # control the fields used by spp for generating the packet
-                    # ids (hashes)
-                    if proto == 'udp':
-                        pid_fields = 2111
-                    else:
-                        pid_fields = 511
-
+                    # filters are lists of (host, port, direction) tuples, see
+                    # write_filtered_pcap()
                     if proto == 'tcp':
-                        filter1 = '(src host ' + src_internal + ' && src port ' + src_port + \
-                                  ') || (' + \
-                                  'dst host ' + src_internal + ' && dst port ' + src_port + ')'
+                        filter1 = [(src_internal, src_port, 'src'),
+                                   (src_internal, src_port, 'dst')]
                         filter2 = filter1 
                     else:
                         entry = udp_reverse_map.get(
@@ -642,68 +1052,38 @@ def _extract_rtt(test_id='', out_dir='', replot_only='0', source_filter='',
                                 '_' + src2_internal + '_' + src2_port
                             rev_name = src2_internal + '_' + src2_port + \
                                 '_' + src_internal + '_' + src_port
-                            filter1 = '(src host ' + src_internal + ' && src port ' + src_port + \
-                                ') || ( ' + \
-                                'src host ' + src2_internal + ' && src port ' + src2_port + ')'
+                            filter1 = [(src_internal, src_port, 'src'),
+                                       (src2_internal, src2_port, 'src')]
                             filter2 = filter1 
-                            if rev_name in out_files:
+                            if rev_name in out_names:
                                 continue
                         else:
                             warn('No entry in udp_map for %s:%s' % (src_internal, src_port)) 
                             continue
 
-                    out1 = out_dirname + test_id + \
-                        '_' + src + '_filtered_' + name + '_ref.dmp'
-                    out2 = out_dirname + test_id + \
-                        '_' + dst + '_filtered_' + name + '_mon.dmp'
                     out_rtt = out_dirname + test_id + '_' + name + ofile_ext 
                     rev_out_rtt = out_dirname + test_id + '_' + rev_name + ofile_ext 
 
-                    if replot_only == '0' or not ( os.path.isfile(out_rtt) and \
-                                                   os.path.isfile(rev_out_rtt) ): 
-                        # create filtered tcpdumps
-                        local(
-                            'zcat %s | tcpdump -nr - -w %s "%s"' %
-                            (dump1, out1, filter1))
-                        local(
-                            'zcat %s | tcpdump -nr - -w %s "%s"' %
-                            (dump2, out2, filter2))
-
-                        # compute rtts with spp
-                        local(
-                            'spp -# %s -a %s -f %s -A %s -F %s > %s' %
-                            (pid_fields, src_internal, out1, dst_internal, out2, out_rtt))
-                        local(
-                            'spp -# %s -a %s -f %s -A %s -F %s > %s' %
-                            (pid_fields,
-                             dst_internal,
-                             out2,
-                             src_internal,
-                             out1,
-                             rev_out_rtt))
-
-                        # remove filtered tcpdumps
-                        local('rm -f %s %s' % (out1, out2))
-
                     already_done[long_name] = 1
                     already_done[long_rev_name] = 1
 
+                    selected = []
                     if sfil.is_in(name):
-                        if ts_correct == '1':
-                            out_rtt = adjust_timestamps(test_id, out_rtt, src, ' ', out_dir)
-
-                        (out_files, 
-                         out_groups) = select_bursts(long_name, group, out_rtt, burst_sep, sburst, eburst,
-                                      out_files, out_groups)
-
+                        selected.append((long_name, out_rtt, src))
                     if sfil.is_in(rev_name):
-                        if ts_correct == '1':
-                            rev_out_rtt = adjust_timestamps(test_id, rev_out_rtt, dst, ' ',
-                                          out_dir)
+                        selected.append((long_rev_name, rev_out_rtt, dst))
+                    out_names.update(sel[0] for sel in selected)
+
+                    work.append((test_id, out_dir, replot_only, ts_correct,
+                                 burst_sep, sburst, eburst, group,
+                                 out_dirname, dump1, dump2, filter1, filter2,
+                                 proto, name, src_internal, dst_internal,
+                                 out_rtt, rev_out_rtt, selected))
 
-                        (out_files, 
-                         out_groups) = select_bursts(long_rev_name, group, rev_out_rtt, burst_sep, sburst, 
-                                      eburst, out_files, out_groups)
+        _prepare_workers([test_id], out_dir, ts_correct, jobs)
+        for flow_files, flow_groups in map_jobs(_extract_rtt_flow, work, jobs):
+            out_files.update(flow_files)
+            out_groups.update(flow_groups)
 
         group += 1
 
@@ -714,11 +1094,12 @@ def _extract_rtt(test_id='', out_dir='', replot_only='0', source_filter='',
 ## SEE _extract_rtt()
 @task
 def extract_rtt(test_id='', out_dir='', replot_only='0', source_filter='',
-                udp_map='', ts_correct='1', burst_sep='0.0', sburst='1', eburst='0'):
+                udp_map='', ts_correct='1', burst_sep='0.0', sburst='1', eburst='0',
+                jobs='1'):
     "Extract RTT of flows with SPP"
 
     _extract_rtt(test_id, out_dir, replot_only, source_filter,
-                udp_map, ts_correct, burst_sep, sburst, eburst)
+                udp_map, ts_correct, burst_sep, sburst, eburst, jobs)
 
     # done
     puts('\n[MAIN] COMPLETED extracting RTTs %s \n' % test_id)
@@ -758,19 +1139,21 @@ def extract_rtt(test_id='', out_dir='', replot_only='0', source_filter='',
 #                    seconds since the first burst @ t = 0 (e.g. incast query/response bursts)
 #   @param sburst Start plotting with burst N (bursts are numbered from 1)
 #   @param eburst End plotting with burst N (bursts are numbered from 1)
+#   @param jobs Number of worker processes used for capture passes and flows
+#               ('0' means number of CPUs, '1' means no worker processes)
 @task
 def analyse_rtt(test_id='', out_dir='', replot_only='0', source_filter='',
                 min_values='3', udp_map='', omit_const='0', ymin='0', ymax='0',
                 lnames='', stime='0.0', etime='0.0', out_name='', pdf_dir='',
                 ts_correct='1', plot_params='', plot_script='', burst_sep='0.0',
-                sburst='1', eburst='0'):
+                sburst='1', eburst='0', jobs='1'):
     "Plot RTT of flows with SPP"
 
     (test_id_arr, 
      out_files, 
      out_groups) = _extract_rtt(test_id, out_dir, replot_only, 
                                  source_filter, udp_map, ts_correct,
-                                 burst_sep, sburst, eburst)
+                                 burst_sep, sburst, eburst, jobs)
 
     (out_files, out_groups) = filter_min_values(out_files, out_groups, min_values)
     out_name = get_out_name(test_id_arr, out_name)
@@ -823,8 +1206,6 @@ def extract_siftr(test_id='', out_dir='', replot_only='0', source_filter='',
 
     if io_filter != 'i' and io_filter != 'o' and io_filter != 'io':
         abort('Invalid parameter value for io_filter')
-    if io_filter == 'io':
-        io_filter = '(i|o)'
 
     test_id_arr = test_id.split(';')
 
@@ -842,39 +1223,14 @@ def extract_siftr(test_id='', out_dir='', replot_only='0', source_filter='',
             # get input directory name and create result directory if necessary
             out_dirname = get_out_dir(siftr_file, out_dir)
 
-            if replot_only == '0':
-                # check that file is complete, i.e. we have the disable line
-                with settings(warn_only=True):
-                    last_line = local(
-                        'zcat %s | tail -1 | grep disable_time_secs' %
-                        siftr_file,
-                        capture=True)
-                if last_line == '':
-                    abort('Incomplete siftr file %s' % siftr_file)
-
-                # check that we have patched siftr (27 columns)
-                cols = int(
-                    local(
-                        'zcat %s | head -2 | tail -1 | sed "s/,/ /g" | wc -w' %
-                        siftr_file,
-                        capture=True))
-                if cols < 27:
-                    abort('siftr needs to be patched to output ertt estimates')
-
-            # we need to stop reading before the log disable line
-            rows = str(int(
-                local('zcat %s | wc -l | awk \'{ print $1 }\'' %
-                      (siftr_file), capture=True)) - 3)
+            # split log into per-flow files, this also checks that the file
+            # is complete and that siftr is patched
+            split_dir = split_siftr(siftr_file, out_dirname, replot_only)
 
             # unique flows
             flows = lookup_flow_cache(siftr_file)
             if flows == None:
-                flows = _list(
-                    local(
-                        'zcat %s | grep -v enable | head -%s | '
-                        'egrep "^%s" | '
-                        'cut -d\',\' -f 4,5,6,7 | LC_ALL=C sort -u' %
-                        (siftr_file, rows, io_filter), capture=True))
+                flows = get_split_flows(split_dir, get_directions(io_filter))
 
                 append_flow_cache(siftr_file, flows)
 
@@ -896,24 +1252,27 @@ def extract_siftr(test_id='', out_dir='', replot_only='0', source_filter='',
                 else:
                     long_flow_name = flow_name
                 out = out_dirname + test_id + '_' + flow_name + '_siftr.' + out_file_ext
-                if replot_only == '0' or not os.path.isfile(out) :
-                    local(
-                        'zcat %s | grep -v enable | head -%s | '
-                        'egrep "^%s" | '
-                        'cut -d\',\' -f 3,4,5,6,7,%s | '
-                        'grep "%s" | cut -d\',\' -f 1,6- > %s' %
-                        (siftr_file, rows, io_filter, attributes, flow, out))
+                params = {'attributes': attributes, 'io_filter': io_filter,
+                          'post_proc': getattr(post_proc, '__name__', '')}
+                if must_derive(replot_only, [out], 'siftr', [siftr_file],
+                               params):
+                    write_split_fields(split_dir, flow,
+                                       get_directions(io_filter),
+                                       SIFTR_BASE_FIELDS, attributes, out)
 
                     if post_proc is not None:
                         post_proc(siftr_file, out)
 
+                    record_derived([out], 'siftr', [siftr_file], params)
+
                 if sfil.is_in(flow_name):
-                    if ts_correct == '1':
+                    if ts_correct != '0':
                         host = local(
                             'echo %s | sed "s/.*_\([a-z0-9\.]*\)_siftr.log.gz/\\1/"' %
                             siftr_file,
                             capture=True)
-                        out = adjust_timestamps(test_id, out, host, ',', out_dir)
+                        out = adjust_timestamps(test_id, out, host, ',', out_dir,
+                                                ts_correct_virtual(ts_correct))
 
                     out_files[long_flow_name] = out
                     out_groups[out] = group
@@ -987,28 +1346,15 @@ def extract_web10g(test_id='', out_dir='', replot_only='0', source_filter='',
             # get input directory name and create result directory if necessary
             out_dirname = get_out_dir(web10g_file, out_dir)
 
-            # check for errors, unless we replot
-            # make sure we have exit status 0 for this, hence the final echo
-            if replot_only == '0':
-                errors = local(
-                    'zcat %s | grep -v "runbg_wrapper.sh" | grep -v "Timestamp" ' 
-                    'egrep "[a-z]+" ; echo -n ""' %
-                    web10g_file,
-                    capture=True)
-                if errors != '':
-                    warn('Errors in %s:\n%s' % (web10g_file, errors))
+            # split log into per-flow files, this also checks for errors
+            # (unless we replot), suppresses the last line, cause that can
+            # be incomplete, and suppresses duplicate rows
+            split_dir = split_web10g(web10g_file, out_dirname, replot_only)
 
             # unique flows
-            # the sed command here suppresses the last line, cause that can be
-            # incomplete
             flows = lookup_flow_cache(web10g_file)
             if flows == None:
-                flows = _list(
-                    local(
-                        'zcat %s | egrep -v "[a-z]+" | sed -n \'$!p\' | '
-                        'cut -d\',\' -f 3,4,5,6 | LC_ALL=C sort -u' %
-                        (web10g_file),
-                        capture=True))
+                flows = get_split_flows(split_dir, [WEB10G_EXT])
 
                 append_flow_cache(web10g_file, flows)
 
@@ -1030,31 +1376,29 @@ def extract_web10g(test_id='', out_dir='', replot_only='0', source_filter='',
                 else:
                     long_flow_name = flow_name
                 out = out_dirname + test_id + '_' + flow_name + '_web10g.' + out_file_ext
-                if replot_only == '0' or not os.path.isfile(out) :
-                    # the first grep removes lines with netlink errors printed out
-                    # or last incomplete lines (sed '$d')
-                    # (not sure how to suppress them in web10g)
-                    # the awk command here is a little trick to not print out lines when
-                    # no data is flying around; basically it does suppress lines if
-                    # there is no change with respect to the fields specified.
-                    # this makes the output comparable to siftr where we only
-                    # have output if data is flying around.
-                    local('zcat %s | egrep -v "[a-z]+" | sed \'$d\' | '
-                          'cut -d\',\' -f 1,3,4,5,6,7,8,13,14,%s | grep "%s" | '
-                          'awk -F \',\' \'!a[$2$3$4$5$6$7$8$9]++\' | cut -d\',\' -f 1,10- > %s' %
-                          (web10g_file, attributes, flow, out))
+                params = {'attributes': attributes,
+                          'post_proc': getattr(post_proc, '__name__', '')}
+                if must_derive(replot_only, [out], 'web10g', [web10g_file],
+                               params):
+                    # lines with netlink errors and rows where no data is
+                    # flying around were already removed when splitting
+                    write_split_fields(split_dir, flow, [WEB10G_EXT],
+                                       WEB10G_BASE_FIELDS, attributes, out)
 
                     if post_proc is not None:
                         post_proc(web10g_file, out)
 
+                    record_derived([out], 'web10g', [web10g_file], params)
+
                 if sfil.is_in(flow_name):
-		    if ts_correct == '1':
+		    if ts_correct != '0':
                         host = local(
                             'echo %s | sed "s/.*_\([a-z0-9\.]*\)_web10g.log.gz/\\1/"' %
                             web10g_file,
                             capture=True)
 
-                        out = adjust_timestamps(test_id, out, host, ',', out_dir) 
+                        out = adjust_timestamps(test_id, out, host, ',', out_dir,
+                                                ts_correct_virtual(ts_correct)) 
 
                     out_files[long_flow_name] = out
                     out_groups[out] = group
@@ -1188,6 +1532,8 @@ def extract_cwnd(test_id='', out_dir='', replot_only='0', source_filter='',
 #  @param ts_correct '0' use timestamps as they are (default)
 #                    '1' correct timestamps based on clock offsets estimated
 #                        from broadcast pings
+#                    '2' like '1', but clock offsets are only applied when
+#                        reading the data for plotting (no .tscorr files)
 #  @param io_filter  'i' only use statistics from incoming packets
 #                    'o' only use statistics from outgoing packets
 #                    'io' use statistics from incooming and outgoing packets
@@ -1225,14 +1571,11 @@ def analyse_cwnd(test_id='', out_dir='', replot_only='0', source_filter='',
 #  @param out_file File name for post processed data
 def post_proc_siftr_rtt(siftr_file, out_file):
 
-    hz = local(
-        'zcat %s | head -1 | awk \'{ print $4 }\' | cut -d\'=\' -f 2' %
-        siftr_file,
-        capture=True)
-    tcp_rtt_scale = local(
-        'zcat %s | head -1 | awk \'{ print $5 }\' | cut -d\'=\' -f 2' %
-        siftr_file,
-        capture=True)
+    # header is <enable_time_secs=..> <enable_time_usecs=..> <siftrver=..>
+    # <hz=..> <tcp_rtt_scale=..> ...
+    header = get_log_header(siftr_file).split()
+    hz = header[3].split('=')[1]
+    tcp_rtt_scale = header[4].split('=')[1]
     scaler = str(float(hz) * float(tcp_rtt_scale) / 1000)
     # XXX hmm maybe do the following in python
     tmp_file = local('mktemp "/tmp/tmp.XXXXXXXXXX"', capture=True)
@@ -1372,6 +1715,8 @@ def extract_tcp_rtt(test_id='', out_dir='', replot_only='0', source_filter='',
 #  @param ts_correct '0' use timestamps as they are (default)
 #                    '1' correct timestamps based on clock offsets estimated
 #                        from broadcast pings
+#                    '2' like '1', but clock offsets are only applied when
+#                        reading the data for plotting (no .tscorr files)
 #  @param io_filter 'i' only use statistics from incoming packets
 #                   'o' only use statistics from outgoing packets
 #                   'io' use statistics from incooming and outgoing packets
@@ -1557,6 +1902,8 @@ def extract_tcp_stat(test_id='', out_dir='', replot_only='0', source_filter='',
 #  @param ts_correct '0' use timestamps as they are (default)
 #                    '1' correct timestamps based on clock offsets estimated
 #                        from broadcast pings
+#                    '2' like '1', but clock offsets are only applied when
+#                        reading the data for plotting (no .tscorr files)
 #  @param io_filter  'i' only use statistics from incoming packets
 #                    'o' only use statistics from outgoing packets
 #                    'io' use statistics from incooming and outgoing packets
@@ -1592,6 +1939,45 @@ def analyse_tcp_stat(test_id='', out_dir='', replot_only='0', source_filter='',
     puts('\n[MAIN] COMPLETED plotting TCP Statistic %s \n' % out_name)
 
 
+## Extract packet sizes of a flow in both directions (see
+## _extract_pktsizes). Called in worker processes
+#  @param args Tuple of test ID, out_dir, replot_only, link_len, ts_correct,
+#              output directory, the two dump files, the flow's internal
+#              addresses, ports and protocol, the two output files and a
+#              list of (flow name, output file, host) tuples for the
+#              directions selected by the source filter
+#  @return List of (flow name, interim data file name) tuples
+def _extract_pktsizes_flow(args):
+    (test_id, out_dir, replot_only, link_len, ts_correct, out_dirname,
+     dump1, dump2, src_internal, src_port, dst_internal, dst_port, proto,
+     out_size1, out_size2, selected) = args
+
+    params = {'link_len': link_len}
+    if must_derive(replot_only, [out_size1, out_size2],
+                   'pktsizes', [dump1, dump2], params):
+        # make sure for each flow we get the packet sizes captured
+        # at the _receiver_, hence we use the forward flow with dump2 ...
+        write_pktsizes(get_spool_file(dump2, out_dirname, PktSizeSink.name,
+                                      src_internal, src_port, dst_internal,
+                                      dst_port, proto, replot_only),
+                       link_len, out_size1)
+        write_pktsizes(get_spool_file(dump1, out_dirname, PktSizeSink.name,
+                                      dst_internal, dst_port, src_internal,
+                                      src_port, proto, replot_only),
+                       link_len, out_size2)
+        record_derived([out_size1, out_size2], 'pktsizes',
+                       [dump1, dump2], params)
+
+    ret = []
+    for long_name, out, host in selected:
+        if ts_correct != '0':
+            out = adjust_timestamps(test_id, out, host, ' ', out_dir,
+                                    ts_correct_virtual(ts_correct))
+        ret.append((long_name, out))
+
+    return ret
+
+
 ## Extract packet sizes. Plot function computes throughput based on the packet sizes.
 ## The extracted files have an extension of .psiz. The format is CSV with the
 ## columns:
@@ -1606,10 +1992,15 @@ def analyse_tcp_stat(test_id='', out_dir='', replot_only='0', source_filter='',
 #  @param ts_correct '0' use timestamps as they are (default)
 #                    '1' correct timestamps based on clock offsets estimated
 #                        from broadcast pings
+#  @param total_per_experiment '0' per-flow data (default)
+#                              '1' total data
+#  @param jobs Number of worker processes used for capture passes and flows
+#              ('0' means number of CPUs, '1' means no worker processes)
 #  @return Test ID list, map of flow names to interim data file names and 
 #          map of file names and group IDs
 def _extract_pktsizes(test_id='', out_dir='', replot_only='0', source_filter='',
-                       link_len='0', ts_correct='1', total_per_experiment='0'):
+                       link_len='0', ts_correct='1', total_per_experiment='0',
+                       jobs='1'):
     "Extract per-flow packet size versus time"
 
     ifile_ext = '.dmp.gz'
@@ -1634,28 +2025,21 @@ def _extract_pktsizes(test_id='', out_dir='', replot_only='0', source_filter='',
                                        ifile_ext,
                                        'grep -v "router.dmp.gz" | grep -v "ctl.dmp.gz"')
 
+        # decode tcpdump files once for all metrics
+        if replot_only == '0':
+            run_capture_passes([(tcpdump_file, get_out_dir(tcpdump_file, out_dir))
+                                for tcpdump_file in tcpdump_files], jobs)
+
+        # list of flows to extract, the work for each flow is independent
+        work = []
+
         for tcpdump_file in tcpdump_files:
             # get input directory name and create result directory if necessary
             out_dirname = get_out_dir(tcpdump_file, out_dir)
             dir_name = os.path.dirname(tcpdump_file)
 
-            # unique flows
-            flows = lookup_flow_cache(tcpdump_file)
-            if flows == None:
-                flows = _list(local('zcat %s | tcpdump -nr - "tcp" | '
-                                'awk \'{ if ( $2 == "IP" ) { print $3 " " $5 " tcp" } }\' | '
-                                'sed "s/://" | '
-                                'sed "s/\.\([0-9]*\) /,\\1 /g" | sed "s/ /,/g" | '
-                                'LC_ALL=C sort -u' %
-                                tcpdump_file, capture=True))
-                flows += _list(local('zcat %s | tcpdump -nr - "udp" | '
-                                 'awk \'{ if ( $2 == "IP" ) { print $3 " " $5 " udp" } }\' | '
-                                 'sed "s/://" | '
-                                 'sed "s/\.\([0-9]*\) /,\\1 /g" | sed "s/ /,/g" | '
-                                 'LC_ALL=C sort -u' %
-                                 tcpdump_file, capture=True))
-             
-                append_flow_cache(tcpdump_file, flows)
+            # get unique flows
+            flows = get_flows(tcpdump_file)
 
             # since client sends first packet to server, client-to-server flows
             # will always be first
@@ -1688,64 +2072,42 @@ def _extract_pktsizes(test_id='', out_dir='', replot_only='0', source_filter='',
                 dump1 = dir_name + '/' + test_id + '_' + src + ifile_ext 
                 dump2 = dir_name + '/' + test_id + '_' + dst + ifile_ext 
 
-                # tcpdump filters and output file names
-                filter1 = 'src host ' + src_internal + ' && src port ' + src_port + \
-                    ' && dst host ' + dst_internal + ' && dst port ' + dst_port
-                filter2 = 'src host ' + dst_internal + ' && src port ' + dst_port + \
-                    ' && dst host ' + src_internal + ' && dst port ' + src_port
+                # output file names
                 out_size1 = out_dirname + test_id + '_' + name + ofile_ext 
                 out_size2 = out_dirname + test_id + '_' + rev_name + ofile_ext 
 
                 if long_name not in already_done and long_rev_name not in already_done:
-                    if replot_only == '0' or not ( os.path.isfile(out_size1) and \
-                                               os.path.isfile(out_size2) ):
-                        # make sure for each flow we get the packet sizes captured
-                        # at the _receiver_, hence we use filter1 with dump2 ...
-                        if link_len == '0':
-                            local(
-                                'zcat %s | tcpdump -v -tt -nr - "%s" | '
-                                'awk \'{ print $1 " " $NF }\' | grep ")$" | sed -e "s/)//" > %s' %
-                                (dump2, filter1, out_size1))
-                            local(
-                                'zcat %s | tcpdump -v -tt -nr - "%s" | '
-                                'awk \'{ print $1 " " $NF }\' | grep ")$" | sed -e "s/)//" > %s' %
-                                (dump1, filter2, out_size2))
-                        else:
-                            local(
-                                'zcat %s | tcpdump -e -tt -nr - "%s" | grep "ethertype IP" | '
-                                'awk \'{ print $1 " " $9 }\' | sed -e "s/://" > %s' %
-                                (dump2, filter1, out_size1))
-                            local(
-                                'zcat %s | tcpdump -e -tt -nr - "%s" | grep "ethertype IP" | '
-                                'awk \'{ print $1 " " $9 }\' | sed -e "s/://" > %s' %
-                                (dump1, filter2, out_size2))
-   
                     already_done[long_name] = 1
                     already_done[long_rev_name] = 1
 
+                    selected = []
                     if sfil.is_in(name):
-                        if ts_correct == '1':
-                            out_size1 = adjust_timestamps(test_id, out_size1, dst, ' ', out_dir)
-                        out_files[long_name] = out_size1
-                        out_groups[out_size1] = group
-
+                        selected.append((long_name, out_size1, dst))
                     if sfil.is_in(rev_name):
-                        if ts_correct == '1':
-                            out_size2 = adjust_timestamps(test_id, out_size2, src, ' ', out_dir)
-                        out_files[long_rev_name] = out_size2
-                        out_groups[out_size2] = group
+                        selected.append((long_rev_name, out_size2, src))
+
+                    work.append((test_id, out_dir, replot_only, link_len,
+                                 ts_correct, out_dirname, dump1, dump2,
+                                 src_internal, src_port, dst_internal, dst_port,
+                                 proto, out_size1, out_size2, selected))
+
+        _prepare_workers([test_id], out_dir, ts_correct, jobs)
+        for flow_files in map_jobs(_extract_pktsizes_flow, work, jobs):
+            for long_name, out in flow_files:
+                out_files[long_name] = out
+                out_groups[out] = group
 
         # if desired compute aggregate packet kength data for each experiment
         if total_per_experiment == '1':
 
-            files_list = ''
+            files_list = []
             for name in out_files:
                 if out_groups[out_files[name]] == group:
-                    files_list += out_files[name] + ' '
+                    files_list.append(materialise_timestamps(out_files[name]))
 
             out_size1 = out_dirname + test_id + '_total' + ofile_ext
-            # cat everything together and sort by timestamp
-            local('cat %s | sort -k 1,1 > %s' % (files_list, out_size1))
+            # merge everything together sorted by timestamp
+            merge_sorted_files(files_list, out_size1)
 
             # replace all files for separate flows with total
             delete_list = []
@@ -1770,11 +2132,12 @@ def _extract_pktsizes(test_id='', out_dir='', replot_only='0', source_filter='',
 ## SEE _extract_pktsizes
 @task
 def extract_pktsizes(test_id='', out_dir='', replot_only='0', source_filter='',
-                       link_len='0', ts_correct='1', total_per_experiment='0'):
+                       link_len='0', ts_correct='1', total_per_experiment='0',
+                       jobs='1'):
     "Extract throughput for generated traffic flows"
 
     _extract_pktsizes(test_id, out_dir, replot_only, source_filter, link_len,
-                        ts_correct, total_per_experiment)
+                        ts_correct, total_per_experiment, jobs)
     # done
     puts('\n[MAIN] COMPLETED extracting packet sizes %s \n' % test_id)
 
@@ -1803,23 +2166,27 @@ def extract_pktsizes(test_id='', out_dir='', replot_only='0', source_filter='',
 #  @param ts_correct '0' use timestamps as they are (default)
 #                    '1' correct timestamps based on clock offsets estimated
 #                        from broadcast pings
+#                    '2' like '1', but clock offsets are only applied when
+#                        reading the data for plotting (no .tscorr files)
 #  @param plot_params: set env parameters for plotting
 #  @param plot_script: specify the script used for plotting, must specify full path
 #  @param total_per_experiment '0' plot per-flow throughput (default)
 #                              '1' plot total throughput
+#  @param jobs Number of worker processes used for capture passes and flows
+#              ('0' means number of CPUs, '1' means no worker processes)
 @task
 def analyse_throughput(test_id='', out_dir='', replot_only='0', source_filter='',
                        min_values='3', omit_const='0', ymin='0', ymax='0', lnames='',
                        link_len='0', stime='0.0', etime='0.0', out_name='',
                        pdf_dir='', ts_correct='1', plot_params='', plot_script='',
-                       total_per_experiment='0'):
+                       total_per_experiment='0', jobs='1'):
     "Plot throughput for generated traffic flows"
 
     (test_id_arr,
      out_files, 
      out_groups) =_extract_pktsizes(test_id, out_dir, replot_only, 
                               source_filter, link_len, ts_correct,
-                              total_per_experiment)
+                              total_per_experiment, jobs)
 
     if total_per_experiment == '0':
         sort_flowkey='1'
@@ -1858,6 +2225,128 @@ def get_experiment_list(exp_list='', test_id=''):
     return experiments
 
 
+## Get list of experiment IDs to process, i.e. the experiments starting with
+## resume_id if specified
+#  @param experiments List of test IDs
+#  @param resume_id Resume analysis with this test_id (ignore all test_ids
+#                   before this)
+#  @return List of test IDs
+def get_resume_list(experiments, resume_id=''):
+
+    if resume_id == '':
+        return experiments
+
+    puts('Resuming analysis with test_id %s' % resume_id)
+    if resume_id not in experiments:
+        return []
+
+    return experiments[experiments.index(resume_id):]
+
+
+## Run task for one experiment in worker process
+#  @param args Tuple of task name, test ID, positional and keyword arguments
+def _run_all_task(args):
+    name, test_id, nargs, kwargs = args
+
+    execute(globals()[name], test_id, *nargs, **kwargs)
+
+
+## Get clock offsets of one experiment in worker process
+#  @param args Tuple of test ID and output directory
+def _clock_offsets_task(args):
+    test_id, out_dir = args
+
+    # one experiment per node, the graph runs the nodes concurrently
+    execute(get_clock_offsets, test_id=test_id, out_dir=out_dir, jobs='1')
+
+
+## Get experiments without clock offsets file. Also builds the file index
+## and directory cache before worker processes are started
+#  @param experiments List of test IDs
+#  @param out_dir Output directory for result files
+#  @param ts_correct '0' timestamps are not corrected
+#  @return List of test IDs
+def _get_missing_offsets(experiments, out_dir, ts_correct):
+
+    missing = []
+    for test_id in experiments:
+        tcpdump_files = get_testid_file_list('', test_id, '_ctl.dmp.gz', '',
+                                             no_abort=True)
+        if ts_correct != '0' and len(tcpdump_files) > 0:
+            offs_fname = get_out_dir(tcpdump_files[0], out_dir) + test_id + \
+                CLOCK_OFFSET_FILE_EXT
+            if not os.path.isfile(offs_fname):
+                missing.append(test_id)
+
+    return missing
+
+
+## Prepare experiments before they are processed by worker processes.
+## Builds the file index and directory cache, and gets missing clock offsets
+## which otherwise the workers of one experiment would compute concurrently
+#  @param experiments List of test IDs
+#  @param out_dir Output directory for result files
+#  @param ts_correct '0' timestamps are not corrected
+#  @param jobs Number of worker processes ('0' means number of CPUs,
+#              '1' means no worker processes)
+def _prepare_workers(experiments, out_dir, ts_correct, jobs='1'):
+
+    missing = _get_missing_offsets(experiments, out_dir, ts_correct)
+    if len(missing) > 0:
+        execute(get_clock_offsets, test_id=';'.join(missing), out_dir=out_dir,
+                jobs=jobs)
+
+
+## Run tasks for all experiments. The (task, experiment) pairs are nodes of
+## a dependency graph, with more than one job processed by worker processes.
+## The tasks of an experiment depend on a node that gets its clock offsets
+## (if missing), so the offsets of one experiment are computed while the
+## tasks of other experiments already run. A failure does not stop the
+## other experiments, failed pairs are reported at the end
+#  @param experiments List of test IDs
+#  @param tasks List of tuples of task name, positional and keyword arguments.
+#               The test ID is passed as first positional argument
+#  @param jobs Number of worker processes ('0' means number of CPUs)
+#  @param out_dir Output directory for result files
+#  @param ts_correct '0' timestamps are not corrected
+def _run_all(experiments, tasks, jobs, out_dir, ts_correct):
+
+    jobs = int(jobs)
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(tasks) * len(experiments))
+
+    nodes = []
+    offsets_nodes = {}
+    for test_id in _get_missing_offsets(experiments, out_dir, ts_correct):
+        offsets_nodes[test_id] = [('get_clock_offsets', test_id)]
+        nodes.append((('get_clock_offsets', test_id), _clock_offsets_task,
+                      (test_id, out_dir), []))
+
+    if jobs <= 1:
+        # process all tasks of an experiment before the next experiment
+        pairs = [(task, test_id) for test_id in experiments for task in tasks]
+    else:
+        # process one task for all experiments before the next task, so
+        # workers rarely wait for each other's capture pass or log split
+        pairs = [(task, test_id) for task in tasks for test_id in experiments]
+    for (name, nargs, kwargs), test_id in pairs:
+        nodes.append(((name, test_id), _run_all_task,
+                      (name, test_id, nargs, kwargs),
+                      offsets_nodes.get(test_id, [])))
+
+    results = run_graph(nodes, jobs)
+
+    failed = [(node[0], results[node[0]][1]) for node in nodes
+              if results[node[0]][1] is not None]
+    failed.sort(key=lambda res: experiments.index(res[0][1]))
+    for (name, test_id), error in failed:
+        warn('%s failed for experiment %s: %s' % (name, test_id, error))
+
+    if len(failed) > 0:
+        abort('%i of %i tasks failed' % (len(failed), len(nodes)))
+
+
 ## Do all extraction 
 #  @param exp_list List of all test IDs
 #  @param test_id Test ID prefix of experiment to analyse
@@ -1876,33 +2365,28 @@ def get_experiment_list(exp_list='', test_id=''):
 #                   'io' use statistics from incooming and outgoing packets
 #                   (only effective for SIFTR files)
 #  @param web10g_version web10g version string (default is 2.0.9)
+#  @param jobs Number of worker processes ('0' means number of CPUs,
+#              '1' means no worker processes)
 @task
 def extract_all(exp_list='experiments_completed.txt', test_id='', out_dir='',
                 replot_only='0', source_filter='', resume_id='', 
-                link_len='0', ts_correct='1', io_filter='o', web10g_version='2.0.9'):
+                link_len='0', ts_correct='1', io_filter='o', web10g_version='2.0.9',
+                jobs='1'):
     "Extract SPP RTT, TCP RTT, CWND and throughput statistics"
 
-    experiments = get_experiment_list(exp_list, test_id)
+    experiments = get_resume_list(get_experiment_list(exp_list, test_id),
+                                  resume_id)
 
-    do_analyse = True
-    if resume_id != '':
-        puts('Resuming analysis with test_id %s' % resume_id)
-        do_analyse = False
+    args = (out_dir, replot_only, source_filter)
+    tasks = [
+        ('extract_rtt', args, dict(ts_correct=ts_correct)),
+        ('extract_cwnd', args, dict(ts_correct=ts_correct, io_filter=io_filter)),
+        ('extract_tcp_rtt', args, dict(ts_correct=ts_correct, io_filter=io_filter,
+                                       web10g_version=web10g_version)),
+        ('extract_pktsizes', args, dict(link_len=link_len, ts_correct=ts_correct)),
+        ]
 
-    for test_id in experiments:
-
-        if test_id == resume_id:
-            do_analyse = True
-
-        if do_analyse:
-            execute(extract_rtt, test_id, out_dir, replot_only, source_filter,
-                    ts_correct=ts_correct)
-            execute(extract_cwnd, test_id, out_dir, replot_only, source_filter, 
-                    ts_correct=ts_correct, io_filter=io_filter)
-            execute(extract_tcp_rtt, test_id, out_dir, replot_only, source_filter, 
-                    ts_correct=ts_correct, io_filter=io_filter, web10g_version=web10g_version)
-            execute(extract_pktsizes, test_id, out_dir, replot_only, source_filter,
-                    link_len=link_len, ts_correct=ts_correct)
+    _run_all(experiments, tasks, jobs, out_dir, ts_correct)
 
 
 ## Do all analysis
@@ -1939,44 +2423,35 @@ def extract_all(exp_list='experiments_completed.txt', test_id='', out_dir='',
 #  @param web10g_version web10g version string (default is 2.0.9)
 #  @param plot_params Parameters passed to plot function via environment variables
 #  @param plot_script Specify the script used for plotting, must specify full path
+#  @param jobs Number of worker processes ('0' means number of CPUs,
+#              '1' means no worker processes)
 @task
 def analyse_all(exp_list='experiments_completed.txt', test_id='', out_dir='',
                 replot_only='0', source_filter='', min_values='3', omit_const='0',
                 smoothed='1', resume_id='', lnames='', link_len='0', stime='0.0',
                 etime='0.0', out_name='', pdf_dir='', ts_correct='1',
-                io_filter='o', web10g_version='2.0.9', plot_params='', plot_script=''):
+                io_filter='o', web10g_version='2.0.9', plot_params='', plot_script='',
+                jobs='1'):
     "Compute SPP RTT, TCP RTT, CWND and throughput statistics"
 
-    experiments = get_experiment_list(exp_list, test_id)
+    experiments = get_resume_list(get_experiment_list(exp_list, test_id),
+                                  resume_id)
 
-    do_analyse = True
-    if resume_id != '':
-        puts('Resuming analysis with test_id %s' % resume_id)
-        do_analyse = False
-
-    for test_id in experiments:
+    args = (out_dir, replot_only, source_filter, min_values)
+    plot_args = dict(omit_const=omit_const, lnames=lnames, stime=stime,
+                     etime=etime, out_name=out_name, pdf_dir=pdf_dir,
+                     ts_correct=ts_correct, plot_params=plot_params,
+                     plot_script=plot_script)
+    tasks = [
+        ('analyse_rtt', args, plot_args),
+        ('analyse_cwnd', args, dict(plot_args, io_filter=io_filter)),
+        ('analyse_tcp_rtt', args, dict(plot_args, smoothed=smoothed,
+                                       io_filter=io_filter,
+                                       web10g_version=web10g_version)),
+        ('analyse_throughput', args, dict(plot_args, link_len=link_len)),
+        ]
 
-        if test_id == resume_id:
-            do_analyse = True
-
-        if do_analyse:
-            execute(analyse_rtt, test_id, out_dir, replot_only, source_filter,
-                    min_values, omit_const=omit_const, lnames=lnames, stime=stime,
-                    etime=etime, out_name=out_name, pdf_dir=pdf_dir,
-                    ts_correct=ts_correct, plot_params=plot_params, plot_script=plot_script)
-            execute(analyse_cwnd, test_id, out_dir, replot_only, source_filter, min_values,
-                    omit_const=omit_const, lnames=lnames, stime=stime, etime=etime,
-                    out_name=out_name, pdf_dir=pdf_dir, ts_correct=ts_correct,
-                    io_filter=io_filter, plot_params=plot_params, plot_script=plot_script)
-            execute(analyse_tcp_rtt, test_id, out_dir, replot_only, source_filter, min_values,
-                    omit_const=omit_const, smoothed=smoothed, lnames=lnames,
-                    stime=stime, etime=etime, out_name=out_name, pdf_dir=pdf_dir,
-                    ts_correct=ts_correct, io_filter=io_filter, web10g_version=web10g_version,
-                    plot_params=plot_params, plot_script=plot_script)
-            execute(analyse_throughput, test_id, out_dir, replot_only, source_filter,
-                    min_values, omit_const=omit_const, lnames=lnames, link_len=link_len,
-                    stime=stime, etime=etime, out_name=out_name, pdf_dir=pdf_dir,
-                    ts_correct=ts_correct, plot_params=plot_params, plot_script=plot_script)
+    _run_all(experiments, tasks, jobs, out_dir, ts_correct)
 
 
 ## Extract incast response times from httperf files 
@@ -2079,7 +2554,10 @@ def _extract_incast(test_id='', out_dir='', replot_only='0', source_filter='',
                 out_files[long_name] = out_fname
                 out_groups[out_fname] = group
 
-                if replot_only == '0' or not os.path.isfile(out_fname) :
+                params = {'responder': cnt, 'sburst': sburst,
+                          'eburst': eburst}
+                if must_derive(replot_only, [out_fname], 'incast', [log_file],
+                               params):
                     f = open(out_fname, 'w')
 
                     responses = _list(local('zcat %s | grep "incast_files"' %
@@ -2115,6 +2593,8 @@ def _extract_incast(test_id='', out_dir='', replot_only='0', source_filter='',
 
                     f.close()
 
+                    record_derived([out_fname], 'incast', [log_file], params)
+
                 cnt += 1
 
         # abort but only after we fully processed the problematic experiment
@@ -2144,65 +2624,148 @@ def extract_incast(test_id='', out_dir='', replot_only='0', source_filter='',
     puts('\n[MAIN] COMPLETED extracting incast response times %s\n' % test_id)
 
 
-## Get slowest response time per burst
-#  @param out_files List of data files
-#  @param out_groups Map of files to groups
-#  @param mode '0' slowest response time
-#              '1' time between first request and last response finished
-#  @return Map of flow names to file names, map of file names to group IDs
-def get_slowest_response_time(out_files, out_groups, mode=0):
+## Get response time statistics per burst of one responder
+#  @param fname Data file name (columns timestamp, burst and response time
+#               as last column)
+#  @return Tuple of burst IDs, time of first request, slowest response
+#          time, earliest request time and latest finish time per burst.
+#          Bursts are sorted by burst ID (NumPy arrays if NumPy is available,
+#          lists otherwise)
+def _get_burst_response_stats(fname):
+
+    with open(fname, 'r') as f:
+        if np is not None:
+            data = f.read()
+            n = data.count('\n')
+            if data != '' and data[-1] != '\n':
+                n += 1
+            cols = len(data.split('\n', 1)[0].split())
+            values = np.fromstring(data, sep=' ')
+            data = None
+            if cols >= 3 and len(values) == n * cols:
+                values = values.reshape(n, cols)
+                # stable sort, so the first request of a burst stays first
+                order = np.argsort(values[:, 1], kind='mergesort')
+                times = values[order, 0]
+                bursts = values[order, 1]
+                res_times = values[order, -1]
+                return _reduce_bursts(bursts, times, res_times, times,
+                                      times + res_times)
+
+            # different number of columns per line, parse line by line
+            f.seek(0)
+
+        stats = {}
+        for line in f:
+            fields = line.split()
+            _time = float(fields[0])
+            _burst = float(fields[1])
+            # response time is in last column, but column number differs
+            # for httperf vs tcpdump extracted data
+            _res_time = float(fields[-1])
+            _time_finished = _time + _res_time
+
+            if _burst not in stats:
+                # use the first time as time burst ocurred
+                stats[_burst] = [_time, _res_time, _time, _time_finished]
+            else:
+                stat = stats[_burst]
+                if _res_time > stat[1]:
+                    stat[1] = _res_time
+                if _time < stat[2]:
+                    stat[2] = _time
+                if _time_finished > stat[3]:
+                    stat[3] = _time_finished
 
-    slowest = {}
-    earliest = {}
-    latest = {}
-    burst_time = {}
+    bursts = sorted(stats.keys())
+    ret = [bursts] + [[stats[_burst][i] for _burst in bursts] for i in range(4)]
+    if np is not None:
+        ret = [np.array(col, dtype=float) for col in ret]
 
-    for group in set(out_groups.values()):
-        fname = ''
-        for name in out_files.keys():
-            if out_groups[out_files[name]] == group:
+    return tuple(ret)
 
-                # read data file and adjust slowest
-                f = open(out_files[name], 'r')
-                for line in f.readlines():
-                    _time = float(line.split()[0])
-                    _burst = float(line.split()[1])
-                    # response time is in last column, but column number differs
-                    # for httperf vs tcpdump extracted data
-                    _res_time = float(line.split()[-1])
 
-                    _time_finished = _time + _res_time
+## Reduce per-burst values sorted by burst ID (NumPy only)
+#  @param bursts Burst IDs
+#  @param burst_times Times bursts occurred, the first value per burst is used
+#  @param res_times Response times, the maximum per burst is used
+#  @param times Request times, the minimum per burst is used
+#  @param times_finished Finish times, the maximum per burst is used
+#  @return Tuple of burst IDs, time of first request, slowest response time,
+#          earliest request time and latest finish time per burst
+def _reduce_bursts(bursts, burst_times, res_times, times, times_finished):
 
-                    # use the first time as time burst ocurred
-                    if _burst not in burst_time:
-                        burst_time[_burst] = _time
+    if len(bursts) == 0:
+        return (bursts, burst_times, res_times, times, times_finished)
 
-                    if _burst not in slowest:
-                        slowest[_burst] = _res_time
-                    else:
-                        if _res_time > slowest[_burst]:
-                            slowest[_burst] = _res_time
+    starts = np.flatnonzero(np.concatenate(([True],
+                                            bursts[1:] != bursts[:-1])))
 
-                    if _burst not in earliest:
-                        earliest[_burst] = _time
-                    else:
-                        if _time < earliest[_burst]:
-                            earliest[_burst] = _time
+    return (bursts[starts], burst_times[starts],
+            np.maximum.reduceat(res_times, starts),
+            np.minimum.reduceat(times, starts),
+            np.maximum.reduceat(times_finished, starts))
 
-                    if _burst not in latest:
-                        latest[_burst] = _time_finished
-                    else:
-                        if _time_finished > latest[_burst]:
-                            latest[_burst] = _time_finished
 
-                f.close()
+## Get slowest response time per burst
+#  @param out_files List of data files
+#  @param out_groups Map of files to groups
+#  @param mode '0' slowest response time
+#              '1' time between first request and last response finished
+#  @return Map of flow names to file names, map of file names to group IDs
+def get_slowest_response_time(out_files, out_groups, mode=0):
 
-                if fname == '':
-                    fname = out_files[name]
+    group_names = {}
+    for name in out_files.keys():
+        group = out_groups[out_files[name]]
+        if group not in group_names:
+            group_names[group] = []
+        group_names[group].append(name)
 
-                # delete entries for single responders
-                del out_groups[out_files[name]]
-                del out_files[name]
+    for group in set(out_groups.values()):
+        # per-burst statistics of each responder, only one responder file is
+        # read into memory at a time
+        stats = []
+        for name in group_names[group]:
+            stats.append(_get_burst_response_stats(out_files[name]))
+
+        fname = out_files[group_names[group][0]]
+        for name in group_names[group]:
+            # delete entries for single responders
+            del out_groups[out_files[name]]
+            del out_files[name]
+
+        # reduce over all responders of the group
+        if np is not None:
+            cols = [np.concatenate([stat[i] for stat in stats])
+                    for i in range(5)]
+            # stable sort, so the first responder of a burst stays first
+            order = np.argsort(cols[0], kind='mergesort')
+            (bursts, burst_time, slowest, earliest,
+             latest) = _reduce_bursts(*[col[order] for col in cols])
+            bursts = bursts.tolist()
+            burst_time = burst_time.tolist()
+            slowest = slowest.tolist()
+            earliest = earliest.tolist()
+            latest = latest.tolist()
+        else:
+            merged = {}
+            for stat in stats:
+                for i in range(len(stat[0])):
+                    _burst = stat[0][i]
+                    if _burst not in merged:
+                        merged[_burst] = [stat[1][i], stat[2][i], stat[3][i],
+                                          stat[4][i]]
+                    else:
+                        m = merged[_burst]
+                        m[1] = max(m[1], stat[2][i])
+                        m[2] = min(m[2], stat[3][i])
+                        m[3] = max(m[3], stat[4][i])
+            bursts = sorted(merged.keys())
+            burst_time = [merged[_burst][0] for _burst in bursts]
+            slowest = [merged[_burst][1] for _burst in bursts]
+            earliest = [merged[_burst][2] for _burst in bursts]
+            latest = [merged[_burst][3] for _burst in bursts]
 
         fname = re.sub('_[0-9]*_[0-9]*\.[0-9]*\.[0-9]*\.[0-9]*_[0-9]*\.', '_0_0.0.0.0_0.', fname)
         fname += '.slowest'
@@ -2210,13 +2773,13 @@ def get_slowest_response_time(out_files, out_groups, mode=0):
 
         # write file for slowest response times
         f = open(fname, 'w')
-        for _burst in sorted(slowest.keys()):
+        for i in range(len(bursts)):
             if mode == 0:
                 # slowest response time of all 
-                f.write('%f %f\n' % (burst_time[_burst], slowest[_burst]))
+                f.write('%f %f\n' % (burst_time[i], slowest[i]))
             else:
                 # time between first request and last response finished
-                f.write('%f %f\n' % (burst_time[_burst], latest[_burst] - earliest[_burst]))
+                f.write('%f %f\n' % (burst_time[i], latest[i] - earliest[i]))
 
         f.close()
 
@@ -2349,6 +2912,11 @@ def analyse_incast(test_id='', out_dir='', replot_only='0', source_filter='',
 #
 def extract_dupACKs_bursts(acks_file='', burst_sep=0):
 
+    if np is not None:
+        new_fnames = _extract_dupACKs_bursts_np(acks_file, burst_sep)
+        if new_fnames is not None:
+            return new_fnames
+
     # New filenames (source file + ".0" or ".1,.2,....N" for bursts)
     new_fnames = []
 
@@ -2462,6 +3030,173 @@ def extract_dupACKs_bursts(acks_file='', burst_sep=0):
     return new_fnames
 
 
+## NumPy version of extract_dupACKs_bursts. The columns of the .acks file
+## are loaded once and dupACK counts, burst boundaries and the per-burst
+## sequence numbers are computed as array operations. All burst files are
+## written through one DemuxWriter
+#  @param acks_file Full path to a specific .acks file
+#  @param burst_sep See extract_dupACKs_bursts
+#  @return Vector of file names, or None if the file can't be handled here
+#          (malformed lines, or unsorted timestamps with burst_sep < 0)
+def _extract_dupACKs_bursts_np(acks_file, burst_sep):
+
+    try:
+        with open(acks_file) as f:
+            data = f.read()
+    except IOError:
+        print('extract_dupACKs_bursts(): File access problem while working on %s' % acks_file)
+        return []
+
+    if burst_sep != 0:
+        first_burst = 1
+    else:
+        first_burst = 0
+
+    tokens = data.split()
+    n = data.count('\n')
+    if data != '' and data[-1] != '\n':
+        n += 1
+    if len(tokens) != 2 * n:
+        return None
+
+    if n == 0:
+        fname = acks_file + '.' + str(first_burst)
+        open(fname, 'w').close()
+        return [fname]
+
+    # parse all numbers at once, stops at the first malformed number
+    values = np.fromstring(data, sep=' ')
+    if len(values) != 2 * n:
+        return None
+    times = values[0::2]
+    seqnos = values[1::2].astype(np.int64)
+
+    # the line by line version needs the first seq number to be zero
+    if seqnos[0] != 0:
+        return None
+
+    # first line of each burst
+    if burst_sep > 0:
+        # burst starts if time since previous ACK >= burst_sep
+        starts = np.concatenate(([0], np.flatnonzero(
+            times[1:] - times[:-1] >= burst_sep) + 1))
+    elif burst_sep < 0:
+        # burst starts if time since first ACK of burst >= abs(burst_sep)
+        if np.any(times[1:] < times[:-1]):
+            return None
+
+        sep = abs(burst_sep)
+        starts = [0]
+        while True:
+            start = starts[-1]
+            i = int(np.searchsorted(times, times[start] + sep))
+            # use the same comparison as the line by line version
+            while i > start + 1 and times[i - 1] - times[start] >= sep:
+                i -= 1
+            while i < n and times[i] - times[start] < sep:
+                i += 1
+            if i >= n:
+                break
+            starts.append(i)
+        starts = np.array(starts)
+    else:
+        starts = np.array([0])
+
+    # dupACK is an ACK with unchanged (non-zero) seq number wrt preceding
+    # ACK. Counter restarts at ACKs with zero seq number and at each burst
+    dups = np.zeros(n, dtype=np.int64)
+    dups[1:] = (seqnos[1:] == seqnos[:-1]) & (seqnos[1:] != 0)
+    resets = seqnos == 0
+    resets[starts] = True
+    cum_dups = np.cumsum(dups)
+    last_reset = np.maximum.accumulate(np.where(resets, np.arange(n), 0))
+    dupacks = cum_dups - cum_dups[last_reset]
+
+    # seq numbers of bursts 2..N are relative to the last seq number of the
+    # previous burst (or zero if the first ACK of the burst has a zero seq
+    # number, as in the line by line version)
+    lengths = np.diff(np.append(starts, n))
+    prev_seqnos = np.where(seqnos[starts[1:]] == 0, 0, seqnos[starts[1:] - 1])
+    first_bytes = np.zeros(len(starts), dtype=np.int64)
+    first_bytes[1:] = prev_seqnos
+    bytes_gap = seqnos - np.repeat(first_bytes, lengths)
+
+    for k in range(1, len(starts)):
+        b = starts[k]
+        if burst_sep < 0:
+            ack_gap = times[b] - times[starts[k - 1]]
+        else:
+            ack_gap = times[b] - times[b - 1]
+        if seqnos[b] == 0:
+            burst_dups = 0
+        else:
+            burst_dups = cum_dups[b] - cum_dups[last_reset[b - 1]]
+
+        print ("Burst: %3i, ends at %f sec, data: %i bytes, gap: %3.6f sec, dupACKs: %i" %
+        ( k, times[b - 1], prev_seqnos[k - 1] - first_bytes[k - 1], ack_gap, burst_dups ) )
+
+    # <time>  <ACK seq number>  <dupACK count>
+    lines = [ts + ' ' + str(seqno) + ' ' + str(dupack) + '\n'
+             for ts, seqno, dupack in zip(tokens[0::2], bytes_gap.tolist(),
+                                          dupacks.tolist())]
+
+    new_fnames = []
+    writer = DemuxWriter()
+    for k in range(len(starts)):
+        fname = acks_file + '.' + str(k + first_burst)
+        new_fnames.append(fname)
+        writer.set_header(fname, '')
+        writer.write(fname, ''.join(lines[starts[k]:starts[k] + lengths[k]]))
+    writer.close()
+
+    return new_fnames
+
+
+## Extract ACK sequence numbers of a flow in both directions and compute
+## dupACKs and bursts (see _extract_ackseq). Called in worker processes
+#  @param args Tuple of test ID, out_dir, replot_only, ts_correct, burst_sep,
+#              output directory, the two dump files, the flow's internal
+#              addresses and ports, the two output files and a list of
+#              (flow name, output file, host) tuples for the directions
+#              selected by the source filter
+#  @return List of (flow name, list of dupACK/burst file names) tuples
+def _extract_ackseq_flow(args):
+    (test_id, out_dir, replot_only, ts_correct, burst_sep, out_dirname,
+     dump1, dump2, src_internal, src_port, dst_internal, dst_port,
+     out_acks1, out_acks2, selected) = args
+
+    if must_derive(replot_only, [out_acks1, out_acks2],
+                   'ackseq', [dump1, dump2]):
+
+        # make sure for each flow we get the ACKs captured
+        # at the _receiver_, hence we use the forward flow with dump2 ...
+        # The spool files only contain packets with just the ACK flag
+        # set (eliminate SYN and FIN, even if ACK also set) and absolute
+        # ACK numbers, which we normalise to the first ACK number
+        write_ackseq(get_spool_file(dump2, out_dirname, AckSeqSink.name,
+                                    src_internal, src_port, dst_internal,
+                                    dst_port, 'tcp', replot_only),
+                     out_acks1)
+        write_ackseq(get_spool_file(dump1, out_dirname, AckSeqSink.name,
+                                    dst_internal, dst_port, src_internal,
+                                    src_port, 'tcp', replot_only),
+                     out_acks2)
+        record_derived([out_acks1, out_acks2], 'ackseq', [dump1, dump2])
+
+    ret = []
+    for long_name, out, host in selected:
+        if ts_correct != '0':
+            out = adjust_timestamps(test_id, out, host, ' ', out_dir)
+
+        # do the dupACK calculations and burst extraction here,
+        # return a new vector of one or more filenames, pointing to file(s) containing
+        # <time> <seq_no> <dupACKs>
+        ret.append((long_name, extract_dupACKs_bursts(acks_file = out,
+                                                      burst_sep = burst_sep)))
+
+    return ret
+
+
 ## Extract cumulative bytes ACKnowledged and cumulative dupACKs
 ## Intermediate files end in ".acks", ".acks.N", ".acks.tscorr" or ".acks.tscorr.N"
 ## XXX move sburst and eburst to the plotting task and here extract all?
@@ -2483,10 +3218,12 @@ def extract_dupACKs_bursts(acks_file='', burst_sep=0):
 #  @param eburst End plotting with burst N (bursts are numbered from 1)
 #   @param total_per_experiment '0' per-flow data (default)
 #                               '1' total data 
+#  @param jobs Number of worker processes used for capture passes and flows
+#              ('0' means number of CPUs, '1' means no worker processes)
 #  @return Experiment ID list, map of flow names to file names, map of file names to group IDs
 def _extract_ackseq(test_id='', out_dir='', replot_only='0', source_filter='',
                     ts_correct='1', burst_sep='0.0',
-                    sburst='1', eburst='0', total_per_experiment='0'):
+                    sburst='1', eburst='0', total_per_experiment='0', jobs='1'):
     "Extract cumulative bytes ACKnowledged vs time / extract incast bursts"
 
     ifile_ext = '.dmp.gz'
@@ -2515,22 +3252,21 @@ def _extract_ackseq(test_id='', out_dir='', replot_only='0', source_filter='',
                                        ifile_ext,
                                        'grep -v "router.dmp.gz" | grep -v "ctl.dmp.gz"')
 
+        # decode tcpdump files once for all metrics
+        if replot_only == '0':
+            run_capture_passes([(tcpdump_file, get_out_dir(tcpdump_file, out_dir))
+                                for tcpdump_file in tcpdump_files], jobs)
+
+        # list of flows to extract, the work for each flow is independent
+        work = []
+
         for tcpdump_file in tcpdump_files:
             # get input directory name and create result directory if necessary
             dir_name = os.path.dirname(tcpdump_file)
             out_dirname = get_out_dir(tcpdump_file, out_dir)
 
-            # unique flows
-            flows = lookup_flow_cache(tcpdump_file)
-            if flows == None:
-                flows = _list(local('zcat %s | tcpdump -nr - "tcp" | '
-                                'awk \'{ if ( $2 == "IP" ) { print $3 " " $5 " tcp" } }\' | '
-                                'sed "s/://" | '
-                                'sed "s/\.\([0-9]*\) /,\\1 /g" | sed "s/ /,/g" | '
-                                'LC_ALL=C sort -u' %
-                                tcpdump_file, capture=True))
-
-                append_flow_cache(tcpdump_file, flows)
+            # get unique flows
+            flows = get_flows(tcpdump_file, 'tcp')
 
             # since client sends first packet to server, client-to-server flows
             # will always be first
@@ -2563,133 +3299,57 @@ def _extract_ackseq(test_id='', out_dir='', replot_only='0', source_filter='',
                 dump1 = dir_name + '/' + test_id + '_' + src + ifile_ext 
                 dump2 = dir_name + '/' + test_id + '_' + dst + ifile_ext 
 
-                # tcpdump filters and output file names
-                # 'tcp[tcpflags] == tcp-ack' rule to extract only ACK packets (eliminate SYN and FIN, even if ACK also set)
-                filter1 = 'src host ' + src_internal + ' && src port ' + src_port + \
-                    ' && dst host ' + dst_internal + ' && dst port ' + dst_port + \
-                    ' && tcp[tcpflags] == tcp-ack'
-                filter2 = 'src host ' + dst_internal + ' && src port ' + dst_port + \
-                    ' && dst host ' + src_internal + ' && dst port ' + src_port + \
-                    ' && tcp[tcpflags] == tcp-ack'
-
+                # output file names
                 out_acks1 = out_dirname + test_id + '_' + name + ofile_ext 
                 out_acks2 = out_dirname + test_id + '_' + rev_name + ofile_ext 
 
                 if long_name not in already_done and long_rev_name not in already_done:
-                    if replot_only == '0' or not ( os.path.isfile(out_acks1) and \
-                                               os.path.isfile(out_acks2) ):
-
-                        # make sure for each flow we get the ACKs captured
-                        # at the _receiver_, hence we use filter1 with dump2 ...
-                        # Use "-S" option to tcpdump so ACK sequence numbers are always absolute
-
-                        # Grab first ACK sequence numbers for later use as a baseline
-
-                        baseACK1 = local(
-                            'zcat %s | tcpdump -c 1 -S -tt -nr - "%s" | '
-                            'awk \'{ FS=" " ; for(i=2;i<=NF;i++) { if ( $i  == "ack") { print $(i+1) }  } ; }\' | sed \'s/,//\' ' %
-                            (dump2, filter1), capture=True)
-                        baseACK2 = local(
-                            'zcat %s | tcpdump -c 1 -S -tt -nr - "%s" | '
-                            'awk \'{ FS=" " ; for(i=2;i<=NF;i++) { if ( $i  == "ack") { print $(i+1) }  } ; }\' | sed \'s/,//\' ' %
-                            (dump1, filter2), capture=True)
-
-                        #puts('\n[MAIN] BASEACKs %s %s\n' % (baseACK1, baseACK2))
-
-                        # Now extract all ACK sequence numbers, normalised to baseACK{1,2}
-
-                        local(
-                            'zcat %s | tcpdump -S -tt -nr - "%s" | '
-                            'awk \'{ FS=" " ; for(i=2;i<=NF;i++) { if ( $i  == "ack") { print $1 " " $(i+1) - %s }  } ; }\' | sed \'s/,//\'  > %s' %
-                            (dump2, filter1, baseACK1, out_acks1))
-                        local(
-                            'zcat %s | tcpdump -S -tt -nr - "%s" | '
-                            'awk \'{ FS=" " ; for(i=2;i<=NF;i++) { if ( $i  == "ack") { print $1 " " $(i+1) - %s }  } ; }\' | sed \'s/,//\'  > %s' %
-                            (dump1, filter2, baseACK2, out_acks2))
-
                     already_done[long_name] = 1
                     already_done[long_rev_name] = 1
 
+                    selected = []
                     if sfil.is_in(name):
-                        if ts_correct == '1':
-                            out_acks1 = adjust_timestamps(test_id, out_acks1, dst, ' ', out_dir)
-
-                        # do the dupACK calculations and burst extraction here,
-                        # return a new vector of one or more filenames, pointing to file(s) containing
-                        # <time> <seq_no> <dupACKs>
-                        #
-                        out_acks1_dups_bursts = extract_dupACKs_bursts(acks_file = out_acks1, 
-                                                          burst_sep = burst_sep)
-                        # Incorporate the extracted .N files
-                        # as a new, expanded set of filenames to be plotted.
-                        # Update the out_files dictionary (key=interim legend name based on flow, value=file)
-                        # and out_groups dictionary (key=file name, value=group)
-                        if burst_sep == 0.0:
-                            # Assume this is a single plot (not broken into bursts)
-                            # The plot_time_series() function expects key to have a single string
-                            # value rather than a vector. Take the first (and presumably only)
-                            # entry in the vector returned by extract_dupACKs_bursts()
-                            out_files[long_name] = out_acks1_dups_bursts[0]
-                            out_groups[out_acks1_dups_bursts[0]] = group
-                        else:
-                            # This trial has been broken into one or more bursts.
-                            # plot_incast_ACK_series() knows how to parse a key having a
-                            # 'vector of strings' value.
-                            # Also filter the selection based on sburst/eburst nominated by user
-                            if eburst == 0 :
-                                eburst = len(out_acks1_dups_bursts)
-                            # Catch case when eburst was set non-zero but also > number of actual bursts
-                            eburst = min(eburst,len(out_acks1_dups_bursts))
-                            if sburst <= 0 :
-                                sburst = 1
-                            # Catch case where sburst set greater than eburst
-                            if sburst > eburst :
-                                sburst = eburst
-
-                            out_files[long_name] = out_acks1_dups_bursts[sburst-1:eburst]
-                            for tmp_f in out_acks1_dups_bursts[sburst-1:eburst] :
-                                out_groups[tmp_f] = group
-
+                        selected.append((long_name, out_acks1, dst))
                     if sfil.is_in(rev_name):
-                        if ts_correct == '1':
-                            out_acks2 = adjust_timestamps(test_id, out_acks2, src, ' ', out_dir)
-
-                        # do the dupACK calculations burst extraction here
-                        # return a new vector of one or more filenames, pointing to file(s) containing
-                        # <time> <seq_no> <dupACKs>
-                        #
-                        out_acks2_dups_bursts = extract_dupACKs_bursts(acks_file = out_acks2, 
-                                                          burst_sep = burst_sep)
-
-                        # Incorporate the extracted .N files
-                        # as a new, expanded set of filenames to be plotted.
-                        # Update the out_files dictionary (key=interim legend name based on flow, value=file)
-                        # and out_groups dictionary (key=file name, value=group)
-                        if burst_sep == 0.0:
-                            # Assume this is a single plot (not broken into bursts)
-                            # The plot_time_series() function expects key to have a single string
-                            # value rather than a vector. Take the first (and presumably only)
-                            # entry in the vector returned by extract_dupACKs_bursts()
-                            out_files[long_rev_name] = out_acks2_dups_bursts[0]
-                            out_groups[out_acks2_dups_bursts[0]] = group
-                        else:
-                            # This trial has been broken into bursts.
-                            # plot_incast_ACK_series() knows how to parse a key having a
-                            # 'vector of strings' value.
-                            # Also filter the selection based on sburst/eburst nominated by user
-                            if eburst == 0 :
-                                eburst = len(out_acks2_dups_bursts)
-                            # Catch case when eburst was set non-zero but also > number of actual bursts
-                            eburst = min(eburst,len(out_acks2_dups_bursts))
-                            if sburst <= 0 :
-                                sburst = 1
-                            # Catch case where sburst set greater than eburst
-                            if sburst > eburst :
-                                sburst = eburst
-
-                            out_files[long_rev_name] = out_acks2_dups_bursts[sburst-1:eburst]
-                            for tmp_f in out_acks2_dups_bursts[sburst-1:eburst] :
-                                out_groups[tmp_f] = group
+                        selected.append((long_rev_name, out_acks2, src))
+
+                    work.append((test_id, out_dir, replot_only, ts_correct,
+                                 burst_sep, out_dirname, dump1, dump2,
+                                 src_internal, src_port, dst_internal, dst_port,
+                                 out_acks1, out_acks2, selected))
+
+        _prepare_workers([test_id], out_dir, ts_correct, jobs)
+        for flow_files in map_jobs(_extract_ackseq_flow, work, jobs):
+            for long_name, dups_bursts in flow_files:
+                # Incorporate the extracted .N files
+                # as a new, expanded set of filenames to be plotted.
+                # Update the out_files dictionary (key=interim legend name based on flow, value=file)
+                # and out_groups dictionary (key=file name, value=group)
+                if burst_sep == 0.0:
+                    # Assume this is a single plot (not broken into bursts)
+                    # The plot_time_series() function expects key to have a single string
+                    # value rather than a vector. Take the first (and presumably only)
+                    # entry in the vector returned by extract_dupACKs_bursts()
+                    out_files[long_name] = dups_bursts[0]
+                    out_groups[dups_bursts[0]] = group
+                else:
+                    # This trial has been broken into one or more bursts.
+                    # plot_incast_ACK_series() knows how to parse a key having a
+                    # 'vector of strings' value.
+                    # Also filter the selection based on sburst/eburst nominated by user
+                    if eburst == 0 :
+                        eburst = len(dups_bursts)
+                    # Catch case when eburst was set non-zero but also > number of actual bursts
+                    eburst = min(eburst,len(dups_bursts))
+                    if sburst <= 0 :
+                        sburst = 1
+                    # Catch case where sburst set greater than eburst
+                    if sburst > eburst :
+                        sburst = eburst
+
+                    out_files[long_name] = dups_bursts[sburst-1:eburst]
+                    for tmp_f in dups_bursts[sburst-1:eburst] :
+                        out_groups[tmp_f] = group
 
         # if desired compute aggregate acked bytes for each experiment
         # XXX only do this for burst_sep=0 now
@@ -2785,11 +3445,11 @@ def _extract_ackseq(test_id='', out_dir='', replot_only='0', source_filter='',
 @task
 def extract_ackseq(test_id='', out_dir='', replot_only='0', source_filter='',
                     ts_correct='1', burst_sep='0.0',
-                    sburst='1', eburst='0', total_per_experiment='0'):
+                    sburst='1', eburst='0', total_per_experiment='0', jobs='1'):
     "Extract cumulative bytes ACKnowledged vs time / extract incast bursts"
 
     _extract_ackseq(test_id, out_dir, replot_only, source_filter, ts_correct,
-                    burst_sep, sburst, eburst, total_per_experiment)
+                    burst_sep, sburst, eburst, total_per_experiment, jobs)
 
     # done
     puts('\n[MAIN] COMPLETED extracting ackseq %s \n' % test_id)
@@ -2829,6 +3489,8 @@ def extract_ackseq(test_id='', out_dir='', replot_only='0', source_filter='',
 #                  '1' to plot cumulative dupACKs vs time
 #   @param plot_params Parameters passed to plot function via environment variables
 #   @param plot_script Specify the script used for plotting, must specify full path
+#   @param jobs Number of worker processes used for capture passes and flows
+#               ('0' means number of CPUs, '1' means no worker processes)
 #
 # Intermediate files end in ".acks", ".acks.N", ".acks.tscorr" or ".acks.tscorr.N"
 # Output pdf files end in:
@@ -2843,13 +3505,13 @@ def analyse_ackseq(test_id='', out_dir='', replot_only='0', source_filter='',
                        stime='0.0', etime='0.0', out_name='',
                        pdf_dir='', ts_correct='1', burst_sep='0.0',
                        sburst='1', eburst='0', dupacks='0',
-                       plot_params='', plot_script=''):
+                       plot_params='', plot_script='', jobs='1'):
     "Plot cumulative bytes ACKnowledged vs time / extract incast bursts"
 
     (test_id_arr,
      out_files,
      out_groups) =  _extract_ackseq(test_id, out_dir, replot_only, source_filter, 
-                    ts_correct, burst_sep, sburst, eburst)
+                    ts_correct, burst_sep, sburst, eburst, jobs=jobs)
    
     (out_files, out_groups) = filter_min_values(out_files, out_groups, min_values)
     out_name = get_out_name(test_id_arr, out_name)
@@ -2915,18 +3577,21 @@ def analyse_ackseq(test_id='', out_dir='', replot_only='0', source_filter='',
 #   @param plot_script Specify the script used for plotting, must specify full path
 #   @param total_per_experiment '0' plot per-flow goodput (default)
 #                               '1' plot total goodput
+#   @param jobs Number of worker processes used for capture passes and flows
+#               ('0' means number of CPUs, '1' means no worker processes)
 @task
 def analyse_goodput(test_id='', out_dir='', replot_only='0', source_filter='',
                        min_values='3', omit_const='0', ymin='0', ymax='0', lnames='',
                        stime='0.0', etime='0.0', out_name='',
                        pdf_dir='', ts_correct='1', 
-                       plot_params='', plot_script='', total_per_experiment='0'):
+                       plot_params='', plot_script='', total_per_experiment='0',
+                       jobs='1'):
     "Plot goodput vs time"
 
     (test_id_arr,
      out_files,
      out_groups) =  _extract_ackseq(test_id, out_dir, replot_only, source_filter,
-                    ts_correct, 0, 0, 0, total_per_experiment)
+                    ts_correct, 0, 0, 0, total_per_experiment, jobs)
 
     (out_files, out_groups) = filter_min_values(out_files, out_groups, min_values)
     out_name = get_out_name(test_id_arr, out_name)
@@ -3025,37 +3690,36 @@ def _extract_incast_iqtimes(test_id='', out_dir='', replot_only='0', source_filt
                 # ignore all dump files not taken at query host
                 continue
 
-            # tcpdump filters and output file names
-            # 'tcp[tcpflags] & tcp-push != 0' rule to extract only packets with push flag set (eliminate SYN, FIN, or ACKs
-            # without data)
-            filter1 = 'tcp[tcpflags] & tcp-push != 0'
-
             (dummy, query_host_internal) = get_address_pair_analysis(test_id, query_host, do_abort='0') 
             flow_name = query_host_internal + '_0_0.0.0.0_0'
             name = test_id + '_' + flow_name 
             out1 = out_dirname + name + ofile_ext
 
             if name not in already_done:
-                if replot_only == '0' or not (os.path.isfile(out1)):
+                params = {'sink': HttpGetSink.name}
+                if must_derive(replot_only, [out1], 'iqtimes', [tcpdump_file],
+                               params):
 
-                    # Use "-A" option to tcpdump so we get the payload bytes and can check for GET 
-                    # XXX this command fails if default snap length is changed because of the magic -B 4
-                    local(
-                       'zcat %s | tcpdump -A -tt -nr - "%s" | grep -B 5 "GET" | egrep "IP" | '
-                       'awk \'{ print $1 " " $5; }\' | sed \'s/\.\([0-9]*\):/ \\1/\'  > %s' %
-                       (tcpdump_file, filter1, out1))
+                    # GETs are found in the capture pass from the payload
+                    # prefix of packets with push flag set
+                    write_http_gets(tcpdump_file, out_dirname, out1,
+                                    replot_only)
+                    record_derived([out1], 'iqtimes', [tcpdump_file],
+                                   params)
 
                 already_done[name] = 1
 
                 if sfil.is_in(flow_name):
-                    if ts_correct == '1':
+                    if ts_correct != '0':
                         out1 = adjust_timestamps(test_id, out1, query_host, ' ', out_dir)
 
                     if by_responder == '0':
                         # all responders in in one output file
                         out_name = out1 + '.all'
 
-                        if replot_only == '0' or not (os.path.isfile(out_name)):
+                        params = {'burst_sep': burst_sep, 'cumulative': cumulative}
+                        if must_derive(replot_only, [out_name], 'iqtimes_all',
+                                       [out1], params):
                             last_time = 0.0
                             burst_start = 0.0
                             cum_time = 0.0 
@@ -3063,14 +3727,13 @@ def _extract_incast_iqtimes(test_id='', out_dir='', replot_only='0', source_filt
                             out_f = open(out_name, 'w')
 
                             with open(out1) as f:
-                                lines = f.readlines()
-                                for line in lines:
+                                for line in f:
                                     fields = line.split()
                                     time = float(fields[0])
 
                                     if burst_start == 0.0:
                                         burst_start = time
-                                    if line != lines[:-1] and last_time != 0.0 and time - last_time >= burst_sep:
+                                    if last_time != 0.0 and time - last_time >= burst_sep:
                                         cum_time += (last_time - burst_start)
                                         burst_start = time
                                         last_req_time = time
@@ -3088,6 +3751,9 @@ def _extract_incast_iqtimes(test_id='', out_dir='', replot_only='0', source_filt
 
                             out_f.close()
 
+                            record_derived([out_name], 'iqtimes_all', [out1],
+                                           params)
+
                         out_files[name] = out_name
                         out_groups[out_name] = group
 
@@ -3099,9 +3765,8 @@ def _extract_incast_iqtimes(test_id='', out_dir='', replot_only='0', source_filt
                         responders = {}
                         cum_time = {} 
 
-		        with open(out1) as f:
-                            lines = f.readlines()
-                            for line in lines:
+                        with open(out1) as f:
+                            for line in f:
                                 fields = line.split()
                                 time = float(fields[0])
                                 responder = fields[1] + '.' + fields[2]
@@ -3115,7 +3780,7 @@ def _extract_incast_iqtimes(test_id='', out_dir='', replot_only='0', source_filt
 
                                 if burst_start == 0.0:
                                     burst_start = time
-                                if line != lines[:-1] and last_time != 0.0 and time - last_time >= burst_sep:
+                                if last_time != 0.0 and time - last_time >= burst_sep:
                                     #cum_time[responder] += (last_time - burst_start)
                                     burst_start = time
                                     last_req_time = time
@@ -3317,20 +3982,15 @@ def _extract_incast_restimes(test_id='', out_dir='', replot_only='0', source_fil
                 continue
 
             # unique flows
-            flows = lookup_flow_cache(tcpdump_file)
-            if flows == None:
-                flows = _list(local('zcat %s | tcpdump -nr - "tcp" | '
-                                'awk \'{ if ( $2 == "IP" ) { print $3 " " $5 " tcp" } }\' | '
-                                'sed "s/://" | '
-                                'sed "s/\.\([0-9]*\) /,\\1 /g" | sed "s/ /,/g" | '
-                                'LC_ALL=C sort -u' %
-                                tcpdump_file, capture=True))
-
-                append_flow_cache(tcpdump_file, flows)
+            flows = get_flows(tcpdump_file, 'tcp')
 
             # since client sends first packet to server, client-to-server flows
             # will always be first
 
+            # connections from the querier to each responder, GETs are
+            # numbered across all connections to a responder
+            conns = []
+            responder_conns = {}
             for flow in flows:
 
                 src, src_port, dst, dst_port, proto = flow.split(',')
@@ -3346,6 +4006,13 @@ def _extract_incast_restimes(test_id='', out_dir='', replot_only='0', source_fil
                 if dst == query_host:
                     continue
 
+                conns.append((src, src_internal, src_port, dst, dst_internal,
+                              dst_port))
+                responder_conns.setdefault((dst_internal, dst_port), []).append(
+                    (src_internal, src_port))
+
+            for src, src_internal, src_port, dst, dst_internal, dst_port in conns:
+
                 # flow name
                 name = src_internal + '_' + src_port + \
                     '_' + dst_internal + '_' + dst_port
@@ -3358,57 +4025,36 @@ def _extract_incast_restimes(test_id='', out_dir='', replot_only='0', source_fil
                 # the two dump files
                 dump1 = dir_name + '/' + test_id + '_' + src + ifile_ext
 
-                # tcpdump filters and output file names
-                # 'tcp[tcpflags] & tcp-push != 0' rule to extract only packets with push flag set 
-                # (eliminate SYN, FIN, or ACKs without data)
-                filter1 = 'host ' + dst_internal + ' && port ' + dst_port + \
-                    ' && tcp[tcpflags] & tcp-push != 0'
-
-                out1_tmp = out_dirname + test_id + '_' + name + ofile_ext + '.tmp'
                 out1 = out_dirname + test_id + '_' + name + ofile_ext
-                
-                if long_name not in already_done:
-                    if replot_only == '0' or not ( os.path.isfile(out1) ):
- 
-                        # Use "-A" option to tcpdump so we get the payload bytes 
-                        # XXX this falls apart if snap size is not the default because of the magic -B 8
-                        local(
-                            'zcat %s | tcpdump -A -tt -nr - "%s" | grep -B 10 "GET" | egrep "IP" | '
-                            'awk \'{ print $1 " " $3 " " $5; }\' | sed \'s/://\' > %s' %
-                            (dump1, filter1, out1_tmp))
-                        # get the last line, assume this is last packet of last request
-                        local('zcat %s | tcpdump -tt -nr - "%s" | tail -1 | '
-                              'awk \'{ print $1 " " $3 " " $5; }\' | sed \'s/://\' >> %s' % 
-                            (dump1, filter1, out1_tmp))
-
-                        # compute response times from each GET packet and corresponding final data packet
-                        out_f = open(out1, 'w')
-                        with open(out1_tmp) as f:
-                            lines = f.readlines()
-                            cnt = 0
-                            last_src = ''
-                            for line in lines:
-                                fields = line.split()
-                                if cnt % 2 == 0:
-                                    # request
-			            req_time = float(line.split()[0])
-                                elif fields[1] != last_src:
-                                    # response, unless the source is the same as for the last packet
-                                    # (then we possibly have no response)
-                                    res_time = float(fields[0]) - req_time
-                                    out_f.write('%f %i %s %s %s\n' %  (req_time, int(cnt/2) + 1, fields[2], 
-                                                                       fields[1], res_time))
-
-                                last_src = fields[1] 
-                                cnt += 1
 
-                        out_f.close()
-                        os.remove(out1_tmp)
+                if long_name not in already_done:
+                    params = {'sink': HttpGetSink.name,
+                              'numbering': 'responder'}
+                    if must_derive(replot_only, [out1], 'restimes', [dump1],
+                                   params):
+
+                        # compute response times from each GET packet and the
+                        # last data packet of the response on the same
+                        # connection (from the capture pass)
+                        spool_files = []
+                        for q, q_port in responder_conns[(dst_internal,
+                                                          dst_port)]:
+                            spool_files.append(
+                                (get_spool_file(dump1, out_dirname,
+                                                HttpGetSink.name, q, q_port,
+                                                dst_internal, dst_port, 'tcp',
+                                                replot_only),
+                                 q + '.' + q_port))
+                        write_restimes(spool_files,
+                                       dst_internal + '.' + dst_port, out1)
+
+                        record_derived([out1], 'restimes', [dump1],
+                                       params)
 
                     already_done[long_name] = 1
 
                     if sfil.is_in(name):
-                        if ts_correct == '1':
+                        if ts_correct != '0':
                             out1 = adjust_timestamps(test_id, out1, dst, ' ', out_dir)
 
                         out_files[long_name] = out1 
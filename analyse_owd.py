@@ -37,11 +37,9 @@ import datetime
 import re
 import imp
 
-import dpkt     # For direct pcap file parsing
-import zlib     # For calculating crc32 hash
-
-
 import tempfile
+import shutil
+from collections import deque
 
 from fabric.api import task, warn, put, puts, get, local, run, execute, \
     settings, abort, hosts, env, runs_once, parallel, hide
@@ -50,7 +48,9 @@ import config
 from internalutil import _list
 from clockoffset import adjust_timestamps
 from filefinder import get_testid_file_list
-from flowcache import append_flow_cache, lookup_flow_cache
+from flowindex import get_flows
+from capturepass import run_capture_pass, get_spool_file, OwdSink
+from derivedcache import must_derive, record_derived
 from sourcefilter import SourceFilter
 from analyseutil import get_out_dir, get_out_name, filter_min_values, \
     select_bursts, get_address_pair_analysis
@@ -257,7 +257,112 @@ def analyse_pktloss(test_id='', out_dir='', replot_only='0', source_filter='',
     puts('\n[MAIN] COMPLETED plotting pktloss %s \n' % out_name)
 
 
-## Extract OWD or LOSS for flows using DPKT/TCPDUMP
+## Window of packets seen at the destination. Keeps the packets with index
+## in [next_j, next_j + sk_window] and a hash table that maps packet hashes to
+## the indices (and time stamps) of the packets in the window with that hash
+class _DstWindow(object):
+
+    ## Open destination file
+    #  @param fname File with <time> <hash> lines
+    def __init__(self, fname):
+        self.f = open(fname, 'r')
+        self.rows = deque()
+        self.positions = {}
+        self.loaded = 0
+        self.eof = False
+
+    ## Read packets until we have packets with indices up to upto - 1 (or
+    ## end of file)
+    #  @param upto Index of first packet not needed
+    def fill(self, upto):
+        while self.loaded < upto and not self.eof:
+            line = self.f.readline()
+            if line == '':
+                self.eof = True
+                self.f.close()
+                break
+
+            sline = line.rstrip('\n').split(' ')
+            self.rows.append((self.loaded, sline[1]))
+            p = self.positions.get(sline[1])
+            if p is None:
+                p = self.positions[sline[1]] = deque()
+            p.append((self.loaded, float(sline[0])))
+            self.loaded += 1
+
+    ## Remove all packets with index smaller than lo
+    #  @param lo Index of first packet to keep
+    def evict(self, lo):
+        while len(self.rows) > 0 and self.rows[0][0] < lo:
+            idx, key = self.rows.popleft()
+            p = self.positions[key]
+            p.popleft()
+            if len(p) == 0:
+                del self.positions[key]
+
+    ## Find first packet with hash key and index smaller than hi
+    #  @param key Hash
+    #  @param hi Upper bound (exclusive) for index
+    #  @return (index, time) tuple or None
+    def find(self, key, hi):
+        p = self.positions.get(key)
+        if p is not None and p[0][0] < hi:
+            return p[0]
+
+        return None
+
+
+## Match packets seen at the source with packets seen at the destination.
+## For each source packet the first packet with the same hash in the
+## destination packets next_j...next_j + seek_window - 1 is the match, where
+## next_j is the index following the last match. Only seek_window + 1
+## destination packets are held in memory, and lookups use a hash table,
+## so the run time is linear in the number of packets
+#  @param src_fname File with <time> <hash> lines of packets seen at source
+#  @param dst_fname File with <time> <hash> lines of packets seen at destination
+#  @param seek_window Window size, if empty search the whole file
+#  @return Generator of (source time string, destination time) tuples,
+#          destination time is None if packet was lost
+def match_packets(src_fname, dst_fname, seek_window):
+
+    if seek_window != '':
+        sk_window = int(seek_window)
+    else:
+        # window is number of destination packets minus one (as before)
+        with open(dst_fname, 'r') as f:
+            sk_window = sum(1 for line in f) - 1
+
+    dst = _DstWindow(dst_fname)
+    next_j = 0
+
+    with open(src_fname, 'r') as f:
+        for line in f:
+            i = line.rstrip('\n').split(' ')
+
+            hi = next_j + sk_window
+            dst.fill(hi)
+            if dst.eof:
+                hi = min(hi, dst.loaded)
+
+            match = dst.find(i[1], hi)
+            if match is None:
+                yield (i[0], None)
+                continue
+
+            k, dst_time = match
+            yield (i[0], dst_time)
+
+            # continue with the packet after the match, unless the match
+            # was the last packet
+            dst.fill(k + 2)
+            if dst.eof and k + 1 >= dst.loaded:
+                next_j = k
+            else:
+                next_j = k + 1
+            dst.evict(next_j)
+
+
+## Extract OWD or LOSS for flows from the capture pass spool files
 # The extracted files have an extension of .owds or .loss
 #
 # For OWD the output file format is space-separated <timestamp> <OWD> pairs:
@@ -357,26 +462,10 @@ def _extract_owd_pktloss(test_id='', out_dir='', replot_only='0', source_filter=
             out_dirname = get_out_dir(tcpdump_file, out_dir) 
             dir_name = os.path.dirname(tcpdump_file)
             
-            # get unique flows
-            flows = lookup_flow_cache(tcpdump_file)
-            if flows == None:
-                # If not previously found in flow_cache,
-                # extract and identify the tcp and udp flows contained in tcpdump_file
-                flows = _list(local('zcat %s | tcpdump -nr - "tcp" | '
-                                'awk \'{ if ( $2 == "IP" ) { print $3 " " $5 " tcp" } }\' | '
-                                'sed "s/://" | '
-                                'sed "s/\.\([0-9]*\) /,\\1 /g" | sed "s/ /,/g" | '
-                                'LC_ALL=C sort -u' %
-                                tcpdump_file, capture=True))
-                flows += _list(local('zcat %s | tcpdump -nr - "udp" | '
-                                 'awk \'{ if ( $2 == "IP" ) { print $3 " " $5 " udp" } }\' | '
-                                 'sed "s/://" | '
-                                 'sed "s/\.\([0-9]*\) /,\\1 /g" | sed "s/ /,/g" | '
-                                 'LC_ALL=C sort -u' %
-                                 tcpdump_file, capture=True))
-
-                # Add them to the flow cache
-                append_flow_cache(tcpdump_file, flows)
+            # decode tcpdump file once for all metrics, then get unique flows
+            if replot_only == '0':
+                run_capture_pass(tcpdump_file, out_dirname)
+            flows = get_flows(tcpdump_file)
 
             # Walk through and process the flows identified in this current tcpdump_file
             
@@ -410,11 +499,16 @@ def _extract_owd_pktloss(test_id='', out_dir='', replot_only='0', source_filter=
 
                     # Construct filenames for files containing final <time> <owd|loss> pairs
                     out_final = out_dirname + test_id + '_' + name + ofile_ext
+                    dmp_files = [dir_name + '/' + test_id + '_' + host + ifile_ext
+                                 for host in (src_extname, dst_extname)]
+                    params = {'seek_window': seek_window, 'log_loss': log_loss,
+                              'anchor_map': anchor_map, 'owd_midpoint': owd_midpoint}
                     
                     # Only embark on actual filtering/extraction if we're asked to regenerate
                     # the intermediate OWD values, or for some reason the intermediate OWD
-                    # file is missing...
-                    if replot_only == '0' or not os.path.isfile(out_final):
+                    # file is missing or out of date...
+                    if must_derive(replot_only, [out_final], 'owd_pktloss', dmp_files,
+                                   params):
                                                 
                         # Per flow/host:
                         #   Create intermediate file of timestamps + uniqString from pcap files,
@@ -422,13 +516,9 @@ def _extract_owd_pktloss(test_id='', out_dir='', replot_only='0', source_filter=
                         #   relative to a single reference host in the testbed
                         #   THEN use the adjusted timestamps in the subsequent owd/loss calculations.
                         
-                        # To extract packets in in FORWARD direction from both src and dst pcap files,
-                        # construct dpkt flow filter in form <src_ip>:<src_port>:<dst_ip>:<dst_port>
-                        # (and more specifically, from src_internal:src_port to dst_internal:dst_port).
-
-                        filter_dpkt = src_internal + ':' + src_port + ':' + dst_internal + ':' + dst_port
-                        src_port_int = int(src_port)
-                        dst_port_int = int(dst_port)
+                        # Packets in FORWARD direction (from src_internal:src_port to
+                        # dst_internal:dst_port) from both src and dst pcap files, as
+                        # extracted by the capture pass
                         
                         # Loop across the src and dst dmp files
                         
@@ -445,65 +535,20 @@ def _extract_owd_pktloss(test_id='', out_dir='', replot_only='0', source_filter=
                             # whose timestamps will be adjusted by adjust_timestamps()
                             # before being used for owd calculations
                             # (NOTE: Due to adjust_timestamps making assumptions about out_dir parameter,
-                            # we currently can't place these tmp files under /tmp)
-                            tmp_fwd_out = tempfile.mktemp(suffix=test_id + '_' + name +'_fwd_out_' + dirsuffix+".gz", dir=out_dirname)
+                            # we currently can't place these tmp files under /tmp or the spool directory)
+                            tmp_fwd_out = tempfile.mktemp(suffix=test_id + '_' + name +'_fwd_out_' + dirsuffix, dir=out_dirname)
                             
-                            # Extract packet id info
-                            if dmp_file.endswith('.gz'):
-                                f_dmp_file = gzip.open(dmp_file)
+                            # Get <timestamp> <crc32 hash of uniqueString bytes> from the capture
+                            # pass. uniqueString is IP ID, TCP sequence and ACK number for TCP, or
+                            # IP ID and payload for UDP (hashing eliminates any later problems
+                            # parsing payloads containing null bytes)
+                            spool_file = get_spool_file(dmp_file, out_dirname, OwdSink.name,
+                                                        src_internal, src_port, dst_internal,
+                                                        dst_port, proto, replot_only)
+                            if os.path.isfile(spool_file):
+                                shutil.copyfile(spool_file, tmp_fwd_out)
                             else:
-                                f_dmp_file = open(dmp_file)
-                            pcap_reader = dpkt.pcap.Reader(f_dmp_file)
-                            pcap_reader.setfilter(filter_dpkt)
-                            #pcap_reader.setfilter('')
-                            
-                            # Create a compressed temporary intermediate file
-                            f_tmp_fwd_out = gzip.open(tmp_fwd_out,'wb',1)
-                            
-                            # Walk across every packet in this pcap file
-                            for ts, pkt in pcap_reader:
-                                # get pointer to ethernet layer and check that we have IP
-                                eth = dpkt.ethernet.Ethernet(pkt)
-                                if eth.type != dpkt.ethernet.ETH_TYPE_IP:
-                                    continue
-
-                                # get pointer to IP layer
-                                ip_pkt = eth.data
-
-                                # ignore if src or dst IP not the ones specified in filter
-                                if socket.inet_ntoa(ip_pkt.src) != src_internal or \
-                                    socket.inet_ntoa(ip_pkt.dst) != dst_internal:
-                                        continue
-
-                                # ignore if UDP/TCP src or dst ports not the ones specified in filter
-                                # get pointer to payload
-                                if type(ip_pkt.data) == dpkt.udp.UDP:
-                                    udp_frame = ip_pkt.data
-                                    if udp_frame.sport != src_port_int or udp_frame.dport != dst_port_int:
-                                        continue
-                                    # Add IP ID field to the payload to ensure
-                                    # at least something semi-unique is hashed
-                                    # if UDP payload is invariant
-                                    payload = str(ip_pkt.id) +udp_frame.data
-                                    
-                                elif type(ip_pkt.data) == dpkt.tcp.TCP:
-                                    tcp_frame = ip_pkt.data
-                                    if tcp_frame.sport != src_port_int or tcp_frame.dport != dst_port_int:
-                                        continue
-                                    # Use IP ID field, TCP Sequence number and ACK number to
-                                    # construct a mostly unique string within context of this flow
-                                    payload = str(ip_pkt.id) + str(tcp_frame.seq) + str(tcp_frame.ack)
-                                else:
-                                    continue
-                                
-                                # Write <timestamp> <crc32 hash of uniqueString bytes>
-                                # (hashing here eliminates any later problems parsing payloads
-                                # containing null bytes)
-
-                                f_tmp_fwd_out.write("%f %s\n" % (ts,zlib.crc32(payload)))
-
-                            f_tmp_fwd_out.close()
-                            f_dmp_file.close()
+                                open(tmp_fwd_out, 'w').close()
                             
                             # Apply timestamp corrections to the data thus extracted, prior to
                             # calculating OWDs. Correction is MANDATORY otherwise the
@@ -518,38 +563,6 @@ def _extract_owd_pktloss(test_id='', out_dir='', replot_only='0', source_filter=
                         
                         # Begin calculating OWD or identifying when packet losses occurred
                         
-                        # Read into memory the <adjusted_timestamp> <uniqString> datasets captured
-                        # at dst (2nd place packet seen, "destination"). The src is (1st place packet
-                        # seen, "source")
-                        
-                        dst_data_time=list()
-                        dst_data_uniqString=list()
-                        for line in gzip.open(tmp_fwd_out_adj["dst"]).read().splitlines():
-                            sline = line.split(" ")
-                            dst_data_time.append(float(sline[0]))
-                            dst_data_uniqString.append(sline[1])
-
-                        # Walk through tmp_fwd_out_adj["src"] looking for matches to packets
-                        # in dst_data_uniqString, and write <time> <owd|loss> pairs in plain
-                        # ASCII to out_final
-                        
-                        # To limit potential duplicate matches to packets received forward
-                        # in time from previous match in dst_data_uniqString, maintain
-                        # index next_j pointing to next row in dst_data_uniqString to start
-                        # matching next packet from tmp_fwd_out_adj["src"]
-                        next_j = 0
-                        last_j = len(dst_data_uniqString)-1
-
-                        # As a speed-up hack, assume match in dst_data_uniqString is
-                        # within sk_window entries of next_j (saves searching all the
-                        # way to the end of dst_data_uniqString when seeking a lost packet)
-                        # Keeping seek_window in the low 1000s also minimises chances of
-                        # duplicate matches.
-                        if seek_window != '':
-                            sk_window = int(seek_window)
-                        else:
-                            sk_window = last_j
-                        
                         # Create gzipped output file (rough experiments showed over reduction
                         # in on-disk file size easily 100s of K down to 10s of K).
                         # R automagically reads gzipped data files, so no changes required
@@ -570,19 +583,20 @@ def _extract_owd_pktloss(test_id='', out_dir='', replot_only='0', source_filter=
                                     #print "*** " + src_internal + " points to " + anchor_map_list[src_internal] + " in anchor_map"
                                     anchor = 1 # Print timestamp at dst
                                         
-                        for line in gzip.open(tmp_fwd_out_adj["src"]).read().splitlines():
-                            i = line.split(" ")
-                            try:
-                                # The following search will raise a 'ValueError' exception if i[1] does not occur in dst_data_uniqString[next_j:]
-                                j = dst_data_uniqString[next_j:min((next_j+sk_window),last_j+1)].index(i[1])
-                                
+                        # Walk through tmp_fwd_out_adj["src"] looking for matches to packets
+                        # seen at dst (2nd place packet seen, "destination"), and write
+                        # <time> <owd|loss> pairs to out_final
+                        for src_time, dst_time in match_packets(tmp_fwd_out_adj["src"],
+                                                                tmp_fwd_out_adj["dst"],
+                                                                seek_window):
+                            if dst_time is not None:
                                 if log_loss == '0':
-                                    # OWD is diff between i[0] and dst_data_time[next_j+j]
-                                    ts = float(i[0])
-                                    owd = dst_data_time[next_j+j]-float(i[0])
+                                    # OWD is diff between src_time and dst_time
+                                    ts = float(src_time)
+                                    owd = dst_time - float(src_time)
                                     # If required, print event as occuring at dst timestamp rather than src timestamp
                                     if anchor:
-                                        ts = dst_data_time[next_j+j]
+                                        ts = dst_time
                                     # If we want to imply the OWD "existed" at some mid-point
                                     # between pkt seen at src and seen at dst
                                     if owd_midpoint == '1':
@@ -591,31 +605,28 @@ def _extract_owd_pktloss(test_id='', out_dir='', replot_only='0', source_filter=
                                     
                                 if log_loss == '1':
                                     # No lost packet, emit "0"
-                                    f.write('%s 0\n' % (i[0]))
+                                    f.write('%s 0\n' % (src_time))
                                 if log_loss == '2':
                                     # No lost packet, emit previous cumulative count
-                                    f.write('%s %i\n' % (i[0], cumulative_loss))
-                                    
-                                next_j = min(next_j+j+1,last_j)
+                                    f.write('%s %i\n' % (src_time, cumulative_loss))
                                 
-                            except ValueError:
+                            else:
                                 # No match means a packet loss
                                 if log_loss == '1':
                                     # Single loss event, emit "1"
-                                    f.write('%s 1\n' % (i[0]))
+                                    f.write('%s 1\n' % (src_time))
                                 if log_loss == '2':
                                     # Single loss event, increment cumulative count, emit cumulative count
                                     cumulative_loss += 1
-                                    f.write('%s %i\n' % (i[0], cumulative_loss))
-                                pass
+                                    f.write('%s %i\n' % (src_time, cumulative_loss))
                                                     
                         f.close()
-                        dst_data_time=[]
-                        dst_data_uniqString=[]
                         
                         # Clean up temporary post-adjustment files
                         os.remove(tmp_fwd_out_adj["src"])
                         os.remove(tmp_fwd_out_adj["dst"])
+
+                        record_derived([out_final], 'owd_pktloss', dmp_files, params)
                         
                     already_done[long_name] = 1
                     
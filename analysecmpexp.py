@@ -39,11 +39,11 @@ from fabric.api import task, warn, put, puts, get, local, run, execute, \
     settings, abort, hosts, env, runs_once, parallel, hide
 
 import config
-from internalutil import mkdir_p, valid_dir
-from clockoffset import DATA_CORRECTED_FILE_EXT
+from internalutil import mkdir_p, valid_dir, map_jobs
+from clockoffset import DATA_CORRECTED_FILE_EXT, TS_OFFSETS_FILE_EXT
 from filefinder import get_testid_file_list
 from sourcefilter import SourceFilter
-from analyseutil import merge_data_files
+from analyseutil import merge_data_files, enough_rows
 from analyse import _extract_rtt, _extract_cwnd, _extract_tcp_rtt, \
     _extract_dash_goodput, _extract_tcp_stat, _extract_incast, \
     _extract_pktsizes, _extract_incast_iqtimes, _extract_incast_restimes, \
@@ -94,6 +94,31 @@ def get_first_experiment_path(experiments):
     return dir_name
 
 
+## Get data files of experiment. For files with corrected timestamps this
+## includes virtually corrected files, which only have a clock offset file
+## (see clockoffset.adjust_timestamps)
+#  @param experiment Experiment ID
+#  @param ext File extension
+#  @param res_dir Directory with results
+#  @return Sorted list of file names
+def get_data_files(experiment, ext, res_dir):
+    files = get_testid_file_list('', experiment, ext, 'LC_ALL=C sort', res_dir,
+                                 no_abort=True)
+    if ext.endswith(DATA_CORRECTED_FILE_EXT):
+        offs_files = get_testid_file_list('', experiment,
+                                          ext + TS_OFFSETS_FILE_EXT,
+                                          'LC_ALL=C sort', res_dir,
+                                          no_abort=True)
+        files = sorted(set(files +
+                           [f[:-len(TS_OFFSETS_FILE_EXT)] for f in offs_files]))
+
+    if len(files) == 0:
+        abort('Cannot find any matching data files.\n'
+              'Remove outdated teacup_dir_cache.txt if files were moved.')
+
+    return files
+
+
 ## Build match string to match test IDs based on specified variables, and a second
 ## string to extract the test id prefix. does not require access to the config, 
 ## instead it tries to get the sames from the file name and some specified prefix
@@ -280,7 +305,7 @@ def get_metric_params(metric='', smoothed='0', ts_correct='1', stat_index='0', d
     else:
         return None
 
-    if ts_correct == '1' and metric != 'restime':
+    if ts_correct != '0' and metric != 'restime':
         ext += DATA_CORRECTED_FILE_EXT
 
     if metric == 'spprtt' or metric == 'ackseq':
@@ -342,6 +367,36 @@ def get_extract_function(metric='', link_len='0', stat_index='0', slowest_only='
     return (extract_functions[metric], extract_kwargs[metric])
 
 
+## Extract data of one experiment for one or more metrics. Called in worker
+## processes
+#  @param args Tuple of experiment ID, list of (metric, stat_index) tuples,
+#              map of parameters passed to get_extract_function and map of
+#              parameters passed to the extract functions
+def _extract_experiment(args):
+    experiment, metrics, metric_kwargs, ex_kwargs = args
+
+    for metric, stat_index in metrics:
+        (ex_function, kwargs) = get_extract_function(metric,
+                                stat_index=stat_index, **metric_kwargs)
+        kwargs.update(ex_kwargs)
+        ex_function(test_id=experiment, **kwargs)
+
+
+## Extract data of all experiments, using a pool of worker processes
+#  @param experiments List of experiment IDs
+#  @param metrics List of (metric, stat_index) tuples
+#  @param metric_kwargs Map of parameters passed to get_extract_function
+#  @param ex_kwargs Map of parameters passed to the extract functions
+#  @param jobs Number of worker processes ('0' means number of CPUs,
+#              '1' means no worker processes)
+def extract_experiments(experiments, metrics, metric_kwargs, ex_kwargs,
+                        jobs='1'):
+
+    map_jobs(_extract_experiment,
+             [(experiment, metrics, metric_kwargs, ex_kwargs)
+              for experiment in experiments], jobs)
+
+
 ####################################################################################
 # Analyse functions
 ####################################################################################
@@ -383,6 +438,8 @@ def get_extract_function(metric='', link_len='0', stat_index='0', slowest_only='
 #  @param ts_correct '0' use timestamps as they are (default)
 #                    '1' correct timestamps based on clock offsets estimated
 #                        from broadcast pings
+#                    '2' like '1', but clock offsets are only applied when
+#                        reading the data for plotting (no .tscorr files)
 #  @param smoothed '0' plot non-smooth RTT (enhanced RTT in case of FreeBSD),
 #                  '1' plot smoothed RTT estimates (non enhanced RTT in case of FreeBSD)
 #  @param link_len '0' throughput based on IP length (default),
@@ -414,6 +471,9 @@ def get_extract_function(metric='', link_len='0', stat_index='0', slowest_only='
 #                       '2' plot ratio of median/mean (as per ptype) and nominal response
 #                           time
 #  @param query_host Name of querier (only for iqtime metric)
+#  @param jobs Number of worker processes used for extracting the data of
+#              experiments ('0' means number of CPUs, '1' means no worker
+#              processes)
 @task
 def analyse_cmpexp(exp_list='experiments_completed.txt', res_dir='', out_dir='',
                    source_filter='', min_values='3', omit_const='0', metric='throughput',
@@ -424,7 +484,7 @@ def analyse_cmpexp(exp_list='experiments_completed.txt', res_dir='', out_dir='',
                    dupacks='0', cum_ackseq='1', merge_data='0', sburst='1',
                    #eburst='0', test_id_prefix='[0-9]{8}\-[0-9]{6}_experiment_',
                    eburst='0', test_id_prefix='exp_[0-9]{8}\-[0-9]{6}_',
-                   slowest_only='0', res_time_mode='0', query_host=''):
+                   slowest_only='0', res_time_mode='0', query_host='', jobs='1'):
     "Compare metrics for different experiments"
 
     if ptype != 'box' and ptype != 'mean' and ptype != 'median':
@@ -459,18 +519,14 @@ def analyse_cmpexp(exp_list='experiments_completed.txt', res_dir='', out_dir='',
 
     # if we haven' got the extracted data run extract method(s) first
     if res_dir == '':
-        for experiment in experiments:
-
-            (ex_function, kwargs) = get_extract_function(metric, link_len,
-                                    stat_index, sburst=sburst, eburst=eburst,
-                                    slowest_only=slowest_only, query_host=query_host)
-
-            (dummy, out_files, out_groups) = ex_function(
-                test_id=experiment, out_dir=out_dir,
-                source_filter=source_filter,
-                replot_only=replot_only,
-                ts_correct=ts_correct,
-                **kwargs)
+        extract_experiments(experiments, [(metric, stat_index)],
+                            dict(link_len=link_len, sburst=sburst,
+                                 eburst=eburst, slowest_only=slowest_only,
+                                 query_host=query_host),
+                            dict(out_dir=out_dir, source_filter=source_filter,
+                                 replot_only=replot_only,
+                                 ts_correct=ts_correct),
+                            jobs)
 
         if out_dir == '' or out_dir[0] != '/':
             res_dir = dir_name + '/' + out_dir
@@ -545,9 +601,7 @@ def analyse_cmpexp(exp_list='experiments_completed.txt', res_dir='', out_dir='',
         out_files = {}
         _ext = ext
 
-        files = get_testid_file_list('', experiment,
-                                      '%s' % _ext,
-                                      'LC_ALL=C sort', res_dir)
+        files = get_data_files(experiment, _ext, res_dir)
         if merge_data == '1':
             # change extension
             _ext += '.all'
@@ -561,10 +615,7 @@ def analyse_cmpexp(exp_list='experiments_completed.txt', res_dir='', out_dir='',
             #print(res.group(1))
             if res and sfil.is_in(res.group(1)):
                 # only add file if enough data points
-                rows = int(
-                    local('wc -l %s | awk \'{ print $1 }\'' %
-                          f, capture=True))
-                if rows > int(min_values):
+                if enough_rows(f, min_values):
                     out_files[res.group(1)] = f
 
         #print(out_files)
@@ -710,6 +761,8 @@ def analyse_cmpexp(exp_list='experiments_completed.txt', res_dir='', out_dir='',
 #  @param ts_correct '0' use timestamps as they are (default)
 #                    '1' correct timestamps based on clock offsets estimated
 #                        from broadcast pings
+#                    '2' like '1', but clock offsets are only applied when
+#                        reading the data for plotting (no .tscorr files)
 #  @param smoothed '0' plot non-smooth RTT (enhanced RTT in case of FreeBSD),
 #                  '1' plot smoothed RTT estimates (non enhanced RTT in case of FreeBSD)
 #  @param link_len '0' throughput based on IP length (default),
@@ -734,6 +787,9 @@ def analyse_cmpexp(exp_list='experiments_completed.txt', res_dir='', out_dir='',
 #  @param slowest_only '0' plot all response times (metric restime)
 #                      '1' plot only the slowest response times for each burst
 #  @param query_host Name of querier (only for iqtime metric)
+#  @param jobs Number of worker processes used for extracting the data of
+#              experiments ('0' means number of CPUs, '1' means no worker
+#              processes)
 # NOTE: that xmin, xmax, ymin and ymax don't just zoom, but govern the selection of data points
 #       used for the density estimation. this is how ggplot2 works by default, although possibly
 #       can be changed
@@ -747,7 +803,7 @@ def analyse_2d_density(exp_list='experiments_completed.txt', res_dir='', out_dir
                    dupacks='0', cum_ackseq='1', merge_data='0',
                    #sburst='1', eburst='0', test_id_prefix='[0-9]{8}\-[0-9]{6}_experiment_',
                    sburst='1', eburst='0', test_id_prefix='exp_[0-9]{8}\-[0-9]{6}_',
-                   slowest_only='0', query_host=''):
+                   slowest_only='0', query_host='', jobs='1'):
     "2d density / ellipse plot for different experiments"
 
     test_id_pfx = ''
@@ -781,29 +837,15 @@ def analyse_2d_density(exp_list='experiments_completed.txt', res_dir='', out_dir
 
     # if we haven' got the extracted data run extract method(s) first
     if res_dir == '':
-        for experiment in experiments:
-
-            (ex_function, kwargs) = get_extract_function(xmetric, link_len,
-                                    xstat_index, sburst=sburst, eburst=eburst,
-                                    slowest_only=slowest_only, query_host=query_host)
-
-            (dummy, out_files, out_groups) = ex_function(
-                test_id=experiment, out_dir=out_dir,
-                source_filter=source_filter,
-                replot_only=replot_only,
-                ts_correct=ts_correct,
-                **kwargs)
-
-            (ex_function, kwargs) = get_extract_function(ymetric, link_len,
-                                    ystat_index, sburst=sburst, eburst=eburst,
-                                    slowest_only=slowest_only, query_host=query_host)
-
-            (dummy, out_files, out_groups) = ex_function(
-                test_id=experiment, out_dir=out_dir,
-                source_filter=source_filter,
-                replot_only=replot_only,
-                ts_correct=ts_correct,
-                **kwargs)
+        extract_experiments(experiments,
+                            [(xmetric, xstat_index), (ymetric, ystat_index)],
+                            dict(link_len=link_len, sburst=sburst,
+                                 eburst=eburst, slowest_only=slowest_only,
+                                 query_host=query_host),
+                            dict(out_dir=out_dir, source_filter=source_filter,
+                                 replot_only=replot_only,
+                                 ts_correct=ts_correct),
+                            jobs)
 
         if out_dir == '' or out_dir[0] != '/':
             res_dir = dir_name + '/' + out_dir
@@ -911,15 +953,13 @@ def analyse_2d_density(exp_list='experiments_completed.txt', res_dir='', out_dir
         _x_ext = x_ext
         _y_ext = y_ext
 
-        _files = get_testid_file_list('', experiment, _x_ext,
-                                      'LC_ALL=C sort', res_dir)
+        _files = get_data_files(experiment, _x_ext, res_dir)
         if merge_data == '1':
             _x_ext += '.all'
             _files = merge_data_files(_files)
         _x_files += _files
 
-        _files = get_testid_file_list('', experiment, _y_ext,
-                                      'LC_ALL=C sort', res_dir)
+        _files = get_data_files(experiment, _y_ext, res_dir)
         if merge_data == '1':
             _y_ext += '.all'
             _files = merge_data_files(_files)
@@ -932,10 +972,7 @@ def analyse_2d_density(exp_list='experiments_completed.txt', res_dir='', out_dir
             #print(res.group(1))
             if res and sfil.is_in(res.group(1)):
                 # only add file if enough data points
-                rows = int(
-                    local('wc -l %s | awk \'{ print $1 }\'' %
-                          f, capture=True))
-                if rows > int(min_values):
+                if enough_rows(f, min_values):
                     x_files.append(f)
 
         match_str = '.*_([0-9\.]*_[0-9]*_[0-9\.]*_[0-9]*)[0-9a-z_.]*' + _y_ext
@@ -944,10 +981,7 @@ def analyse_2d_density(exp_list='experiments_completed.txt', res_dir='', out_dir
             res = re.search(match_str, f)
             if res and sfil.is_in(res.group(1)):
                 # only add file if enough data points
-                rows = int(
-                    local('wc -l %s | awk \'{ print $1 }\'' %
-                          f, capture=True))
-                if rows > int(min_values):
+                if enough_rows(f, min_values):
                     y_files.append(f)
 
     yindexes = [str(x_axis_params[2]), str(y_axis_params[2])]
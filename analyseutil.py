@@ -36,6 +36,8 @@ import time
 import datetime
 import re
 import imp
+import glob
+import heapq
 import tempfile
 from fabric.api import task, warn, put, puts, get, local, run, execute, \
     settings, abort, env, runs_once, parallel, hide
@@ -44,10 +46,20 @@ import config
 from internalutil import mkdir_p
 from hostint import get_address_pair
 from filefinder import get_testid_file_list
+from tpconfcache import get_tpconf_vars
+from clockoffset import get_data_file, materialise_timestamps, is_virtual, \
+    read_timestamp_lines, TS_OFFSETS_FILE_EXT
 
 import gzip
 
 
+## File extension of burst index files
+BURST_INDEX_FILE_EXT = '.bursts'
+## Maximum number of files merged at once by merge_sorted_files (limits
+## the number of open files)
+MERGE_MAX_FILES = 256
+
+
 ## Figure out directory for output files and create if it doesn't exist
 ## If out_dir is a relative path, the actual out_dir will be the directory where
 ## the file fname is concatenated with out_dir. If out_dir is an absolute path
@@ -95,10 +107,13 @@ def enough_rows(fname='', min_values='3'):
 
     min_values = int(min_values)
 
+    if is_virtual_burst(fname):
+        return get_burst(fname)[2] > min_values
+
     #rows = int(local('wc -l %s | awk \'{ print $1 }\'' %
     #               fname, capture=True))
     rows = 0
-    with open(fname, 'r') as f:
+    with open(get_data_file(fname), 'r') as f:
         while f.readline():
             rows += 1
             if rows > min_values:
@@ -142,139 +157,266 @@ def filter_min_values(files={}, groups={}, min_values='3'):
 
 
 
-## Extract data per incast burst
+## Split data file name into name of data file and burst number
+#  @param fname Name of burst file (<data file>.<burst number>)
+#  @return Tuple of data file name and burst number, or None if the name
+#          does not end with a burst number
+def _split_burst_name(fname):
+    res = re.match('(.*)\.([0-9]+)$', fname)
+    if res is None:
+        return None
+
+    return (res.group(1), int(res.group(2)))
+
+
+## Check if burst file is virtual, i.e. the file does not exist but the
+## data file it belongs to has a burst index (see extract_bursts)
+#  @param fname Name of burst file
+#  @return True if burst file is virtual, False otherwise
+def is_virtual_burst(fname):
+    if os.path.isfile(fname):
+        return False
+
+    res = _split_burst_name(fname)
+
+    return res is not None and \
+        os.path.isfile(res[0] + BURST_INDEX_FILE_EXT)
+
+
+## Read burst index
+#  @param index_file Name of burst index file
+#  @return Tuple of header (map of keys to values) and list of bursts
+#          (tuples of burst number, number of first line, number of lines
+#          and value the data is normalised on)
+def _read_burst_index(index_file):
+
+    header = {}
+    bursts = []
+    with open(index_file) as f:
+        for line in f:
+            if line.startswith('#'):
+                key, val = line[1:].strip().split(' ', 1)
+                header[key] = val
+            else:
+                fields = line.split()
+                bursts.append((int(fields[0]), int(fields[1]),
+                               int(fields[2]), fields[3]))
+
+    return (header, bursts)
+
+
+## Get burst of virtual burst file
+#  @param fname Name of burst file
+#  @return Tuple of data file name, number of first line, number of lines
+#          and value the data is normalised on
+def get_burst(fname):
+
+    data_file, burst_no = _split_burst_name(fname)
+    try:
+        bursts = _read_burst_index(data_file + BURST_INDEX_FILE_EXT)[1]
+    except IOError:
+        abort('Cannot open file %s' % data_file + BURST_INDEX_FILE_EXT)
+
+    for burst, start, lines, base in bursts:
+        if burst == burst_no:
+            return (data_file, start, lines, base)
+
+    abort('Burst %i not in burst index of %s' % (burst_no, data_file))
+
+
+## Read data of burst file. For virtual burst files the lines of the burst
+## are read from the data file and normalised on the fly
+#  @param fname Name of burst file
+#  @return Generator of lines (<time> <data>)
+def read_burst(fname):
+
+    if not is_virtual_burst(fname):
+        with open(fname) as f:
+            for line in f:
+                yield line
+        return
+
+    for line in _read_burst_lines(*get_burst(fname)):
+        yield line
+
+
+## Read lines of burst from data file and normalise them. The timestamps of
+## virtually corrected data files are corrected on the fly.
+#  @param data_file Data file name
+#  @param start Number of first line of burst
+#  @param lines Number of lines of burst
+#  @param base Value the data is normalised on
+#  @return Generator of lines (<time> <data>)
+def _read_burst_lines(data_file, start, lines, base):
+
+    f = read_timestamp_lines(data_file, start, start + lines)
+    try:
+        for line in f:
+            fields = line.split()
+            yield fields[0] + ' ' + str(float(fields[1]) - float(base)) + '\n'
+    finally:
+        f.close()
+
+
+## Find bursts in data file
 #  @param data_file File with data
 #  @param burst_sep Time between bursts (0.0 means no burst separation)
-#  @param normalize 0: leave metric values as they are (default)
-#                  1: normalise metric values on first value or first value
-#                     fo each burst (if burst_sep > 0.0)        
-#  @return List of file names (one file per burst)
-def extract_bursts(data_file='', burst_sep=0.0, normalize=0):
+#  @param normalize 0: leave metric values as they are
+#                   1: normalise metric values on first value or first value
+#                      of each burst (if burst_sep > 0.0)
+#  @return List of bursts (tuples of burst number, number of first line,
+#          number of lines and value the data is normalised on)
+def _find_bursts(data_file, burst_sep, normalize):
 
-    # New filenames (source file + ".0" or ".1,.2,....N" for bursts)
-    new_fnames = []
+    bursts = []
 
     # Internal variables
-    burstN = 1
+    if burst_sep != 0:
+        burstN = 1
+    else:
+        burstN = 0
     firstTS = -1
     prev_data = -1
+    first_line = 0
+    line_no = 0
 
-    if burst_sep == 0.0 and normalize == 0:
-        new_fnames.append(data_file)
-        return new_fnames
+    f = read_timestamp_lines(data_file)
 
     try:
-            lines = []
-            # First read the entire contents of a data file, using
-            # gzip.open() if the extract_* task has generated .gz
-            # intermediate files.
-            if data_file.endswith(".gz"):
-                gzip_output = 1
-                with gzip.open(data_file) as f:
-                    lines = f.readlines()
-            else:
-                gzip_output = 0
-                with open(data_file) as f:
-                    lines = f.readlines()
+        # Now walk through every line of the data file
+        for oneline in f:
+            # fields[0] is the timestamp, fields[1] is the statistic
+            fields = oneline.split()
+
+            if firstTS == -1 :
+                # This is first time through the loop, so set some baseline
+                # values for later offsets
+                firstTS = fields[0]
+                prevTS = firstTS
+                if normalize == 1:
+                    first_data = fields[1]
+                else:
+                    first_data = '0.0'
+
+            # If burst_sep == 0 the only thing we're calculating is a
+            # cumulative running total, so we only do burst
+            # identification if burst_sep != 0
 
-            # Create the first .N output file
             if burst_sep != 0 :
-                out_fname = data_file + "." + "1"
-            else:
-                out_fname = data_file + "." + "0"
-                
-            if gzip_output:
-                # Don't append .gz as the R script's burst handling
-                # currently relies on the trailing ".N". Note that
-                # R subsequentely auto-detects gzip'd file contents
-                # without relying on .gz suffix.
-                out_f = gzip.open(out_fname, "w")
-            else:
-                out_f = open(out_fname, "w")
-                
-            new_fnames.append(out_fname)
-
-            # Now walk through every line of the data file
-            for oneline in lines:
-                # fields[0] is the timestamp, fields[1] is the statistic 
-                fields = oneline.split()
-
-                if firstTS == -1 :
-                    # This is first time through the loop, so set some baseline
-                    # values for later offsets
+
+                if burst_sep < 0 :
+                    # gap is time since first statistic of this burst
+                    # (i.e. relative to firstTS)
+                    gap = float(fields[0]) - float(firstTS)
+                else:
+                    gap = float(fields[0]) - float(prevTS)
+
+                # New burst begins when time between this statistic and previous
+                # exceeds abs(burst_sep)
+                if (gap >= abs(burst_sep)) :
+                    # We've found the first one of the _next_ burst
+                    bursts.append((burstN, first_line, line_no - first_line,
+                                   first_data))
+
+                    # Move on to the next burst
+                    burstN += 1
+
+                    print ("Burst: %3i, ends at %f sec, data: %f bytes, gap: %3.6f sec" %
+                    ( (burstN - 1),  float(prevTS), float(prev_data) - float(first_data), gap ) )
+
+                    # Reset firstTS to the beginning (first timestamp) of this new burst
                     firstTS = fields[0]
-                    prevTS = firstTS
+
+                    # first data value of next burst must be considered relative to the last
+                    # data value of the previous burst if we normalize
                     if normalize == 1:
-                        first_data = fields[1]
-                    else:
-                        first_data = '0.0'
-
-                # If burst_sep == 0 the only thing we're calculating is a
-                # cumulative running total, so we only do burst
-                # identification if burst_sep != 0
-
-                if burst_sep != 0 :
-
-                    if burst_sep < 0 :
-                        # gap is time since first statistic of this burst
-                        # (i.e. relative to firstTS)
-                        gap = float(fields[0]) - float(firstTS)
-                    else:
-                        gap = float(fields[0]) - float(prevTS)
-
-                    # New burst begins when time between this statistic and previous
-                    # exceeds abs(burst_sep)
-                    if (gap >= abs(burst_sep)) :
-                        # We've found the first one of the _next_ burst
-
-                        # Close previous burst output file
-                        out_f.close()
-
-                        # Move on to the next burst
-                        burstN += 1
-
-                        print ("Burst: %3i, ends at %f sec, data: %f bytes, gap: %3.6f sec" %
-                        ( (burstN - 1),  float(prevTS), float(prev_data) - float(first_data), gap ) )
-
-                        # Reset firstTS to the beginning (first timestamp) of this new burst
-                        firstTS = fields[0]
-
-                        # first data value of next burst must be considered relative to the last 
-                        # data value of the previous burst if we normalize 
-                        if normalize == 1:
-                            first_data = prev_data
-
-                        # Create the next .N output file
-                        out_fname = data_file + "." + str(burstN)
-                        if gzip_output:
-                            # Don't append .gz as the R script's burst handling
-                            # currently relies on the trailing ".N". Note that
-                            # R subsequentely auto-detects gzip'd file contents
-                            # without relying on .gz suffix.
-                            out_f = gzip.open(out_fname, "w")
-                        else:
-                            out_f = open(out_fname, "w")
-                            
-                        new_fnames.append(out_fname)
-                        
-                # data value (potentially normalised based on first value / first value of burst
-                data_gap = float(fields[1]) - float(first_data)
-
-                # Write to burst-specific output file
-                # <time>  <data>
-                out_f.write(fields[0] + " " + str(data_gap) + "\n")
-
-                # Store the seq number for next time around the loop
-                prev_data = fields[1]
-                prevTS = fields[0]
-
-            # Close the last output file
-            out_f.close()
+                        first_data = prev_data
 
-    except IOError:
+                    first_line = line_no
+
+            # Store the seq number for next time around the loop
+            prev_data = fields[1]
+            prevTS = fields[0]
+            line_no += 1
+
+    finally:
+        f.close()
+
+    if firstTS == -1:
+        # empty data file
+        first_data = '0.0'
+
+    # the last burst
+    bursts.append((burstN, first_line, line_no - first_line, first_data))
+
+    return bursts
+
+
+## Extract data per incast burst. The bursts are not written to separate
+## files. Instead we write a small index <data_file>.bursts with the lines
+## and normalisation value of each burst, and return the names of virtual
+## burst files <data_file>.<burst number>. The plot functions read the
+## bursts through the index (see read_data_file() in plot_func.R), Python
+## code uses read_burst(). Virtually corrected data files (see
+## adjust_timestamps) stay virtual, the timestamps are corrected when the
+## bursts are read. The index is only rebuilt if the data file, the clock
+## offsets, burst_sep or normalize changed.
+#  @param data_file File with data
+#  @param burst_sep Time between bursts (0.0 means no burst separation)
+#  @param normalize 0: leave metric values as they are (default)
+#                  1: normalise metric values on first value or first value
+#                     fo each burst (if burst_sep > 0.0)        
+#  @return List of file names (one file per burst)
+def extract_bursts(data_file='', burst_sep=0.0, normalize=0):
+
+    if burst_sep == 0.0 and normalize == 0:
+        return [data_file]
+
+    index_file = data_file + BURST_INDEX_FILE_EXT
+
+    try:
+        st = os.stat(get_data_file(data_file))
+        if is_virtual(data_file):
+            offsets = repr(os.stat(data_file + TS_OFFSETS_FILE_EXT).st_mtime)
+        else:
+            offsets = '-'
+        header = {
+            'data': data_file,
+            'size': str(st.st_size),
+            'mtime': repr(st.st_mtime),
+            'offsets': offsets,
+            'burst_sep': repr(float(burst_sep)),
+            'normalize': str(normalize),
+            }
+
+        bursts = None
+        if os.path.isfile(index_file):
+            (old_header, old_bursts) = _read_burst_index(index_file)
+            if old_header == header:
+                bursts = old_bursts
+
+        if bursts is None:
+            bursts = _find_bursts(data_file, burst_sep, normalize)
+
+            # remove burst files written by older versions, they would
+            # hide the virtual burst files
+            for fname in glob.glob(data_file + '.*'):
+                res = _split_burst_name(fname)
+                if res is not None and res[0] == data_file:
+                    os.remove(fname)
+
+            with open(index_file, 'w') as f:
+                for key in ('data', 'size', 'mtime', 'offsets', 'burst_sep',
+                            'normalize'):
+                    f.write('# %s %s\n' % (key, header[key]))
+                for burst in bursts:
+                    f.write('%i %i %i %s\n' % burst)
+
+    except (IOError, OSError):
         print('extract_bursts(): File access problem while working on %s' % data_file)
+        return []
 
-    return new_fnames
+    return ['%s.%i' % (data_file, burst[0]) for burst in bursts]
 
 
 ## Select bursts to plot and add files to out_files and out_groups 
@@ -332,7 +474,107 @@ def select_bursts(name='', group='', data_file='', burst_sep='0.0', sburst='1',
     return (out_files, out_groups)
 
 
-## Merge several data files into one data file 
+## Read lines of data file sorted by timestamp
+#  @param fname Data file name
+#  @param unsorted List the file name is appended to if the lines are not
+#                  sorted by timestamp
+#  @return Generator of tuples of timestamp and line
+def _read_sorted_lines(fname, unsorted):
+
+    if fname.endswith('.gz'):
+        f = gzip.open(fname)
+    else:
+        f = open(fname)
+
+    try:
+        prev_time = None
+        for line in f:
+            field = re.match('[^\s,]*', line).group(0)
+            if field == '':
+                continue
+
+            curr_time = float(field)
+            if prev_time is not None and curr_time < prev_time and \
+               fname not in unsorted:
+                unsorted.append(fname)
+            prev_time = curr_time
+
+            if line[-1] != '\n':
+                line += '\n'
+
+            yield (curr_time, line)
+    finally:
+        f.close()
+
+
+## Merge data files with a k-way merge
+#  @param in_files List of file names
+#  @param out_name Name of merged file
+#  @return List of input files that were not sorted by timestamp
+def _merge_files(in_files, out_name):
+
+    unsorted = []
+    with open(out_name, 'w') as f_out:
+        for curr_time, line in heapq.merge(*[_read_sorted_lines(fname, unsorted)
+                                             for fname in in_files]):
+            f_out.write(line)
+
+    return unsorted
+
+
+## Merge data files that are sorted by timestamp (first column) into one
+## file sorted by timestamp (same as cat <files> | sort -k 1,1 with numeric
+## timestamps). Since each data file is already sorted, a k-way merge is
+## used that only holds one line per data file in memory. At most
+## MERGE_MAX_FILES files are merged at once, larger sets of files are merged
+## in groups into temporary files first. Data files that turn out not to be
+## sorted (e.g. because of timestamp correction) are sorted in memory and
+## the merge is repeated.
+#  @param in_files List of file names
+#  @param out_name Name of merged file
+def merge_sorted_files(in_files, out_name):
+
+    tmp_files = []
+    try:
+        while len(in_files) > MERGE_MAX_FILES:
+            next_files = []
+            for i in range(0, len(in_files), MERGE_MAX_FILES):
+                (fd, tmp_name) = tempfile.mkstemp(
+                    dir=os.path.dirname(os.path.abspath(out_name)),
+                    prefix='.merge_')
+                os.close(fd)
+                tmp_files.append(tmp_name)
+                merge_sorted_files(in_files[i:i + MERGE_MAX_FILES], tmp_name)
+                next_files.append(tmp_name)
+            in_files = next_files
+
+        unsorted = _merge_files(in_files, out_name)
+        if len(unsorted) > 0:
+            sorted_files = []
+            for fname in in_files:
+                if fname in unsorted:
+                    (fd, tmp_name) = tempfile.mkstemp(
+                        dir=os.path.dirname(os.path.abspath(out_name)),
+                        prefix='.merge_')
+                    os.close(fd)
+                    tmp_files.append(tmp_name)
+                    lines = sorted(_read_sorted_lines(fname, []))
+                    with open(tmp_name, 'w') as f:
+                        f.writelines(line for curr_time, line in lines)
+                    lines = None
+                    fname = tmp_name
+                sorted_files.append(fname)
+
+            _merge_files(sorted_files, out_name)
+    finally:
+        for tmp_name in tmp_files:
+            try:
+                os.remove(tmp_name)
+            except OSError:
+                pass
+
+
+## Merge several data files into one data file sorted by timestamp
 #  @param in_files List of file names
 #  @return List with merged file name 
 def merge_data_files(in_files):
@@ -344,14 +586,8 @@ def merge_data_files(in_files):
     merge_fname += '.all'
     #print(merge_fname)
 
-    f_out = open(merge_fname, 'w')
-
-    for fname in sorted(in_files):
-        with open(fname) as f:
-            lines = f.readlines()
-        f_out.writelines(lines)
-
-    f_out.close()
+    merge_sorted_files([materialise_timestamps(fname)
+                        for fname in sorted(in_files)], merge_fname)
 
     return [merge_fname]
 
@@ -398,16 +634,13 @@ def get_address_pair_analysis(test_id, host, do_abort='1'):
     global host_list_cache
     internal = ''
     external = ''
-    TMP_CONF_FILE = tempfile.mktemp(suffix='_oldconfig.py', dir='/tmp/')
-
-    # XXX the whole old config access should be moved into separate module as 
-    # similar code is also in clockoffset
 
     # prior to TEACUP version 0.9 it was required to run the analysis with a config
     # file that had config.TPCONF_host_internal_ip as it was used to run the experiment
     # (or a superset of it). Since version 0.9 we use config.TPCONF_host_internal_ip
     # (as well as config.TPCONF_hosts and config.TPCONF_router) from the file 
-    # <test_id_prefix>_tpconf_vars.log.gz in the test experiment directory.
+    # <test_id_prefix>_tpconf_vars.log.gz in the test experiment directory
+    # (parsed once and cached, see tpconfcache).
 
     if test_id not in host_internal_ip_cache:
         # first find the directory but looking for mandatory uname file
@@ -422,32 +655,16 @@ def get_address_pair_analysis(test_id, host, do_abort='1'):
                 host_list_cache[test_id] = host_list_cache[dir_name]
         else:
             # try to find old config information
+            tpconf_vars = get_tpconf_vars(dir_name)
 
-            # look for tpconf_vars.log.gz file in that directory 
-            var_file = local('find -L %s -name "*tpconf_vars.log.gz"' % dir_name,
-                             capture=True)
-
-            if len(var_file) > 0:
+            if tpconf_vars is not None:
                 # new approach without using config.py
 
-                # unzip archived file
-                local('gzip -cd %s > %s' % (var_file, TMP_CONF_FILE))
-
-                # load the TPCONF_variables into oldconfig
-                oldconfig = imp.load_source('oldconfig', TMP_CONF_FILE)
-
-                # remove temporary unzipped file 
-                try:
-                    os.remove(TMP_CONF_FILE)
-                    os.remove(TMP_CONF_FILE + 'c') # remove the compiled file as well
-                except OSError:
-                    pass
-
                 # store data in cache (both under test id and directory name)
-                host_internal_ip_cache[test_id] = oldconfig.TPCONF_host_internal_ip
-                host_list_cache[test_id] = oldconfig.TPCONF_hosts + oldconfig.TPCONF_router
-                host_internal_ip_cache[dir_name] = oldconfig.TPCONF_host_internal_ip
-                host_list_cache[dir_name] = oldconfig.TPCONF_hosts + oldconfig.TPCONF_router
+                host_internal_ip_cache[test_id] = tpconf_vars['TPCONF_host_internal_ip']
+                host_list_cache[test_id] = tpconf_vars['TPCONF_hosts'] + tpconf_vars['TPCONF_router']
+                host_internal_ip_cache[dir_name] = tpconf_vars['TPCONF_host_internal_ip']
+                host_list_cache[dir_name] = tpconf_vars['TPCONF_hosts'] + tpconf_vars['TPCONF_router']
             else:
                 # old approach using the functions in hostint.py that access config.py
                 # store empty value in cache (both under test id and directory name)
@@ -47,6 +47,8 @@ os.chdir(CWD)
 sys.path.append(TEACUP_DIR)
 from analysecmpexp import get_extract_function, read_experiment_ids
 from analyse import _extract_tcp_stat
+from clockoffset import is_virtual, read_ts_offsets, correct_times
+from analyseutil import is_virtual_burst, read_burst
 
 def init_log():
     """
@@ -972,6 +974,25 @@ def read_raw_file(filename):
     column relative to the first entry
     """
     LOG.info('Reading "%s"…', filename)
+    if is_virtual_burst(filename):
+        # read burst through burst index of data file
+        data = np.loadtxt(read_burst(filename), ndmin=2)
+        if len(data) > 0:
+            LOG.info('File contains %s records', len(data))
+            return data
+        return None
+
+    if is_virtual(filename):
+        # apply clock offsets while reading
+        data_file, sep, ref_times, offsets, drifts = read_ts_offsets(filename)
+        data = np.loadtxt(data_file, delimiter=sep, ndmin=2)
+        if len(data) > 0:
+            data[:, 0] = np.round(correct_times(ref_times, offsets,
+                                                data[:, 0], drifts), 6)
+            LOG.info('File contains %s records', len(data))
+            return data
+        return None
+
     with open(filename, 'r') as raw_file:
         try:
             data = np.loadtxt(raw_file, delimiter=',')
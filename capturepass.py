@@ -0,0 +1,522 @@
+# Copyright (c) 2013-2018 Centre for Advanced Internet Architectures,
+# Swinburne University of Technology. All rights reserved.
+#
+# Author: Sebastian Zander (sebastian.zander@gmx.de)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+## @package capturepass
+# Decode each tcpdump file once and fan out the packets to per-metric sinks.
+# Each sink writes per-flow spool files that the extract functions read
+# instead of running zcat | tcpdump per flow and direction.
+#
+# The spool files of <test_id>_<host>.dmp.gz are in the directory
+# <out_dir>/<test_id>_<host>.cpass/. Per flow (and direction) each sink
+# writes a file <src>_<src_port>_<dst>_<dst_port>_<proto>.<sink extension>.
+#
+# $Id$
+
+import os
+import zlib
+import heapq
+import struct
+from fabric.api import puts
+
+from internalutil import lock_dir, map_jobs, DemuxWriter, RUN_ID
+from pcapreader import read_packets, read_header, TH_ACK, TH_PUSH
+from flowindex import flow_index, flow_key, get_flows, FlowStats
+from derivedcache import must_derive, record_derived
+
+
+## Spool directory extension
+SPOOL_DIR_EXT = '.cpass'
+## Name of file marking a complete spool directory
+SPOOL_DONE_FILE = 'DONE'
+
+## Spool directories of capture files processed in this run. Index is
+## (tcpdump file name, output directory), value is the spool directory
+capture_passes = {}
+
+
+## Base class of capture pass sinks. A sink gets every TCP and UDP packet
+## of a capture together with the flow the packet belongs to
+class CaptureSink(object):
+
+    ## Sink name, also used as spool file extension
+    name = ''
+    ## If True sink needs transport payload
+    want_payload = False
+    ## If True sink needs raw pcap records
+    want_record = False
+
+    ## Start sink
+    #  @param tcpdump_file tcpdump file name
+    #  @param spool_dir Spool directory
+    #  @param writer DemuxWriter shared by all sinks
+    def start(self, tcpdump_file, spool_dir, writer):
+        self.tcpdump_file = tcpdump_file
+        self.spool_dir = spool_dir
+        self.writer = writer
+
+    ## Get spool file name for flow
+    #  @param flow Flow name <src>_<src_port>_<dst>_<dst_port>_<proto>
+    #  @return Spool file name
+    def spool_file(self, flow):
+        return self.spool_dir + flow + '.' + self.name
+
+    ## Process packet
+    #  @param pkt Packet (see pcapreader)
+    #  @param flow Flow name
+    def packet(self, pkt, flow):
+        pass
+
+    ## Called after last packet
+    def finish(self):
+        pass
+
+
+## Flow index sink. Stores per-flow statistics in flowindex.flow_index, so
+## we do not need a separate pass to discover flows
+class FlowIndexSink(CaptureSink):
+
+    name = 'flows'
+
+    def start(self, tcpdump_file, spool_dir, writer):
+        CaptureSink.start(self, tcpdump_file, spool_dir, writer)
+        self.stats = {}
+        self.keys = {}
+
+    def packet(self, pkt, flow):
+        key = self.keys.get(flow)
+        if key is None:
+            key = self.keys[flow] = flow_key(pkt)
+            self.stats[key] = FlowStats(pkt.ts_sec + pkt.ts_usec / 1E6)
+
+        s = self.stats[key]
+        s.packets += 1
+        s.bytes += pkt.ip_len
+        s.last_ts = pkt.ts_sec + pkt.ts_usec / 1E6
+
+    def finish(self):
+        flow_index[self.tcpdump_file] = self.stats
+
+
+## Packet size sink. Writes <time> <IP length> <link length>, link length
+## is '-' for non-Ethernet frames
+class PktSizeSink(CaptureSink):
+
+    name = 'psize'
+
+    def packet(self, pkt, flow):
+        if pkt.link_len is None:
+            link_len = '-'
+        else:
+            link_len = str(pkt.link_len)
+        self.writer.write(self.spool_file(flow), '%u.%06u %i %s\n' %
+                          (pkt.ts_sec, pkt.ts_usec, pkt.ip_len, link_len))
+
+
+## ACK sequence sink. Writes <time> <ack> for TCP packets that only have the
+## ACK flag set (same as tcpdump filter 'tcp[tcpflags] == tcp-ack')
+class AckSeqSink(CaptureSink):
+
+    name = 'ackno'
+
+    def packet(self, pkt, flow):
+        if pkt.flags == TH_ACK:
+            self.writer.write(self.spool_file(flow), '%u.%06u %u\n' %
+                              (pkt.ts_sec, pkt.ts_usec, pkt.ack))
+
+
+## Packet sink for SPP. Writes the raw pcap records, so we can construct the
+## filtered tcpdump files SPP needs without reading the capture again
+class PcapSink(CaptureSink):
+
+    name = 'pcap.gz'
+    want_record = True
+
+    def start(self, tcpdump_file, spool_dir, writer):
+        CaptureSink.start(self, tcpdump_file, spool_dir, writer)
+        self.header = read_header(tcpdump_file)
+        self.compressed = DemuxWriter(compress=True)
+
+    def packet(self, pkt, flow):
+        fname = self.spool_file(flow)
+        self.compressed.set_header(fname, self.header)
+        self.compressed.write(fname, pkt.record)
+
+    def finish(self):
+        self.compressed.close()
+
+
+## OWD sink. Writes <time> <crc32 hash> where the hash is computed over IP
+## ID, TCP sequence and acknowledgement numbers (TCP) or IP ID and payload
+## (UDP)
+class OwdSink(CaptureSink):
+
+    name = 'owdid'
+    want_payload = True
+
+    def packet(self, pkt, flow):
+        if pkt.proto == 'tcp':
+            payload = str(pkt.ip_id) + str(pkt.seq) + str(pkt.ack)
+        else:
+            # add IP ID field to the payload to ensure at least something
+            # semi-unique is hashed if UDP payload is invariant
+            payload = str(pkt.ip_id) + pkt.payload
+        self.writer.write(self.spool_file(flow), '%f %s\n' %
+                          (pkt.ts_sec + pkt.ts_usec / 1E6, zlib.crc32(payload)))
+
+
+## HTTP GET sink for incast experiments. For each GET sent on a TCP
+## connection writes <GET time> <response end time> to the spool file of the
+## flow the GET was sent on. The response end time is the time of the last
+## data packet sent back on the connection before the next GET (or the end of
+## the capture), or '-' if there was no response. Only packets with the push
+## flag set are considered (eliminate SYN, FIN, or ACKs without data) and a
+## GET is detected from the payload prefix, so only the first bytes of the
+## payload need to be captured
+class HttpGetSink(CaptureSink):
+
+    name = 'httpget'
+    want_payload = True
+
+    def start(self, tcpdump_file, spool_dir, writer):
+        CaptureSink.start(self, tcpdump_file, spool_dir, writer)
+        # pending GET of each connection, index is (src, sport, dst, dport)
+        # of the GET, value is [spool file, GET time, response end time]
+        self.pending = {}
+
+    def _flush(self, req):
+        self.writer.write(req[0], '%s %s\n' % (req[1], req[2]))
+
+    def packet(self, pkt, flow):
+        if pkt.proto != 'tcp' or not pkt.flags & TH_PUSH:
+            return
+
+        if pkt.payload.startswith('GET '):
+            conn = (pkt.src, pkt.sport, pkt.dst, pkt.dport)
+            req = self.pending.get(conn)
+            if req is not None:
+                self._flush(req)
+            self.pending[conn] = [self.spool_file(flow),
+                                  '%u.%06u' % (pkt.ts_sec, pkt.ts_usec), '-']
+        else:
+            req = self.pending.get((pkt.dst, pkt.dport, pkt.src, pkt.sport))
+            if req is not None:
+                req[2] = '%u.%06u' % (pkt.ts_sec, pkt.ts_usec)
+
+    def finish(self):
+        for req in self.pending.values():
+            self._flush(req)
+
+
+## Sinks used for every capture pass
+def get_sinks():
+    return [FlowIndexSink(), PktSizeSink(), AckSeqSink(), PcapSink(),
+            OwdSink(), HttpGetSink()]
+
+
+## Get spool directory name
+#  @param tcpdump_file tcpdump file name
+#  @param out_dirname Output directory
+#  @return Spool directory name
+def get_spool_dir(tcpdump_file, out_dirname):
+    base = os.path.basename(tcpdump_file)
+    if base.endswith('.dmp.gz'):
+        base = base[:-len('.dmp.gz')]
+
+    return out_dirname + base + SPOOL_DIR_EXT + '/'
+
+
+## Check if spool directory is complete and was created in this run,
+## possibly by another worker process
+#  @param spool_dir Spool directory name
+#  @return True if done in this run, False otherwise
+def _done_in_run(spool_dir):
+
+    try:
+        with open(spool_dir + SPOOL_DONE_FILE, 'r') as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return False
+
+    return len(lines) > 1 and lines[1] == RUN_ID
+
+
+## Run capture pass over tcpdump file unless already done in this run.
+## If replot_only is '1' a complete spool directory from an earlier run is
+## reused if it was created from the same tcpdump file (see derivedcache).
+## The spool directory is locked, so worker processes analysing the same
+## experiment do not run the same capture pass concurrently
+#  @param tcpdump_file tcpdump file name
+#  @param out_dirname Output directory
+#  @param replot_only '1' means reuse existing spool directory
+#  @return Spool directory name
+def run_capture_pass(tcpdump_file, out_dirname, replot_only='0'):
+
+    key = (tcpdump_file, out_dirname)
+    if key in capture_passes:
+        return capture_passes[key]
+
+    spool_dir = get_spool_dir(tcpdump_file, out_dirname)
+    lock = lock_dir(spool_dir)
+    try:
+        _run_capture_pass(tcpdump_file, spool_dir, replot_only)
+    finally:
+        os.close(lock)
+
+    capture_passes[key] = spool_dir
+
+    return spool_dir
+
+
+## Run capture pass in worker process
+#  @param args Tuple of tcpdump file name and output directory
+def _capture_pass_job(args):
+    run_capture_pass(args[0], args[1])
+
+
+## Run capture passes over several tcpdump files (unless already done in
+## this run) using a pool of worker processes
+#  @param work List of tuples of tcpdump file name and output directory
+#  @param jobs Number of worker processes ('0' means number of CPUs)
+def run_capture_passes(work, jobs='0'):
+
+    map_jobs(_capture_pass_job, work, jobs)
+
+    # spool directories are complete now, remember them in this process
+    for tcpdump_file, out_dirname in work:
+        run_capture_pass(tcpdump_file, out_dirname)
+
+
+## Run capture pass over tcpdump file unless spool directory is up to date.
+## Caller must hold the lock of the spool directory
+#  @param tcpdump_file tcpdump file name
+#  @param spool_dir Spool directory name
+#  @param replot_only '1' means reuse existing spool directory
+def _run_capture_pass(tcpdump_file, spool_dir, replot_only):
+
+    sinks = get_sinks()
+    params = {'sinks': ' '.join(s.name for s in sinks)}
+    if _done_in_run(spool_dir) or \
+       (not must_derive(replot_only, [spool_dir], 'capturepass',
+                        [tcpdump_file], params) and \
+        os.path.isfile(spool_dir + SPOOL_DONE_FILE)):
+        return
+
+    for fname in os.listdir(spool_dir):
+        os.remove(spool_dir + fname)
+
+    puts('Processing %s' % tcpdump_file)
+
+    writer = DemuxWriter()
+    for sink in sinks:
+        sink.start(tcpdump_file, spool_dir, writer)
+
+    want_payload = any(s.want_payload for s in sinks)
+    want_record = any(s.want_record for s in sinks)
+    names = {}
+    for pkt in read_packets(tcpdump_file, want_payload, want_record):
+        t = (pkt.src, pkt.sport, pkt.dst, pkt.dport, pkt.proto)
+        flow = names.get(t)
+        if flow is None:
+            flow = names[t] = '%s_%i_%s_%i_%s' % t
+        for sink in sinks:
+            sink.packet(pkt, flow)
+
+    for sink in sinks:
+        sink.finish()
+    writer.close()
+
+    with open(spool_dir + SPOOL_DONE_FILE, 'w') as f:
+        f.write(params['sinks'] + '\n')
+        f.write(RUN_ID + '\n')
+
+    record_derived([spool_dir], 'capturepass', [tcpdump_file], params)
+
+
+## Get spool file of flow, running the capture pass if necessary. The file
+## does not exist if the flow has no packets for the sink
+#  @param tcpdump_file tcpdump file name
+#  @param out_dirname Output directory
+#  @param sink_name Sink name
+#  @param src Source IP
+#  @param src_port Source port
+#  @param dst Destination IP
+#  @param dst_port Destination port
+#  @param proto Protocol ('tcp' or 'udp')
+#  @param replot_only '1' means reuse existing spool directory
+#  @return Spool file name
+def get_spool_file(tcpdump_file, out_dirname, sink_name, src, src_port, dst,
+                   dst_port, proto, replot_only='0'):
+
+    spool_dir = run_capture_pass(tcpdump_file, out_dirname, replot_only)
+
+    return spool_dir + '%s_%s_%s_%s_%s.%s' % (src, src_port, dst, dst_port,
+                                              proto, sink_name)
+
+
+## Read spool file lines split into fields. A missing spool file is
+## treated like an empty file
+#  @param fname Spool file name
+#  @return Generator of lists of fields
+def read_spool_file(fname):
+    if not os.path.isfile(fname):
+        return
+
+    with open(fname, 'r') as f:
+        for line in f:
+            yield line.split()
+
+
+## Write filtered tcpdump file from the pcap spool files, with the packets
+## of all flows merged in time order. The filter is a list of
+## (host, port, direction) tuples, where direction is 'src' or 'dst'. A flow
+## is selected if it matches any of the tuples, so [(A, p, 'src'),
+## (A, p, 'dst')] is equivalent to the tcpdump filter
+## '(src host A && src port p) || (dst host A && dst port p)'
+#  @param tcpdump_file tcpdump file name
+#  @param out_dirname Output directory
+#  @param filt Filter
+#  @param out_file Name of filtered tcpdump file
+#  @param replot_only '1' means reuse existing spool directory
+def write_filtered_pcap(tcpdump_file, out_dirname, filt, out_file,
+                        replot_only='0'):
+
+    run_capture_pass(tcpdump_file, out_dirname, replot_only)
+
+    header = read_header(tcpdump_file)
+    if header[:4] in ('\xd4\xc3\xb2\xa1', '\x4d\x3c\xb2\xa1'):
+        ts_hdr = struct.Struct('<II')
+    else:
+        ts_hdr = struct.Struct('>II')
+
+    def records(fname):
+        for pkt in read_packets(fname, want_record=True):
+            yield (ts_hdr.unpack_from(pkt.record), pkt.record)
+
+    streams = []
+    for flow in get_flows(tcpdump_file):
+        src, src_port, dst, dst_port, proto = flow.split(',')
+        if (src, src_port, 'src') not in filt and \
+           (dst, dst_port, 'dst') not in filt:
+            continue
+
+        fname = get_spool_file(tcpdump_file, out_dirname, PcapSink.name, src,
+                               src_port, dst, dst_port, proto, replot_only)
+        if os.path.isfile(fname):
+            streams.append(records(fname))
+
+    with open(out_file, 'wb') as f:
+        f.write(header)
+        for ts, record in heapq.merge(*streams):
+            f.write(record)
+
+
+## Write packet size file from packet size spool file
+#  @param spool_file Spool file name
+#  @param link_len '0' means IP length, '1' means link layer (Ethernet) length
+#  @param out_file Output file name
+def write_pktsizes(spool_file, link_len, out_file):
+    with open(out_file, 'w') as f:
+        for fields in read_spool_file(spool_file):
+            if link_len == '0':
+                f.write('%s %s\n' % (fields[0], fields[1]))
+            elif fields[2] != '-':
+                f.write('%s %s\n' % (fields[0], fields[2]))
+
+
+## Write ACK sequence file from ACK spool file. ACK numbers are relative to
+## the first ACK number
+#  @param spool_file Spool file name
+#  @param out_file Output file name
+def write_ackseq(spool_file, out_file):
+    base_ack = None
+    with open(out_file, 'w') as f:
+        for fields in read_spool_file(spool_file):
+            if base_ack is None:
+                base_ack = int(fields[1])
+            f.write('%s %i\n' % (fields[0], int(fields[1]) - base_ack))
+
+
+## Read GET times of GET spool file. The file is read completely, so that
+## merging the GETs of many flows does not keep a spool file open per flow
+## (there is only one line per GET)
+#  @param fname Spool file name
+#  @param dst Destination IP of the flow
+#  @param dst_port Destination port of the flow
+#  @return List of (time, time string, dst, dst_port) tuples
+def _read_http_gets(fname, dst, dst_port):
+    return [(float(fields[0]), fields[0], dst, dst_port)
+            for fields in read_spool_file(fname)]
+
+
+## Write GET times of all TCP flows in tcpdump file ordered by time. Writes
+## <time> <destination IP> <destination port>
+#  @param tcpdump_file tcpdump file name
+#  @param out_dirname Output directory
+#  @param out_file Output file name
+#  @param replot_only '1' means reuse existing spool directory
+def write_http_gets(tcpdump_file, out_dirname, out_file, replot_only='0'):
+
+    run_capture_pass(tcpdump_file, out_dirname, replot_only)
+
+    gets = []
+    for flow in get_flows(tcpdump_file, 'tcp'):
+        src, src_port, dst, dst_port, proto = flow.split(',')
+        fname = get_spool_file(tcpdump_file, out_dirname, HttpGetSink.name,
+                               src, src_port, dst, dst_port, proto,
+                               replot_only)
+        gets.append(_read_http_gets(fname, dst, dst_port))
+
+    with open(out_file, 'w') as f:
+        for t, ts, dst, dst_port in heapq.merge(*gets):
+            f.write('%s %s %s\n' % (ts, dst, dst_port))
+
+
+## Write response times file from GET spool files of all connections from
+## the querier to a responder. Writes <GET time> <GET number>
+## <querier IP.port> <responder IP.port> <response time> for each GET that
+## got a response. GETs are numbered in time order across all connections to
+## the responder, so the GET number identifies the burst even if the querier
+## opens new connections
+#  @param spool_files List of (spool file name, querier IP.port) tuples, one
+#                     for each connection to the responder
+#  @param responder Responder IP.port
+#  @param out_file Output file name
+def write_restimes(spool_files, responder, out_file):
+    gets = []
+    for spool_file, querier in spool_files:
+        for fields in read_spool_file(spool_file):
+            gets.append((float(fields[0]), fields[1], querier))
+    gets.sort()
+
+    with open(out_file, 'w') as f:
+        cnt = 0
+        for req_time, res_end, querier in gets:
+            cnt += 1
+            if res_end == '-':
+                continue
+            res_time = float(res_end) - req_time
+            f.write('%f %i %s %s %s\n' % (req_time, cnt, querier, responder,
+                                           res_time))
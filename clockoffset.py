@@ -40,20 +40,31 @@
 # $Id$
 
 import os
+import re
 import socket
 import csv
 import tempfile
 import imp
+import bisect
+import itertools
 from subprocess import *
 import tempfile
 from fabric.api import task, warn, put, puts, get, local, run, execute, \
     settings, abort, hosts, env, runs_once, parallel
 import config
-from internalutil import mkdir_p
+from internalutil import mkdir_p, map_jobs
 from filefinder import get_testid_file_list
+from tpconfcache import get_tpconf_vars
+from pcapreader import read_packets, ts_str
 
 import gzip
 
+try:
+    import numpy as np
+except ImportError:
+    # fall back to correcting timestamps one at a time
+    np = None
+
 ## Create safe place to dump output from stderr of various shell processes
 stderrhack = os.tmpfile()
 
@@ -63,21 +74,295 @@ CLOCK_OFFSET_FILE_EXT = '_clock_offsets.txt'
 ## Extension for modified data file
 DATA_CORRECTED_FILE_EXT = '.tscorr'
 
-## Temporary unzipped config
-TMP_CONF_FILE = tempfile.mktemp(suffix='_oldconfig.py', dir='/tmp/')
+## Extension of file with clock offsets for virtually corrected data file
+TS_OFFSETS_FILE_EXT = '.tsoffs'
+
+## File extension for clock model file
+CLOCK_MODEL_FILE_EXT = '_clock_model.txt'
+
+## Clock model: number of offsets used for the running median when
+## rejecting outliers
+MODEL_MEDIAN_WINDOW = 9
+
+## Clock model: offsets that differ more than this many (scaled) median
+## absolute deviations from the running median are outliers
+MODEL_OUTLIER_MADS = 5.0
+
+## Clock model: offsets are never outliers if they differ less than this
+## from the running median (seconds)
+MODEL_OUTLIER_MIN = 0.0001
+
+## Number of lines corrected at once
+ADJUST_BLOCK_LINES = 65536
+
+## Parsed clock offset tables and clock models. Index is (clock offset or
+## clock model file name, host name), value is a tuple of reference times,
+## offsets and drifts (arrays if we have numpy, lists otherwise). Drifts is
+## None for clock offset tables
+clock_offsets = {}
+
+
+## Get host name from control interface tcpdump file name
+#  @param tcpdump_file tcpdump file name <test_id>_<host>_ctl.dmp.gz
+#  @return Host name
+def get_ctl_host(tcpdump_file):
+    res = re.search('.*_([a-z0-9\.]*)_ctl.dmp.gz', tcpdump_file)
+    if res:
+        return res.group(1)
+    else:
+        return tcpdump_file
+
+
+## Get broadcast ping times from control interface tcpdump file. If no
+## packet filter is specified, ICMP echo requests to the broadcast address
+## are read directly from the pcap file, otherwise tcpdump is used to apply
+## the filter
+#  @param args Tuple of tcpdump file name, broadcast address and tcpdump
+#              filter string
+#  @return Tuple of map of ping sequence numbers to timestamp strings and
+#          error message (None if there was no error)
+def _get_ping_times(args):
+    tcpdump_file, bc_addr, pkt_filter = args
+
+    times = {}
+    try:
+        if pkt_filter == '':
+            for pkt in read_packets(tcpdump_file, want_icmp=True):
+                if pkt.proto == 'icmp' and pkt.dst == bc_addr and \
+                   pkt.seq is not None:
+                    times[pkt.seq] = ts_str(pkt)
+        else:
+            # We pipe gzcat through to tcpdump. Note, since tcpdump exits early
+            # (due to "-c num_samples") gzcat's pipe will collapse and gzcat
+            # will complain bitterly. So we dump its stderr to stderrhack.
+            init_zcat = Popen(['zcat ' + tcpdump_file], stdin=None,
+                              stdout=PIPE, stderr=stderrhack, shell=True)
+            init_tcpdump = Popen(['tcpdump -tt -r - -n ' + pkt_filter],
+                                 stdin=init_zcat.stdout,
+                                 stdout=PIPE,
+                                 stderr=stderrhack,
+                                 shell=True)
+
+            for line in init_tcpdump.stdout:
+                fields = line.split(" ")
+                times[int(fields[11].replace(',', ''))] = fields[0]
+    except SystemExit:
+        # abort() in worker process
+        return (times, 'Cannot read broadcast pings from %s' % tcpdump_file)
+
+    return (times, None)
+
+
+## Get broadcast address and router name of experiment
+#  @param tcpdump_file One of the experiment's tcpdump files
+#  @return Tuple of broadcast address (or '') and router name
+def _get_bc_config(tcpdump_file):
+
+    dir_name = os.path.dirname(tcpdump_file)
+    # then look for tpconf_vars.log.gz file in that directory 
+    tpconf_vars = get_tpconf_vars(dir_name)
+
+    bc_addr = ''
+    router_name = ''
+
+    if tpconf_vars is not None:
+        # new approach without using config.py
+        bc_addr = tpconf_vars.get('TPCONF_bc_ping_address', '')
+        router_name = tpconf_vars['TPCONF_router'][0].split(':')[0]
+        
+    else:
+        # old approach using config.py
+
+        try:
+            bc_addr = config.TPCONF_bc_ping_address
+        except AttributeError:
+            pass
+
+        router_name = config.TPCONF_router[0].split(':')[0]
+
+    return (bc_addr, router_name)
+
+
+## Write clock offset file
+#  @param out_name Output file name
+#  @param host_times Map of host names to maps of ping sequence numbers to
+#                    timestamp strings
+#  @param baseline_host Host we compute offset against
+def _write_clock_offsets(out_name, host_times, baseline_host):
+
+    # get time differences and get host list
+    diffs = {}
+    ref_times = {}
+    host_str = ''
+    host_list = sorted(host_times.keys())
+    # getting hosts from the config is problematic if different 
+    # experiments with different configs in same directory 
+    #host_list = sorted(config.TPCONF_router + config.TPCONF_hosts)
+
+    for host in host_list:
+        host_str += ' ' + host
+        if host not in host_times:
+            continue
+        for seq in sorted(host_times[host].keys()):
+            if seq not in diffs:
+                diffs[seq] = {}
+            if baseline_host in host_times and \
+               seq in host_times[baseline_host]:
+                diffs[seq][host] = float(host_times[host][seq]) - \
+                    float(host_times[baseline_host][seq])
+                ref_times[seq] = host_times[baseline_host][seq]
+            else:
+                # this only happens:
+                # - if some other host has recorded more pings, OK we don't care
+                #   as this is only at the end after an experiment was finished
+                # - in old versions of TEACUP if TPCONF_router was modified
+                #warn('Cant find baseline host %s timestamp data number %i' % 
+                # (baseline_host, str(seq)))
+                diffs[seq][host] = None
+                ref_times[seq] = None
+
+    # write table of offsets (rows = time, cols = hosts)
+    f = open(out_name, 'w')
+    f.write('# ref_time' + host_str + '\n')
+    for seq in sorted(diffs.keys()):
+        if ref_times[seq] is not None:
+            f.write(ref_times[seq])
+        else:
+            # this case should not never happen
+            continue
+
+        f.write(' ')
+
+        for host in host_list:
+            if host in diffs[seq] and diffs[seq][host] is not None:
+                f.write('{0:.6f}'.format(diffs[seq][host]))
+            else:
+                f.write('NA')
+            if host != host_list[-1]:
+                f.write(' ')
+        f.write('\n')
+
+    f.close()
+
+
+## Reject outlier offsets (NumPy only). An offset is an outlier if it is far
+## from the running median of its neighbours, where far is measured in
+## median absolute deviations of all offsets from the running median
+#  @param offsets Offsets array
+#  @return Boolean array, True for offsets that are not outliers
+def _reject_outliers(offsets):
+
+    if len(offsets) < 3:
+        return np.ones(len(offsets), dtype=bool)
+
+    win = min(MODEL_MEDIAN_WINDOW, len(offsets))
+    padded = np.pad(offsets, (win // 2, win - 1 - win // 2), 'reflect')
+    windows = np.lib.stride_tricks.as_strided(
+        padded, shape=(len(offsets), win),
+        strides=(padded.strides[0], padded.strides[0]))
+    resid = np.abs(offsets - np.median(windows, axis=1))
+    thresh = max(MODEL_OUTLIER_MADS * 1.4826 * np.median(resid),
+                 MODEL_OUTLIER_MIN)
+
+    return resid <= thresh
+
+
+## Fit piecewise-linear clock model to offsets of one host (NumPy only).
+## Starting with one segment for all offsets, a segment is split at the
+## offset with the largest residual as long as the residual of the least
+## squares line is larger than the tolerance
+#  @param ref_times Reference times array (sorted)
+#  @param offsets Offsets array
+#  @param tolerance Maximum residual (seconds)
+#  @return List of (start, end, offset, drift) tuples sorted by start, the
+#          offset at time t in [start, end] is offset + drift * (t - start)
+def fit_clock_model(ref_times, offsets, tolerance):
+
+    keep = _reject_outliers(offsets)
+    ref_times = ref_times[keep]
+    offsets = offsets[keep]
+
+    segments = []
+    todo = [(0, len(ref_times))]
+    while len(todo) > 0:
+        lo, hi = todo.pop()
+        x = ref_times[lo:hi] - ref_times[lo]
+        y = offsets[lo:hi]
+        if hi - lo == 1 or x[-1] == 0:
+            drift, offs = 0.0, np.mean(y)
+        else:
+            drift, offs = np.polyfit(x, y, 1)
+
+        resid = np.abs(y - (offs + drift * x))
+        k = np.argmax(resid)
+        if resid[k] <= tolerance or hi - lo <= 2:
+            segments.append((ref_times[lo], ref_times[hi - 1], offs, drift))
+        else:
+            # split before the worst offset (or after it if it is the first)
+            k = lo + max(k, 1)
+            todo.append((lo, k))
+            todo.append((k, hi))
+
+    segments.sort()
+
+    return segments
+
+
+## Write clock model file. For each host there are one or more lines
+## <host> <start> <end> <offset> <drift>
+#  @param out_name Output file name
+#  @param offs_name Clock offset file name
+#  @param tolerance Maximum residual of fitted offsets (seconds)
+def _write_clock_model(out_name, offs_name, tolerance):
+
+    try:
+        with open(offs_name) as f:
+            host_list = f.readline().split()[2:]
+            rows = [line.split() for line in f]
+    except IOError:
+        abort('Cannot open file %s' % offs_name)
+
+    f = open(out_name, 'w')
+    f.write('# host start end offset drift\n')
+    for col, host in enumerate(host_list, 1):
+        ref_times = np.array([float(row[0]) for row in rows
+                              if row[col] != 'NA'])
+        offsets = np.array([float(row[col]) for row in rows
+                            if row[col] != 'NA'])
+        if len(ref_times) == 0:
+            # host falls back to clock offset table
+            continue
+
+        for start, end, offs, drift in fit_clock_model(ref_times, offsets,
+                                                       tolerance):
+            f.write('%s %.6f %.6f %.6f %.9e\n' %
+                    (host, start, end, offs, drift))
+
+    f.close()
 
 
 ## Get file with time offsets for each experiment host (TASK)
+## The control interface tcpdump files of all experiments are processed in
+## one batch by jobs worker processes
 #  @param exp_list File that lists experiments to process
 #  @param test_id Experiment ID
 #  @param pkt_filter tcpdump filter string to filter braoadcast ping packets
 #  @param baseline_host Host we compute offset against (default is first router)
 #  @param out_dir Output directory for results
+#  @param jobs Number of worker processes ('0' means number of CPUs,
+#              '1' means no worker processes)
+#  @param model '0' only write clock offset file
+#               '1' also fit a piecewise-linear offset and drift model for
+#                   each host and write it to <test_id>_clock_model.txt.
+#                   If the model file exists adjust_timestamps uses the
+#                   model instead of the clock offsets (needs NumPy)
+#  @param model_tol Maximum difference between measured offsets and model
+#                   (seconds). Larger values mean fewer segments
 @task
 def get_clock_offsets(exp_list='experiments_completed.txt',
                       test_id='', pkt_filter='',
                       baseline_host='',
-                      out_dir=''):
+                      out_dir='', jobs='1', model='0', model_tol='0.0002'):
     "Get clock offsets for all hosts"
 
     if len(out_dir) > 0 and out_dir[-1] != '/':
@@ -95,9 +380,12 @@ def get_clock_offsets(exp_list='experiments_completed.txt',
     if len(test_id_arr) == 0 or test_id_arr[0] == '':
         abort('Must specify test_id parameter')
 
-    # specify complete tcpdump parameter list
-    tcpdump_filter = '-tt -r - -n ' + pkt_filter
+    if model == '1' and np is None:
+        abort('Fitting clock model requires NumPy')
 
+    # collect tcpdump files of all experiments
+    experiments = []
+    work = []
     for test_id in test_id_arr:
         test_id = test_id.rstrip()
 
@@ -112,167 +400,86 @@ def get_clock_offsets(exp_list='experiments_completed.txt',
         # if we have tcpdumps for control interface we can assume broadcast ping
         # was enabled
 
-        dir_name = os.path.dirname(tcpdump_files[0])
-        # then look for tpconf_vars.log.gz file in that directory 
-        var_file = local('find -L %s -name "*tpconf_vars.log.gz"' % dir_name,
-                         capture=True)
-
-	bc_addr = ''
-        router_name = ''
-
-        if len(var_file) > 0:
-            # new approach without using config.py
-            # XXX no caching here yet, assume we only generate clockoffset file once
-            # per experiment 
-
-            # unzip archived file
-            local('gzip -cd %s > %s' % (var_file, TMP_CONF_FILE))
-
-            # load the TPCONF_variables into oldconfig
-            oldconfig = imp.load_source('oldconfig', TMP_CONF_FILE)
-
-            # remove temporary unzipped file 
-            try:
-                os.remove(TMP_CONF_FILE)
-                os.remove(TMP_CONF_FILE + 'c') # remove the compiled file as well
-            except OSError:
-                pass
-
-            try:
-                bc_addr = oldconfig.TPCONF_bc_ping_address
-            except AttributeError:
-                pass
-
-            router_name = oldconfig.TPCONF_router[0].split(':')[0]
-            
-        else:
-            # old approach using config.py
-
-            try:
-                bc_addr = config.TPCONF_bc_ping_address
-            except AttributeError:
-                pass
-
-            router_name = config.TPCONF_router[0].split(':')[0]
+        bc_addr, router_name = _get_bc_config(tcpdump_files[0])
 
         if bc_addr == '':
             # assume default multicast address 
             bc_addr = '224.0.1.199' 
 
-        # specify complete tcpdump parameter list
-        if pkt_filter != '':
-            tcpdump_filter = '-tt -r - -n ' + pkt_filter
+        # the default filter is applied when reading the pcap files
+        if pkt_filter != '' and pkt_filter != 'icmp and dst host ' + bc_addr:
+            _pkt_filter = pkt_filter
         else:
-            tcpdump_filter = '-tt -r - -n ' + 'icmp and dst host ' + bc_addr
+            _pkt_filter = ''
 
         if baseline_host == '':
-            baseline_host = router_name 
-
-        #
-        # now read timestamps from each host's tcpdump
-        #
-
-        # map of host names (or IPs) and sequence numbers to timestamps
-        host_times = {}
-        for tcpdump_file in tcpdump_files:
-            host = local(
-                'echo %s | sed "s/.*_\([a-z0-9\.]*\)_ctl.dmp.gz/\\1/"' %
-                tcpdump_file,
-                capture=True)
-            host_times[host] = {}
-            #print(host)
-            #print(host_times)
+            _baseline_host = router_name 
+        else:
+            _baseline_host = baseline_host
 
-            # We pipe gzcat through to tcpdump. Note, since tcpdump exits early
-            # (due to "-c num_samples") gzcat's pipe will collapse and gzcat
-            # will complain bitterly. So we dump its stderr to stderrhack.
-            init_zcat = Popen(['zcat ' + tcpdump_file], stdin=None,
-                              stdout=PIPE, stderr=stderrhack, shell=True)
-            init_tcpdump = Popen(['tcpdump ' + tcpdump_filter],
-                                 stdin=init_zcat.stdout,
-                                 stdout=PIPE,
-                                 stderr=stderrhack,
-                                 shell=True)
+        if out_dir == '' or out_dir[0] != '/':
+            dir_name = os.path.dirname(tcpdump_files[0])
+            _out_dir = dir_name + '/' + out_dir
+        else:
+            _out_dir = out_dir
 
-            for line in init_tcpdump.stdout.read().splitlines():
-                _time = line.split(" ")[0]
-                _seq = int(line.split(" ")[11].replace(',', ''))
-                host_times[host][_seq] = _time
+        hosts = [get_ctl_host(tcpdump_file) for tcpdump_file in tcpdump_files]
+        experiments.append((test_id, hosts, _baseline_host, _out_dir))
+        work += [(tcpdump_file, bc_addr, _pkt_filter)
+                 for tcpdump_file in tcpdump_files]
 
-        #print(host_times)
+    #
+    # now read timestamps from each host's tcpdump
+    #
 
-        # get time differences and get host list
-        diffs = {}
-        ref_times = {}
-        host_str = ''
-        host_list = sorted(host_times.keys())
-        # getting hosts from the config is problematic if different 
-        # experiments with different configs in same directory 
-        #host_list = sorted(config.TPCONF_router + config.TPCONF_hosts)
+    results = map_jobs(_get_ping_times, work, jobs)
 
-        for host in host_list:
-            host_str += ' ' + host
-            if host not in host_times:
-                continue
-            for seq in sorted(host_times[host].keys()):
-                if seq not in diffs:
-                    diffs[seq] = {}
-                if baseline_host in host_times and \
-                   seq in host_times[baseline_host]:
-                    diffs[seq][host] = float(host_times[host][seq]) - \
-                        float(host_times[baseline_host][seq])
-                    ref_times[seq] = host_times[baseline_host][seq]
-                else:
-                    # this only happens:
-                    # - if some other host has recorded more pings, OK we don't care
-                    #   as this is only at the end after an experiment was finished
-                    # - in old versions of TEACUP if TPCONF_router was modified
-                    #warn('Cant find baseline host %s timestamp data number %i' % 
-                    # (baseline_host, str(seq)))
-                    diffs[seq][host] = None
-                    ref_times[seq] = None
+    for times, error in results:
+        if error is not None:
+            abort(error)
 
-        #print(diffs)
+    i = 0
+    for test_id, hosts, _baseline_host, _out_dir in experiments:
+        # map of host names (or IPs) and sequence numbers to timestamps
+        host_times = {}
+        for host in hosts:
+            host_times[host] = results[i][0]
+            i += 1
 
-        if out_dir == '' or out_dir[0] != '/':
-            dir_name = os.path.dirname(tcpdump_files[0])
-            out_dir = dir_name + '/' + out_dir
-        mkdir_p(out_dir)
-        out_name = out_dir + test_id + CLOCK_OFFSET_FILE_EXT
-
-        # write table of offsets (rows = time, cols = hosts)
-        f = open(out_name, 'w')
-        f.write('# ref_time' + host_str + '\n')
-        for seq in sorted(diffs.keys()):
-            if ref_times[seq] is not None:
-                f.write(ref_times[seq])
-            else:
-                # this case should not never happen
-                continue
+        mkdir_p(_out_dir)
+        out_name = _out_dir + test_id + CLOCK_OFFSET_FILE_EXT
 
-            f.write(' ')
+        _write_clock_offsets(out_name, host_times, _baseline_host)
 
-            for host in host_list:
-                if host in diffs[seq] and diffs[seq][host] is not None:
-                    f.write('{0:.6f}'.format(diffs[seq][host]))
-                else:
-                    f.write('NA')
-                if host != host_list[-1]:
-                    f.write(' ')
-            f.write('\n')
+        # remove model of previous run, it would override the new offsets
+        model_name = _out_dir + test_id + CLOCK_MODEL_FILE_EXT
+        if os.path.isfile(model_name):
+            os.remove(model_name)
 
-        f.close()
+        if model == '1':
+            _write_clock_model(model_name, out_name, float(model_tol))
 
 
 ## Adjust timestamps in interim data file (TASK)
+## If virtual is '1' the file with corrected timestamps is not written.
+## Instead we write a small file <name>.tsoffs next to the (non-existing)
+## file <name> that references the interim data file and has the host's
+## clock offsets. The plot functions apply the offsets when reading the data
+## (see read_data_file() in plot_func.R), Python code that needs the
+## corrected data must call materialise_timestamps() first.
+## If there is a clock model file (see get_clock_offsets) with segments for
+## the host, the model is used instead of the clock offsets.
 #  @param test_id Experiment ID
 #  @param file_name Interim data file
 #  @param host_name Host the timestamps are from in the interim data file
 #  @param sep Separator used in interim data file
 #  @param out_dir Output directory for results
+#  @param virtual '0' write file with corrected timestamps
+#                 '1' only write clock offsets for correction at read time
 #  @return Name of file with corrected timestamps
 @task
-def adjust_timestamps(test_id='', file_name='', host_name='', sep=' ', out_dir=''):
+def adjust_timestamps(test_id='', file_name='', host_name='', sep=' ', out_dir='',
+                      virtual='0'):
     "Adjust timestamps in data file based on observed clock offsets"
 
     # out_dir is the user-specified out_dir we pass on to get_clock_offsets()
@@ -290,6 +497,8 @@ def adjust_timestamps(test_id='', file_name='', host_name='', sep=' ', out_dir='
 
     # clock offset file name
     offs_fname = out_dirname + test_id + CLOCK_OFFSET_FILE_EXT
+    # clock model file name
+    model_fname = out_dirname + test_id + CLOCK_MODEL_FILE_EXT
     # new file name
     if file_name.endswith('.gz'):
         # TBD: Strip the trailing .gz from file_name first
@@ -300,7 +509,7 @@ def adjust_timestamps(test_id='', file_name='', host_name='', sep=' ', out_dir='
     #print(offs_fname)
 
     if not os.path.isfile(offs_fname):
-        execute(get_clock_offsets, test_id=test_id, out_dir=out_dir)
+        execute(get_clock_offsets, test_id=test_id, out_dir=out_dir, jobs='1')
 
     if not os.path.isfile(offs_fname):
         # give up and just make a copy of the existing data, so we have a file
@@ -315,7 +524,229 @@ def adjust_timestamps(test_id='', file_name='', host_name='', sep=' ', out_dir='
 
         return new_fname
 
-    host_times = []
+    ref_times, offsets, drifts = None, None, None
+    if os.path.isfile(model_fname):
+        ref_times, offsets, drifts = get_host_model(model_fname, host_name)
+    if ref_times is None:
+        ref_times, offsets, drifts = get_host_offsets(offs_fname, host_name)
+
+    # remove results of previous runs done with the other mode
+    for fname in (new_fname, new_fname + TS_OFFSETS_FILE_EXT):
+        if os.path.isfile(fname):
+            os.remove(fname)
+
+    if virtual == '1':
+        with open(new_fname + TS_OFFSETS_FILE_EXT, 'w') as f:
+            f.write('# data %s\n' % file_name)
+            f.write('# host %s\n' % host_name)
+            if drifts is None:
+                f.write('# offsets %s\n' % offs_fname)
+            else:
+                f.write('# model %s\n' % model_fname)
+            f.write('# sep %s\n' % ('space' if sep == ' ' else sep))
+            if drifts is None:
+                for ref_time, offs in zip(ref_times, offsets):
+                    f.write('%.6f %.6f\n' % (ref_time, offs))
+            else:
+                for ref_time, offs, drift in zip(ref_times, offsets, drifts):
+                    f.write('%.6f %.6f %.9e\n' % (ref_time, offs, drift))
+    else:
+        _adjust_file(file_name, new_fname, sep, ref_times, offsets, drifts)
+
+    return new_fname
+
+
+## Get virtual parameter of adjust_timestamps for ts_correct parameter of
+## analyse functions
+#  @param ts_correct '0', '1' or '2' (correct timestamps when reading data)
+#  @return '1' if ts_correct is '2', '0' otherwise
+def ts_correct_virtual(ts_correct):
+    if ts_correct == '2':
+        return '1'
+    else:
+        return '0'
+
+
+## Check if data file is virtually corrected, i.e. the file does not exist
+## but there is a clock offset file for it (see adjust_timestamps)
+#  @param fname Name of file with corrected timestamps
+#  @return True if data file is virtually corrected, False otherwise
+def is_virtual(fname):
+    return not os.path.isfile(fname) and \
+        os.path.isfile(fname + TS_OFFSETS_FILE_EXT)
+
+
+## Read clock offset file of virtually corrected data file
+#  @param fname Name of file with corrected timestamps
+#  @return Tuple of interim data file name, separator, reference times,
+#          offsets and drifts (None if the file has clock offsets and not
+#          a clock model)
+def read_ts_offsets(fname):
+
+    header = {}
+    ref_times = []
+    offsets = []
+    drifts = []
+    try:
+        with open(fname + TS_OFFSETS_FILE_EXT) as f:
+            for line in f:
+                if line.startswith('#'):
+                    key, val = line[1:].strip().split(' ', 1)
+                    header[key] = val
+                else:
+                    fields = line.split()
+                    ref_times.append(float(fields[0]))
+                    offsets.append(float(fields[1]))
+                    if len(fields) > 2:
+                        drifts.append(float(fields[2]))
+    except IOError:
+        abort('Cannot open file %s' % fname + TS_OFFSETS_FILE_EXT)
+
+    if header.get('sep') == 'space':
+        sep = ' '
+    else:
+        sep = header.get('sep', ' ')
+
+    if 'model' not in header:
+        drifts = None
+
+    if np is not None:
+        ref_times = np.array(ref_times)
+        offsets = np.array(offsets)
+        if drifts is not None:
+            drifts = np.array(drifts)
+
+    return (header['data'], sep, ref_times, offsets, drifts)
+
+
+## Get name of the file that has the data. This is the interim data file for
+## virtually corrected files, and the file itself otherwise
+#  @param fname Data file name
+#  @return Name of file with data
+def get_data_file(fname):
+    if is_virtual(fname):
+        return read_ts_offsets(fname)[0]
+
+    return fname
+
+
+## Write file with corrected timestamps for virtually corrected data file.
+## Does nothing for other files.
+#  @param fname Name of file with corrected timestamps
+#  @return fname
+def materialise_timestamps(fname):
+    if is_virtual(fname):
+        data_file, sep, ref_times, offsets, drifts = read_ts_offsets(fname)
+        _adjust_file(data_file, fname, sep, ref_times, offsets, drifts)
+        os.remove(fname + TS_OFFSETS_FILE_EXT)
+
+    return fname
+
+
+## Write file with corrected timestamps
+#  @param file_name Interim data file
+#  @param new_fname Name of file with corrected timestamps
+#  @param sep Separator used in interim data file
+#  @param ref_times Reference times (see get_host_offsets)
+#  @param offsets Offsets (see get_host_offsets)
+#  @param drifts Drifts (see get_host_model) or None
+def _adjust_file(file_name, new_fname, sep, ref_times, offsets, drifts=None):
+
+    if file_name.endswith('.gz'):
+        fin = gzip.open(file_name, 'rb')
+        fout = gzip.open(new_fname, 'wb',1)
+    else:
+        fin = open(file_name, 'r')
+        fout = open(new_fname, 'w')
+
+    try:
+        for block in _adjust_lines(fin, sep, ref_times, offsets, drifts):
+            fout.write(block)
+    finally:
+        fin.close()
+        fout.close()
+
+
+## Read lines of data file with corrected timestamps. For virtually corrected
+## files the lines are read from the interim data file and corrected on the
+## fly, so the corrected file is never written.
+#  @param fname Data file name
+#  @param start Number of first line to read
+#  @param stop Number of line after the last line to read (None means
+#              read to the end of the file)
+#  @return Generator of lines
+def read_timestamp_lines(fname, start=0, stop=None):
+
+    virtual = is_virtual(fname)
+    if virtual:
+        data_file, sep, ref_times, offsets, drifts = read_ts_offsets(fname)
+    else:
+        data_file = fname
+
+    if data_file.endswith('.gz'):
+        fin = gzip.open(data_file, 'rb')
+    else:
+        fin = open(data_file, 'r')
+
+    try:
+        lines = itertools.islice(fin, start, stop)
+        if not virtual:
+            for line in lines:
+                yield line
+        else:
+            for block in _adjust_lines(lines, sep, ref_times, offsets,
+                                       drifts):
+                for line in block.splitlines(True):
+                    yield line
+    finally:
+        fin.close()
+
+
+## Correct timestamps of lines in blocks of ADJUST_BLOCK_LINES lines
+#  @param lines Iterable of lines of interim data file
+#  @param sep Separator used in interim data file
+#  @param ref_times Reference times (see get_host_offsets)
+#  @param offsets Offsets (see get_host_offsets)
+#  @param drifts Drifts (see get_host_model) or None
+#  @return Generator of blocks of corrected lines
+def _adjust_lines(lines, sep, ref_times, offsets, drifts):
+
+    times = []
+    rests = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line == '':
+            continue
+        fields = line.split(sep, 1)
+        times.append(fields[0])
+        if len(fields) > 1:
+            rests.append(fields[1])
+        else:
+            rests.append('')
+
+        if len(times) == ADJUST_BLOCK_LINES:
+            yield _adjust_block(sep, ref_times, offsets, drifts, times, rests)
+            times = []
+            rests = []
+
+    if len(times) > 0:
+        yield _adjust_block(sep, ref_times, offsets, drifts, times, rests)
+
+
+## Get clock offsets of host. The offset file is only parsed once per run.
+#  @param offs_fname Clock offset file name
+#  @param host_name Host name
+#  @return Tuple of sorted reference times, offsets and None (no drifts).
+#          If there is no offset for a reference time (NA), the offset is
+#          the last known offset (or zero if there is no earlier offset)
+def get_host_offsets(offs_fname, host_name):
+
+    key = (offs_fname, host_name)
+    if key in clock_offsets:
+        return clock_offsets[key]
+
+    ref_times = []
+    offsets = []
     last_offs = 0.0
     try:
         with open(offs_fname) as f:
@@ -329,58 +760,129 @@ def adjust_timestamps(test_id='', file_name='', host_name='', sep=' ', out_dir='
 
                 host_col += 1
 
-            #print(host_name)
-            #print(host_col)
-
             for line in offs_lines[1:]:
-                line = line.rstrip()
-                ref_time = line.split(' ')[0]
-                offs = line.split(' ')[host_col]
+                line = line.rstrip().split(' ')
                 # if we have no data our offset for correction will be the
                 # last offset != zero otherwise it will be the offset measured
-                if offs == 'NA':
+                if line[host_col] == 'NA':
                     offs = last_offs
                 else:
-                    offs = float(offs)
+                    offs = float(line[host_col])
                     last_offs = offs
 
                 # XXX instead of using the instantenous offset values we may
                 # want to do something better in the future, such as using
                 # a weighted moving average etc.
-                host_times.append((ref_time, offs))
+                ref_times.append(float(line[0]))
+                offsets.append(offs)
 
     except IOError:
         abort('Cannot open file %s' % offs_fname)
 
-    if file_name.endswith('.gz'):
-        reader = csv.reader(gzip.open(file_name, 'rb'), delimiter=sep)
-        fout = gzip.open(new_fname, 'wb',1)
-    else:
-        reader = csv.reader(open(file_name, 'r'), delimiter=sep)
-        fout = open(new_fname, 'w')
+    if len(ref_times) == 0:
+        abort('No clock offsets in file %s' % offs_fname)
 
-    # index to curr_ref_time
-    curr = 0
-    for line in reader:
-        time = line[0]
+    if np is not None:
+        ref_times = np.array(ref_times)
+        offsets = np.array(offsets)
 
-        # find the right time, we assume here that each offset is
-        # valid from the time it was observed until the time the next
-        # offset is observed
-        while host_times[curr][0] < time or host_times[curr][0] == 'NA':
-            curr += 1
-            if curr == len(host_times):
-                break
-            
-        if curr > 0 and host_times[curr - 1][0] != 'NA':
-            curr -= 1
+    clock_offsets[key] = (ref_times, offsets, None)
 
-        new_time = float(time) - host_times[curr][1]
+    return clock_offsets[key]
 
-        fout.write('{0:.6f}'.format(new_time) + sep)
-        fout.write(sep.join(line[1:]))
-        fout.write('\n')
 
-    fout.close()
+## Get clock model of host. The model file is only parsed once per run.
+#  @param model_fname Clock model file name
+#  @param host_name Host name
+#  @return Tuple of sorted segment start times, offsets at start times and
+#          drifts, or (None, None, None) if there is no model for the host
+def get_host_model(model_fname, host_name):
 
-    return new_fname
+    key = (model_fname, host_name)
+    if key in clock_offsets:
+        return clock_offsets[key]
+
+    starts = []
+    offsets = []
+    drifts = []
+    try:
+        with open(model_fname) as f:
+            for line in f:
+                fields = line.split()
+                if fields[0] == host_name:
+                    starts.append(float(fields[1]))
+                    offsets.append(float(fields[3]))
+                    drifts.append(float(fields[4]))
+    except IOError:
+        abort('Cannot open file %s' % model_fname)
+
+    if len(starts) == 0:
+        clock_offsets[key] = (None, None, None)
+        return clock_offsets[key]
+
+    if np is not None:
+        starts = np.array(starts)
+        offsets = np.array(offsets)
+        drifts = np.array(drifts)
+
+    clock_offsets[key] = (starts, offsets, drifts)
+
+    return clock_offsets[key]
+
+
+## Correct timestamps (NumPy only). Without drifts we assume each offset is
+## valid from the time it was observed until the time the next offset is
+## observed, timestamps before the first reference time use the first offset.
+## With drifts each model segment is valid from its start time until the
+## start of the next segment, timestamps before the first segment use the
+## first segment
+#  @param ref_times Reference times array (see get_host_offsets) or segment
+#                   start times array (see get_host_model)
+#  @param offsets Offsets array
+#  @param times Timestamps array
+#  @param drifts Drifts array or None
+#  @return Array of corrected timestamps
+def correct_times(ref_times, offsets, times, drifts=None):
+    if drifts is None:
+        idx = np.searchsorted(ref_times, times, side='left') - 1
+        np.clip(idx, 0, None, out=idx)
+
+        return times - offsets[idx]
+
+    idx = np.searchsorted(ref_times, times, side='right') - 1
+    np.clip(idx, 0, None, out=idx)
+
+    return times - (offsets[idx] + drifts[idx] * (times - ref_times[idx]))
+
+
+## Correct a block of timestamps (see correct_times)
+#  @param sep Separator
+#  @param ref_times Reference times (see get_host_offsets) or segment start
+#                   times (see get_host_model)
+#  @param offsets Offsets
+#  @param drifts Drifts or None
+#  @param times List of timestamp strings
+#  @param rests List of the remaining line contents
+#  @return Corrected lines
+def _adjust_block(sep, ref_times, offsets, drifts, times, rests):
+
+    if np is not None:
+        new_times = correct_times(ref_times, offsets,
+                                  np.array(times, dtype=float),
+                                  drifts).tolist()
+    elif drifts is None:
+        new_times = []
+        for time in times:
+            t = float(time)
+            idx = max(bisect.bisect_left(ref_times, t) - 1, 0)
+            new_times.append(t - offsets[idx])
+    else:
+        new_times = []
+        for time in times:
+            t = float(time)
+            idx = max(bisect.bisect_right(ref_times, t) - 1, 0)
+            new_times.append(t - (offsets[idx] +
+                                  drifts[idx] * (t - ref_times[idx])))
+
+    return ''.join('%.6f%s%s\n' % (new_time, sep, rest)
+                   for new_time, rest in zip(new_times, rests))
@@ -0,0 +1,323 @@
+# Copyright (c) 2013-2018 Centre for Advanced Internet Architectures,
+# Swinburne University of Technology. All rights reserved.
+#
+# Author: Sebastian Zander (sebastian.zander@gmx.de)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+## @package derivedcache
+# Provenance manifest of derived data files (extracted data, capture pass
+# spool directories, split logs). For each derived file or directory the
+# manifest has a key computed from the extractor name, the parameters that
+# affect the output, the identity (path, size, modification time) of the
+# input files and the version of the analysis code. With replot_only='1'
+# data is only derived again if the key changed or the derived file was
+# modified or removed. Data derived earlier in the same analysis run (e.g.
+# by another task of the same fab invocation) is not derived again, even
+# with replot_only='0'. The manifest is an SQLite database shared by
+# concurrent analysis runs (or worker processes).
+#
+# $Id$
+
+import os
+import time
+import shutil
+import hashlib
+import sqlite3
+from fabric.api import task, warn, puts, abort
+from internalutil import RUN_ID, open_cache_db
+
+
+## Manifest file name
+MANIFEST_FILE_NAME = 'teacup_derived_cache.db'
+## Seconds we wait for a lock held by another process
+MANIFEST_TIMEOUT = 60
+## Source files of the analysis code, if one of them changes all derived
+## data is derived again
+CODE_FILES = ('analyse.py', 'analyse_owd.py', 'analysecmpexp.py',
+              'analyseutil.py', 'capturepass.py', 'clockoffset.py',
+              'filefinder.py', 'flowcache.py', 'flowindex.py', 'hostint.py',
+              'internalutil.py', 'logsplit.py', 'pcapreader.py',
+              'sourcefilter.py', 'tpconfcache.py')
+## Code version (hash over CODE_FILES), computed once per run
+code_version = [None]
+## Database connection and ID of process that opened it (connections must
+## not be used by forked worker processes)
+manifest_db = [None, None]
+
+
+## Create manifest table
+#  @param conn Database connection
+def _create_manifest_db(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS derived ('
+                 'path TEXT PRIMARY KEY, key TEXT, extractor TEXT, '
+                 'inputs TEXT, params TEXT, size INTEGER, '
+                 'mtime REAL, used REAL, run TEXT)')
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(derived)')]
+    if 'run' not in columns:
+        # manifest of older version
+        conn.execute('ALTER TABLE derived ADD COLUMN run TEXT')
+
+
+## Open manifest database if not open yet. If the manifest cannot be opened
+## everything is derived again
+#  @return Database connection or None if manifest cannot be opened
+def _get_manifest_db():
+    return open_cache_db(manifest_db, MANIFEST_FILE_NAME, MANIFEST_TIMEOUT,
+                         _create_manifest_db)
+
+
+## Get version of analysis code
+#  @return Hash over the analysis source files
+def get_code_version():
+
+    if code_version[0] is None:
+        h = hashlib.sha1()
+        code_dir = os.path.dirname(os.path.abspath(__file__))
+        for fname in CODE_FILES:
+            try:
+                with open(os.path.join(code_dir, fname), 'rb') as f:
+                    h.update(f.read())
+            except IOError:
+                h.update(fname)
+        code_version[0] = h.hexdigest()
+
+    return code_version[0]
+
+
+## Get state of derived file or directory. For directories the size is the
+## total size of all files in the directory
+#  @param fname File or directory name
+#  @return Tuple of size and modification time, or None if file does not
+#          exist
+def _get_state(fname):
+
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+
+    size = st.st_size
+    if os.path.isdir(fname):
+        size = 0
+        for name in os.listdir(fname):
+            try:
+                size += os.stat(os.path.join(fname, name)).st_size
+            except OSError:
+                pass
+
+    return (size, st.st_mtime)
+
+
+## Compute manifest key
+#  @param extractor Extractor name
+#  @param inputs List of input file names
+#  @param params Map of parameter names to values that affect the output
+#  @return Tuple of key and string with identities of input files
+def _get_key(extractor, inputs, params):
+
+    input_ids = []
+    for fname in inputs:
+        path = os.path.realpath(fname)
+        try:
+            st = os.stat(path)
+            input_ids.append((path, st.st_size, st.st_mtime))
+        except OSError:
+            input_ids.append((path, None, None))
+    input_str = repr(input_ids)
+
+    h = hashlib.sha1()
+    h.update(repr((extractor, sorted(params.items()), input_str,
+                   get_code_version())))
+
+    return (h.hexdigest(), input_str)
+
+
+## Check if data must be derived (again)
+#  @param replot_only '0' derive data again unless it was derived in this
+#                     analysis run, '1' only derive data if derived data
+#                     does not exist or is out of date
+#  @param out_files List of derived file (or directory) names
+#  @param extractor Extractor name
+#  @param inputs List of input file names
+#  @param params Map of parameter names to values that affect the output
+#  @return True if data must be derived, False if derived data is up to date
+def must_derive(replot_only, out_files, extractor, inputs, params=None):
+
+    if params is None:
+        params = {}
+
+    conn = _get_manifest_db()
+    if conn is None:
+        return True
+
+    key = _get_key(extractor, inputs, params)[0]
+    for out in out_files:
+        path = os.path.realpath(out)
+        try:
+            row = conn.execute('SELECT key, size, mtime, run FROM derived '
+                               'WHERE path = ?', (path, )).fetchone()
+        except sqlite3.Error:
+            return True
+
+        if row is None or row[0] != key:
+            return True
+
+        if replot_only == '0' and row[3] != RUN_ID:
+            return True
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return True
+
+        # for directories the size is only used for eviction
+        if st.st_mtime != row[2] or \
+           (not os.path.isdir(path) and st.st_size != row[1]):
+            return True
+
+    try:
+        with conn:
+            conn.executemany('UPDATE derived SET used = ? WHERE path = ?',
+                             [(time.time(), os.path.realpath(out))
+                              for out in out_files])
+    except sqlite3.Error:
+        pass
+
+    return False
+
+
+## Record provenance of derived data. Must be called after the derived
+## files have been written
+#  @param out_files List of derived file (or directory) names
+#  @param extractor Extractor name
+#  @param inputs List of input file names
+#  @param params Map of parameter names to values that affect the output
+def record_derived(out_files, extractor, inputs, params=None):
+
+    if params is None:
+        params = {}
+
+    conn = _get_manifest_db()
+    if conn is None:
+        return
+
+    key, input_str = _get_key(extractor, inputs, params)
+    rows = []
+    for out in out_files:
+        state = _get_state(out)
+        if state is not None:
+            rows.append((os.path.realpath(out), key, extractor, input_str,
+                         repr(sorted(params.items())), state[0], state[1],
+                         time.time(), RUN_ID))
+
+    try:
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO derived '
+                             '(path, key, extractor, inputs, params, size, '
+                             'mtime, used, run) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    except sqlite3.Error:
+        # if we can't write to the file then bad luck, user needs to fix
+        # permission, but ensure we don't crash
+        pass
+
+
+## Parse size with optional K, M or G suffix
+#  @param size Size string
+#  @return Size in bytes
+def _parse_size(size):
+
+    mult = 1
+    if size[-1:].upper() in ('K', 'M', 'G'):
+        mult = 1024 ** ('KMG'.index(size[-1].upper()) + 1)
+        size = size[:-1]
+
+    try:
+        return int(float(size) * mult)
+    except ValueError:
+        abort('Invalid size %s' % size)
+
+
+## Remove least recently used derived data until the total size of the
+## derived data in the manifest is at most max_size (TASK)
+#  @param max_size Maximum total size in bytes (suffixes K, M, G can be used),
+#                  must be specified ('0' removes all derived data)
+#  @param out_dir Only consider derived data in this directory (and its
+#                 subdirectories), default is all derived data
+@task
+def evict_derived(max_size='', out_dir=''):
+    "Remove least recently used derived data files"
+
+    if max_size == '':
+        abort('Must specify max_size parameter')
+
+    max_size = _parse_size(max_size)
+
+    conn = _get_manifest_db()
+    if conn is None:
+        abort('Cannot open manifest %s' % MANIFEST_FILE_NAME)
+
+    rows = conn.execute('SELECT path, size FROM derived '
+                        'ORDER BY used DESC').fetchall()
+
+    prefix = ''
+    if out_dir != '':
+        prefix = os.path.join(os.path.realpath(out_dir), '')
+        rows = [row for row in rows if row[0].startswith(prefix)]
+
+    total = 0
+    evict = []
+    for path, size in rows:
+        if not os.path.exists(path):
+            # removed by user
+            evict.append(path)
+        elif total + size <= max_size:
+            total += size
+        else:
+            evict.append(path)
+
+    sizes = dict(rows)
+    freed = 0
+    for path in evict:
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+            else:
+                continue
+        except OSError as e:
+            warn('Cannot remove %s: %s' % (path, e))
+            continue
+
+        freed += sizes[path]
+
+    try:
+        with conn:
+            conn.executemany('DELETE FROM derived WHERE path = ?',
+                             [(path, ) for path in evict
+                              if not os.path.exists(path)])
+    except sqlite3.Error:
+        warn('Cannot update manifest %s' % MANIFEST_FILE_NAME)
+
+    puts('Removed %i bytes of derived data, %i bytes left' % (freed, total))
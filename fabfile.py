@@ -177,6 +177,11 @@ try:
 except ImportError:
     pass
 
+try:
+    from derivedcache import evict_derived
+except ImportError:
+    pass
+
 ## Set to zero if we don't need OS initialisation anymore
 # XXX this is a bit ugly as a global
 do_init_os = '1'
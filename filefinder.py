@@ -30,9 +30,25 @@
 # $Id$
 
 import os
+import bisect
+import fcntl
+import fnmatch
+import tempfile
+from subprocess import Popen, PIPE
 import config
 from fabric.api import task, warn, local, run, execute, abort, hosts, env
 from internalutil import _list
+from capturepass import SPOOL_DIR_EXT
+from logsplit import SPLIT_DIR_EXT
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        # fall back to listdir and stat
+        scandir = None
 
 # 
 # Directory cache functions
@@ -86,6 +102,320 @@ def lookup_dir_cache(test_id):
         return '.'
 
 
+# 
+# File index functions
+#
+
+## File index file name
+INDEX_FILE_NAME = 'teacup_file_index.txt'
+## Lock file of the file index
+INDEX_LOCK_FILE_NAME = INDEX_FILE_NAME + '.lock'
+## Directories created by the analysis that are not indexed (they change
+## all the time and never contain experiment files)
+INDEX_SKIP_DIR_EXTS = (SPOOL_DIR_EXT, SPLIT_DIR_EXT)
+## File index. Index is the (normalised) directory name, value is a tuple of
+## modification time of the directory, list of file names and list of
+## subdirectory names. Lines in the index file are
+## <directory> <mtime> <name> ... <subdirectory>/ ... (tab separated)
+file_index = {}
+## True if the index file was read
+file_index_loaded = False
+## Sorted names in directory trees. Index is the (normalised) search
+## directory, value is a sorted list of (name, path) tuples
+file_index_names = {}
+
+
+## Read file index if exists
+def read_file_index():
+
+    if not os.path.isfile(INDEX_FILE_NAME):
+        return
+
+    with open(INDEX_FILE_NAME, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                # header of older versions
+                continue
+            fields = line.rstrip('\n').split('\t')
+            files = [x for x in fields[2:] if not x.endswith('/')]
+            subdirs = [x[:-1] for x in fields[2:] if x.endswith('/') and
+                       not x[:-1].endswith(INDEX_SKIP_DIR_EXTS)]
+            file_index[fields[0]] = (float(fields[1]), files, subdirs)
+
+
+## Write file index. The file is replaced atomically, so concurrent analysis
+## runs always read a complete index
+def write_file_index():
+
+    try:
+        fd, tmp_name = tempfile.mkstemp(
+            prefix=INDEX_FILE_NAME + '.',
+            dir=os.path.dirname(os.path.abspath(INDEX_FILE_NAME)))
+        with os.fdopen(fd, 'w') as f:
+            for d in sorted(file_index.keys()):
+                mtime, files, subdirs = file_index[d]
+                f.write('\t'.join([d, repr(mtime)] + files +
+                                  [x + '/' for x in subdirs]) + '\n')
+        os.rename(tmp_name, INDEX_FILE_NAME)
+    except (IOError, OSError):
+        # if we can't write to the file then bad luck, user needs to fix
+        # permission, but ensure we don't crash
+        pass
+
+
+## List directory
+#  @param dir_name Directory name
+#  @return Tuple of list of file names and list of subdirectory names
+#          (symbolic links are followed like find -L does)
+def _list_dir(dir_name):
+
+    files = []
+    subdirs = []
+    if scandir is not None:
+        for entry in scandir(dir_name):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                subdirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    else:
+        for name in os.listdir(dir_name):
+            if os.path.isdir(_join(dir_name, name)):
+                subdirs.append(name)
+            else:
+                files.append(name)
+
+    # names that cannot be stored in the index file
+    files = [x for x in files if '\t' not in x and '\n' not in x]
+    subdirs = [x for x in subdirs if '\t' not in x and '\n' not in x and
+               not x.endswith(INDEX_SKIP_DIR_EXTS)]
+
+    return (files, subdirs)
+
+
+## Join directory and name like normpath(join(dir_name, name)) would
+#  @param dir_name Normalised directory name
+#  @param name File or directory name
+#  @return Path
+def _join(dir_name, name):
+    if dir_name == '.':
+        return name
+    else:
+        return os.path.join(dir_name, name)
+
+
+## Check if directory is in directory tree
+#  @param dir_name Normalised directory name
+#  @param tree Normalised top directory of tree
+#  @return True if dir_name is tree or below tree
+def _in_tree(dir_name, tree):
+    return tree == '.' or dir_name == tree or \
+        dir_name.startswith(tree.rstrip('/') + '/')
+
+
+## Remove directory tree from file index
+#  @param dir_name Directory name
+#  @param changes List of (directory, old names, new names) tuples the
+#                 removed directories are appended to
+def _drop_index_tree(dir_name, changes):
+
+    todo = [dir_name]
+    while len(todo) > 0:
+        dir_name = todo.pop()
+        entry = file_index.pop(dir_name, None)
+        if entry is not None:
+            changes.append((dir_name, entry[1] + entry[2], []))
+            todo += [_join(dir_name, x) for x in entry[2]]
+
+
+## Update sorted name lists of search directories for changed directories
+#  @param changes List of (directory, old names, new names) tuples
+def _update_index_names(changes):
+
+    for search_dir, names in file_index_names.items():
+        for dir_name, old, new in changes:
+            if not _in_tree(dir_name, search_dir):
+                continue
+            for name in old:
+                k = bisect.bisect_left(names, (name, _join(dir_name, name)))
+                if k < len(names) and names[k] == (name, _join(dir_name, name)):
+                    del names[k]
+            for name in new:
+                bisect.insort(names, (name, _join(dir_name, name)))
+
+
+## Update file index for directory tree. The modification times of all
+## directories are checked on every lookup (the analysis writes files while
+## it runs), but only directories with a changed modification time are
+## listed again. The index file is only written if the index changed
+#  @param search_dir Normalised directory from where we start the search
+#  @return True if index was modified, False otherwise
+def _refresh_file_index(search_dir):
+    global file_index_loaded
+
+    if not file_index_loaded:
+        read_file_index()
+        file_index_loaded = True
+
+    modified = _refresh_index_tree(search_dir)
+    if not modified:
+        return False
+
+    try:
+        lock = os.open(INDEX_LOCK_FILE_NAME, os.O_RDWR | os.O_CREAT)
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    except (IOError, OSError):
+        # can't lock, write anyway (the file is replaced atomically)
+        lock = None
+
+    try:
+        write_file_index()
+    finally:
+        if lock is not None:
+            os.close(lock)
+
+    return True
+
+
+## Update file index for directory tree (see _refresh_file_index)
+#  @param search_dir Normalised directory from where we start the search
+#  @return True if index was modified, False otherwise
+def _refresh_index_tree(search_dir):
+
+    # list of (directory, old names, new names) tuples
+    changes = []
+    # directories to visit with (device, inode) tuples of their parents
+    todo = [(search_dir, frozenset())]
+    while len(todo) > 0:
+        dir_name, parents = todo.pop()
+        try:
+            st = os.stat(dir_name)
+        except OSError:
+            _drop_index_tree(dir_name, changes)
+            continue
+
+        # don't follow symbolic link loops
+        dev_ino = (st.st_dev, st.st_ino)
+        if dev_ino in parents:
+            _drop_index_tree(dir_name, changes)
+            continue
+        parents = parents | set([dev_ino])
+
+        entry = file_index.get(dir_name)
+        if entry is None or entry[0] != st.st_mtime:
+            try:
+                files, subdirs = _list_dir(dir_name)
+            except OSError:
+                files, subdirs = [], []
+            if entry is not None:
+                for subdir in set(entry[2]) - set(subdirs):
+                    _drop_index_tree(_join(dir_name, subdir), changes)
+                changes.append((dir_name, entry[1] + entry[2],
+                                files + subdirs))
+            else:
+                changes.append((dir_name, [], files + subdirs))
+            entry = (st.st_mtime, files, subdirs)
+            file_index[dir_name] = entry
+
+        todo += [(_join(dir_name, x), parents) for x in entry[2]]
+
+    _update_index_names(changes)
+
+    return len(changes) > 0
+
+
+## Find files and directories in directory tree by walking the tree
+## (see find_files)
+#  @param search_dir Normalised directory from where we start the search
+#  @param pattern Shell pattern
+#  @return Sorted list of matching paths (without leading ./)
+def _walk_find_files(search_dir, pattern):
+
+    ret = []
+    todo = [(search_dir, frozenset())]
+    while len(todo) > 0:
+        dir_name, parents = todo.pop()
+        try:
+            st = os.stat(dir_name)
+            files, subdirs = _list_dir(dir_name)
+        except OSError:
+            continue
+
+        # don't follow symbolic link loops
+        dev_ino = (st.st_dev, st.st_ino)
+        if dev_ino in parents:
+            continue
+        parents = parents | set([dev_ino])
+
+        for name in files + subdirs:
+            if fnmatch.fnmatchcase(name, pattern):
+                ret.append(_join(dir_name, name))
+        todo += [(_join(dir_name, x), parents) for x in subdirs]
+
+    return sorted(ret)
+
+
+## Find files and directories in directory tree, like
+## find -L <search_dir> -name <pattern>, but using the file index. If
+## nothing is found in the index, the directory tree is walked (in case
+## a directory changed without changing its modification time)
+#  @param search_dir Directory from where we start the search
+#  @param pattern Shell pattern
+#  @return Sorted list of matching paths (without leading ./)
+def find_files(search_dir, pattern):
+
+    search_dir = os.path.normpath(search_dir)
+    _refresh_file_index(search_dir)
+
+    names = file_index_names.get(search_dir)
+    if names is None:
+        names = []
+        todo = [search_dir]
+        while len(todo) > 0:
+            dir_name = todo.pop()
+            entry = file_index.get(dir_name)
+            if entry is None:
+                # symbolic link loop
+                continue
+            for name in entry[1] + entry[2]:
+                names.append((name, _join(dir_name, name)))
+            todo += [_join(dir_name, x) for x in entry[2]]
+        names.sort()
+        file_index_names[search_dir] = names
+
+    # only names starting with the literal prefix of the pattern can match
+    prefix = pattern
+    for c in '*?[':
+        prefix = prefix.split(c, 1)[0]
+    if prefix == '':
+        start, end = 0, len(names)
+    else:
+        start = bisect.bisect_left(names, (prefix, ))
+        end = bisect.bisect_left(names, (prefix + '\xff', ))
+
+    ret = sorted(path for name, path in names[start:end]
+                 if fnmatch.fnmatchcase(name, pattern))
+    if len(ret) == 0:
+        ret = _walk_find_files(search_dir, pattern)
+
+    return ret
+
+
+## Filter file list with shell command(s)
+#  @param file_list List of file names
+#  @param pipe_cmd One or more shell command that are executed in pipe
+#  @return Filtered list of file names
+def _pipe_file_list(file_list, pipe_cmd):
+
+    proc = Popen(pipe_cmd, shell=True, stdin=PIPE, stdout=PIPE)
+    out = proc.communicate(''.join(x + '\n' for x in file_list))[0]
+
+    return _list(out)
+
+
 ## Filter out duplicates (if we accidentally have copies lying around in 
 #  different subdirectories)
 #  @param file_list List of file names
@@ -109,7 +439,7 @@ def filter_duplicates(file_list):
 #  @param file_ext Characteristic rightmost part of file (file extension) we are
 #                  searching for
 #  @param pipe_cmd One or more shell command that are executed in pipe with the
-#                  find command
+#                  list of files found
 #  @param search_dir Directory from where we start the search
 #  @param no_abort Set to false means abort if no matching files are found (default)
 #                  Set to true means don't abort if no matching files are found.
@@ -119,20 +449,15 @@ def get_testid_file_list(file_list_fname='', test_id='', file_ext='', pipe_cmd='
 
     file_list = []
 
-    if pipe_cmd != '':
-        pipe_cmd = ' | ' + pipe_cmd
-
     # if search dir is not specified try to find it in cache
     if search_dir == '.':
         search_dir = lookup_dir_cache(test_id)
 
         # if not in cache try to locate the directory based on the uname file
         if search_dir == '.':
-            _files = _list(
-                local(
-                    'find -L %s -name "%s*uname.log*" -print | sed -e "s/^\.\///"%s' %
-                    (search_dir, test_id, pipe_cmd),
-                    capture=True))
+            _files = find_files(search_dir, '%s*uname.log*' % test_id)
+            if pipe_cmd != '':
+                _files = _pipe_file_list(_files, pipe_cmd)
             if len(_files) > 0:
                 search_dir = os.path.dirname(_files[0])
                 append_dir_cache(test_id, search_dir)
@@ -147,11 +472,9 @@ def get_testid_file_list(file_list_fname='', test_id='', file_ext='', pipe_cmd='
             abort('Must specify test_id parameter')
 
         for test_id in test_id_arr:
-            _files = _list(
-                local(
-                    'find -L %s -name "%s*%s" -print | sed -e "s/^\.\///"%s' %
-                    (search_dir, test_id, file_ext, pipe_cmd),
-                    capture=True))
+            _files = find_files(search_dir, '%s*%s' % (test_id, file_ext))
+            if pipe_cmd != '':
+                _files = _pipe_file_list(_files, pipe_cmd)
 
             _files = filter_duplicates(_files)
  
@@ -165,11 +488,7 @@ def get_testid_file_list(file_list_fname='', test_id='', file_ext='', pipe_cmd='
                 lines = f.readlines()
             for fname in lines:
                 fname = fname.rstrip()
-                _files = _list(
-                    local(
-                        'find -L %s -name "%s" -print | sed -e "s/^\.\///"' %
-                        (search_dir, fname),
-                        capture=True))
+                _files = find_files(search_dir, fname)
 
                 _files = filter_duplicates(_files)
 
@@ -27,37 +27,66 @@
 ## @package flowcache
 # Functions to cache flows of experiments 
 #
+# The cache is an SQLite database keyed by the absolute path of the file
+# (e.g. tcpdump file). Each entry also has the size and modification time
+# of the file, entries that do not match the file anymore are ignored and
+# replaced. SQLite does the locking, so concurrent analysis runs (or worker
+# processes) can read and write the cache safely.
+#
 # $Id$
 
 import os
+import sqlite3
 import config
 from fabric.api import task, warn, local, run, execute, abort, hosts, env
+from internalutil import open_cache_db
 
 
 ## Cache file name
-CACHE_FILE_NAME = 'teacup_flow_cache.txt'
-## Flow cache. Index is the file name for which we have flows cached 
-## (e.g. tcpdump file), value is a list of flows (which can be empty) 
+CACHE_FILE_NAME = 'teacup_flow_cache.db'
+## Seconds we wait for a lock held by another process
+CACHE_TIMEOUT = 60
+## Flow cache. Index is the absolute file name for which we have flows cached 
+## (e.g. tcpdump file), value is a tuple of size, modification time and list
+## of flows (which can be empty) 
 flow_cache = {}
+## Database connection and ID of process that opened it (connections must
+## not be used by forked worker processes)
+cache_db = [None, None]
 
-## Read cache file if exists
-def read_flow_cache():
 
-    if not os.path.isfile(CACHE_FILE_NAME):
-        return
+## Create cache table
+#  @param conn Database connection
+def _create_cache_db(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS flows ('
+                 'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                 'flows TEXT)')
+
 
-    with open(CACHE_FILE_NAME, 'r') as f:
-        lines = f.readlines()
-        for line in lines:
-            fields = line.split()
-            if len(fields) == 2:
-                flow_cache[fields[0]] = fields[1].split(';')
-            else:
-                flow_cache[fields[0]] = []
+## Open cache database if not open yet
+#  @return Database connection or None if cache cannot be opened
+def _get_cache_db():
+    return open_cache_db(cache_db, CACHE_FILE_NAME, CACHE_TIMEOUT,
+                         _create_cache_db)
 
 
-## Append to cache if entry not in there yet. note that flows may be empty in which
-## case the flow field in the cache file will be empty
+## Get cache key and file state
+#  @param fname File name
+#  @return Tuple of absolute file name, size and modification time, or None if
+#          the file does not exist
+def _get_file_state(fname):
+
+    path = os.path.realpath(fname)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return (path, st.st_size, st.st_mtime)
+
+
+## Add cache entry if entry not in there yet or it is stale. Note that we
+## do not create entries with empty flow list
 #  @param fname File name
 #  @param flows List of flows (5-tuples)
 def append_flow_cache(fname, flows):
@@ -66,28 +95,65 @@ def append_flow_cache(fname, flows):
     if len(flows) == 0:
         return
 
-    if fname not in flow_cache:
-        try:
-            with open(CACHE_FILE_NAME, 'a') as f:
-                f.write('%s %s\n' % (fname, ';'.join(flows)))
-        except:
-            # if we can't write to the file then bad luck, user needs to fix permission,
-            # but ensure we don't crash
-            pass
+    state = _get_file_state(fname)
+    if state is None:
+        return
+
+    path, size, mtime = state
+    entry = flow_cache.get(path)
+    if entry is not None and entry[0] == size and entry[1] == mtime:
+        return
+
+    flow_cache[path] = (size, mtime, flows)
+
+    conn = _get_cache_db()
+    if conn is None:
+        return
+
+    try:
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO flows VALUES (?, ?, ?, ?)',
+                         (path, size, mtime, ';'.join(flows)))
+    except sqlite3.Error:
+        # if we can't write to the file then bad luck, user needs to fix
+        # permission, but ensure we don't crash
+        pass
 
 
 ## Perform cache lookup. If we have entry for file name return list of flows that can be
-## empty, otherwise return None 
+## empty, otherwise return None. Entries are only returned if size and
+## modification time of the file match the entry
 #  @param fname File name for which we want to know flows
 #  @return List of flows (semicolon separated) or None
 def lookup_flow_cache(fname):
 
-    # load cache first if cache is empty
-    if len(flow_cache) == 0:
-        read_flow_cache()
+    state = _get_file_state(fname)
+    if state is None:
+        return None
+
+    path, size, mtime = state
+    entry = flow_cache.get(path)
+    if entry is None:
+        conn = _get_cache_db()
+        if conn is None:
+            return None
 
-    if fname in flow_cache:
-        return flow_cache[fname]
+        try:
+            row = conn.execute('SELECT size, mtime, flows FROM flows '
+                               'WHERE path = ?', (path, )).fetchone()
+        except sqlite3.Error:
+            row = None
+
+        if row is None:
+            return None
+
+        if row[2] == '':
+            entry = (row[0], row[1], [])
+        else:
+            entry = (row[0], row[1], str(row[2]).split(';'))
+        flow_cache[path] = entry
+
+    if entry[0] == size and entry[1] == mtime:
+        return entry[2]
     else:
         return None 
-
@@ -0,0 +1,117 @@
+# Copyright (c) 2013-2018 Centre for Advanced Internet Architectures,
+# Swinburne University of Technology. All rights reserved.
+#
+# Author: Sebastian Zander (sebastian.zander@gmx.de)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+## @package flowindex
+# Index flows in tcpdump files with a single pass over the file
+#
+# $Id$
+
+from pcapreader import read_packets
+from flowcache import append_flow_cache, lookup_flow_cache
+
+
+## Flow index. Index is the tcpdump file name, value is a dictionary that
+## maps flows (5-tuples) to FlowStats objects
+flow_index = {}
+
+
+## Per-flow statistics
+class FlowStats(object):
+
+    __slots__ = ('packets', 'bytes', 'first_ts', 'last_ts')
+
+    ## Create statistics for new flow
+    #  @param ts First time stamp
+    def __init__(self, ts):
+        self.packets = 0
+        self.bytes = 0
+        self.first_ts = ts
+        self.last_ts = ts
+
+
+## Get flow 5-tuple string as used in the flow cache
+#  @param pkt Packet (see pcapreader)
+#  @return Flow string <src>,<src_port>,<dst>,<dst_port>,<proto>
+def flow_key(pkt):
+    return '%s,%i,%s,%i,%s' % (pkt.src, pkt.sport, pkt.dst, pkt.dport,
+                               pkt.proto)
+
+
+## Index flows in tcpdump file. For each flow we record number of packets,
+## number of bytes (sum of IP lengths) and first and last time stamps
+#  @param tcpdump_file tcpdump file name
+#  @return Dictionary mapping flows to FlowStats objects
+def index_flows(tcpdump_file):
+
+    if tcpdump_file in flow_index:
+        return flow_index[tcpdump_file]
+
+    stats = {}
+    keys = {}
+    for pkt in read_packets(tcpdump_file):
+        t = (pkt.src, pkt.sport, pkt.dst, pkt.dport, pkt.proto)
+        key = keys.get(t)
+        if key is None:
+            key = keys[t] = flow_key(pkt)
+            stats[key] = FlowStats(pkt.ts_sec + pkt.ts_usec / 1E6)
+
+        s = stats[key]
+        s.packets += 1
+        s.bytes += pkt.ip_len
+        s.last_ts = pkt.ts_sec + pkt.ts_usec / 1E6
+
+    flow_index[tcpdump_file] = stats
+
+    return stats
+
+
+## Sort flows like the flow cache expects, i.e. all TCP flows first and then
+## all UDP flows, each sorted in byte order (LC_ALL=C sort)
+#  @param flows List of flows
+#  @return Sorted list of flows
+def sort_flows(flows):
+    tcp_flows = sorted(f for f in flows if f.endswith(',tcp'))
+    udp_flows = sorted(f for f in flows if f.endswith(',udp'))
+
+    return tcp_flows + udp_flows
+
+
+## Get flows for tcpdump file. Use the flow cache if possible, otherwise
+## index the file and add the flows to the cache
+#  @param tcpdump_file tcpdump file name
+#  @param proto If not empty only return flows of this protocol ('tcp' or 'udp')
+#  @return List of flows (5-tuples)
+def get_flows(tcpdump_file, proto=''):
+
+    flows = lookup_flow_cache(tcpdump_file)
+    if flows == None:
+        flows = sort_flows(index_flows(tcpdump_file).keys())
+        append_flow_cache(tcpdump_file, flows)
+
+    if proto != '':
+        flows = [f for f in flows if f.endswith(',' + proto)]
+
+    return flows
@@ -31,7 +31,18 @@
 # $Id$
 
 import os
+import time
 import errno
+import fcntl
+import gzip
+import sqlite3
+import multiprocessing
+from fabric.api import abort
+
+
+## ID of this analysis run. Worker processes inherit the ID, so they can
+## detect data derived by other processes of the same run
+RUN_ID = '%i.%f' % (os.getpid(), time.time())
 
 
 ## Build a list of strings from a number of string lines
@@ -58,6 +69,230 @@ def mkdir_p(path):
             raise
 
 
+## Create directory if necessary and lock it. Blocks until no other process
+## holds the lock
+#  @param path Directory to lock
+#  @return File descriptor, the lock is released when it is closed
+def lock_dir(path):
+    mkdir_p(path)
+    fd = os.open(path, os.O_RDONLY)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+
+    return fd
+
+
+## Apply function to each item of work list, using a pool of worker
+## processes. Worker processes (e.g. of extract_all) do not start worker
+## processes themselves, the work is done in the calling process then.
+## The items are run as independent nodes of run_graph, so a worker process
+## that dies or a result that cannot be sent back makes the task abort
+## instead of blocking it
+#  @param func Module-level function with one argument
+#  @param work List of arguments
+#  @param jobs Number of worker processes ('0' means number of CPUs,
+#              '1' means no worker processes)
+#  @return List of results in order of work list
+def map_jobs(func, work, jobs='0'):
+
+    jobs = int(jobs)
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(work))
+    if multiprocessing.current_process().daemon:
+        jobs = 1
+
+    if jobs <= 1:
+        return [func(arg) for arg in work]
+
+    results = run_graph([(i, func, arg, []) for i, arg in enumerate(work)],
+                        str(jobs))
+
+    errors = sorted(set(results[i][1] for i in range(len(work))
+                        if results[i][1] is not None))
+    if len(errors) > 0:
+        # for abort() fabric already printed the reason
+        abort('Worker process failed (%s)' % ', '.join(errors))
+
+    return [results[i][0] for i in range(len(work))]
+
+
+## Shared array worker processes of run_graph write their process ID to
+## (index is the node number), so the scheduler knows which process runs a
+## node. Shared memory is written synchronously, so the ID is also seen if
+## the process is killed right afterwards
+node_pids = [None]
+
+
+## Initialise worker process of run_graph
+#  @param pids Shared array of process IDs
+def _init_node_worker(pids):
+    node_pids[0] = pids
+
+
+## Call function of graph node. abort(), exceptions and interrupts are caught
+## here, so the scheduler can report the failure and skip dependent nodes
+#  @param args Tuple of node number, function and argument
+#  @return Tuple of result and error message (None if no error)
+def _call_node(args):
+    node_no, func, arg = args
+
+    if node_pids[0] is not None:
+        node_pids[0][node_no] = os.getpid()
+
+    try:
+        return (func(arg), None)
+    except SystemExit:
+        # fabric already printed the reason
+        return (None, 'aborted')
+    except Exception as e:
+        return (None, '%s: %s' % (type(e).__name__, e))
+    except KeyboardInterrupt:
+        return (None, 'interrupted')
+
+
+## Check if process exists
+#  @param pid Process ID
+#  @return True if process exists, False otherwise
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+
+    return True
+
+
+## Run the nodes of a dependency graph. A node is started as soon as all
+## nodes it depends on have finished, so independent nodes run concurrently
+## in a pool of worker processes. Nodes that depend on a failed node are not
+## run. Worker processes run the nodes in the calling process (see map_jobs).
+## The scheduler polls the results of running nodes, so a node also fails
+## (instead of blocking the scheduler) if its result cannot be sent back or
+## its worker process dies
+#  @param nodes List of tuples of node ID, module-level function with one
+#               argument, argument and list of IDs of the nodes it depends on.
+#               Nodes are started in list order if they are ready
+#  @param jobs Number of worker processes ('0' means number of CPUs,
+#              '1' means no worker processes)
+#  @return Map of node IDs to tuples of result and error message (None if
+#          no error)
+def run_graph(nodes, jobs='0'):
+
+    jobs = int(jobs)
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(nodes))
+    if multiprocessing.current_process().daemon:
+        jobs = 1
+
+    pool = None
+    if jobs > 1:
+        pids = multiprocessing.RawArray('i', len(nodes))
+        pool = multiprocessing.Pool(jobs, _init_node_worker, (pids, ))
+
+    results = {}
+    # list of node numbers and nodes
+    pending = list(enumerate(nodes))
+    # map of node IDs of running nodes to tuples of node number and
+    # AsyncResult object
+    running = {}
+    # node IDs of running nodes whose worker process was found dead
+    dead = set()
+    ok = False
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            ready = [(node_no, node) for node_no, node in pending
+                     if all(dep in results for dep in node[3])]
+            for node_no, node in ready:
+                node_id, func, arg, deps = node
+                pending.remove((node_no, node))
+
+                failed = [dep for dep in deps if results[dep][1] is not None]
+                if len(failed) > 0:
+                    results[node_id] = (None, 'depends on failed %s' %
+                                        str(failed[0]))
+                elif pool is None:
+                    results[node_id] = _call_node((node_no, func, arg))
+                else:
+                    running[node_id] = (node_no, pool.apply_async(
+                        _call_node, ((node_no, func, arg), )))
+
+            if len(ready) > 0:
+                # nodes finished in this process may have made others ready
+                continue
+
+            if len(running) == 0:
+                abort('Cannot resolve dependencies of %s' %
+                      ', '.join(str(node[0]) for node_no, node in pending))
+
+            done = False
+            for node_id, (node_no, res) in running.items():
+                if res.ready():
+                    try:
+                        results[node_id] = res.get()
+                    except Exception as e:
+                        # e.g. result could not be pickled
+                        results[node_id] = (None, '%s: %s' %
+                                            (type(e).__name__, e))
+                elif pids[node_no] != 0 and \
+                     not _process_alive(pids[node_no]):
+                    # check again in next round, the result may just not
+                    # have arrived yet
+                    if node_id not in dead:
+                        dead.add(node_id)
+                        continue
+                    results[node_id] = (None, 'worker process died')
+                else:
+                    continue
+
+                del running[node_id]
+                done = True
+
+            if not done:
+                time.sleep(0.1)
+
+        ok = True
+    finally:
+        if pool is not None:
+            # the pool waits forever for results of dead worker processes
+            if ok and len(dead) == 0:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+    return results
+
+
+## Open SQLite database of a cache if not open yet in this process. Connections
+## must not be used by forked worker processes, so the process ID is stored
+## with the connection
+#  @param db List of database connection and ID of process that opened it
+#  @param fname Database file name
+#  @param timeout Seconds we wait for a lock held by another process
+#  @param create Function called with the connection to create the tables
+#  @return Database connection or None if database cannot be opened
+def open_cache_db(db, fname, timeout, create):
+
+    if db[0] is not None and db[1] == os.getpid():
+        return db[0]
+
+    try:
+        conn = sqlite3.connect(fname, timeout=timeout)
+        with conn:
+            create(conn)
+    except sqlite3.Error:
+        # if we can't open or create the database then bad luck, the data
+        # is not cached and user needs to fix permission, but ensure we
+        # don't crash
+        conn = None
+
+    db[0] = conn
+    db[1] = os.getpid()
+
+    return conn
+
+
 ## Make sure the specified directory name ends with a trailing slash
 #  @param path Directory
 def valid_dir(path):
@@ -66,3 +301,71 @@ def valid_dir(path):
 
     return path
 
+
+
+## Write data to many output files while keeping only one file open at a time.
+## Data is buffered per file and written out when the buffers get too large
+## or when the writer is closed.
+class DemuxWriter(object):
+
+    ## Create writer
+    #  @param max_buffered Maximum number of buffered bytes before flushing
+    #  @param compress If True output files are gzipped (each flush appends
+    #                  a gzip member, which zcat and gzip.open handle fine)
+    def __init__(self, max_buffered=16777216, compress=False):
+        self.max_buffered = max_buffered
+        self.compress = compress
+        self.buffered = 0
+        self.buffers = {}
+        self.headers = {}
+        self.created = set()
+
+    ## Set header that is written when file is created
+    #  @param fname File name
+    #  @param header Header data
+    def set_header(self, fname, header):
+        self.headers[fname] = header
+
+    ## Write data to file
+    #  @param fname File name
+    #  @param data Data
+    def write(self, fname, data):
+        buf = self.buffers.get(fname)
+        if buf is None:
+            buf = self.buffers[fname] = []
+        buf.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.max_buffered:
+            self.flush()
+
+    ## Write all buffered data
+    def flush(self):
+        for fname, buf in self.buffers.iteritems():
+            if fname in self.created:
+                mode = 'ab'
+            else:
+                mode = 'wb'
+                buf.insert(0, self.headers.get(fname, ''))
+                self.created.add(fname)
+
+            if self.compress:
+                f = gzip.open(fname, mode, 1)
+            else:
+                f = open(fname, mode)
+            f.write(''.join(buf))
+            f.close()
+
+        self.buffers = {}
+        self.buffered = 0
+
+    ## Flush and make sure files that only have a header are created
+    def close(self):
+        for fname in self.headers:
+            if fname not in self.created and fname not in self.buffers:
+                self.buffers[fname] = []
+        self.flush()
+
+    ## Get names of all files written
+    #  @return Set of file names
+    def files(self):
+        return self.created
@@ -0,0 +1,448 @@
+# Copyright (c) 2013-2018 Centre for Advanced Internet Architectures,
+# Swinburne University of Technology. All rights reserved.
+#
+# Author: Sebastian Zander (sebastian.zander@gmx.de)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+## @package logsplit
+# Split TCP logger files into per-flow files with a single pass over the
+# log. The extract functions then only select columns from the split files
+# instead of decompressing and filtering the whole log once per flow.
+#
+# The split files of <test_id>_<host>_siftr.log.gz are in the directory
+# <out_dir>/<test_id>_<host>_siftr.split/. For each flow and direction
+# there is a file <src>_<src_port>_<dst>_<dst_port>.<i|o> with all columns
+# of the log lines, prefixed with the line number so that both directions
+# can be merged in log order. web10g logs are split the same way, but there
+# is only one file <src>_<src_port>_<dst>_<dst_port>.rows per flow. The file
+# META contains the log header line and marks a complete split directory.
+#
+# $Id$
+
+import os
+import re
+import gzip
+import heapq
+from collections import OrderedDict
+from fabric.api import abort, warn, puts
+
+from internalutil import lock_dir, DemuxWriter, RUN_ID
+from derivedcache import must_derive, record_derived
+
+
+## Split directory extension
+SPLIT_DIR_EXT = '.split'
+## Name of file with log header, also marks a complete split directory
+SPLIT_META_FILE = 'META'
+
+## Minimum number of columns of patched siftr (with ertt estimates)
+SIFTR_MIN_COLS = 27
+## siftr columns always selected (time stamp and flow), see write_split_fields
+SIFTR_BASE_FIELDS = '3,4,5,6,7'
+
+## Extension of web10g split files
+WEB10G_EXT = 'rows'
+## web10g columns always selected (time stamps, flow and the columns used for
+## duplicate suppression), see write_split_fields
+WEB10G_BASE_FIELDS = '1,3,4,5,6,7,8,13,14'
+## Lines with lower case letters are no data lines
+WEB10G_NODATA_RE = re.compile('[a-z]')
+## Number of most recently seen keys per flow used for web10g duplicate
+## suppression
+WEB10G_DEDUP_KEYS = 4096
+
+## Split directories of log files processed in this run. Index is
+## (log file name, output directory), value is the split directory
+log_splits = {}
+
+## Log header lines. Index is log file name, value is first line of log
+log_headers = {}
+
+
+## Get split directory name
+#  @param log_file Log file name
+#  @param out_dirname Output directory
+#  @return Split directory name
+def get_split_dir(log_file, out_dirname):
+    base = os.path.basename(log_file)
+    if base.endswith('.log.gz'):
+        base = base[:-len('.log.gz')]
+
+    return out_dirname + base + SPLIT_DIR_EXT + '/'
+
+
+## Get directions for io_filter
+#  @param io_filter 'i', 'o' or 'io'
+#  @return List of directions
+def get_directions(io_filter):
+    if io_filter == 'io':
+        return ['i', 'o']
+    else:
+        return [io_filter]
+
+
+## Split siftr log. Only lines before the log disable line are used (the
+## same lines as 'grep -v enable | head -<number of lines - 3>'), lines
+## containing 'enable' are skipped.
+#  @param siftr_file siftr log file name
+#  @param split_dir Split directory
+#  @param check If True abort if the log is incomplete or siftr is not patched
+def _split_siftr(siftr_file, split_dir, check):
+
+    writer = DemuxWriter()
+    header = None
+    second = None
+    last = ''
+    lines = 0
+    rowno = 0
+    # we don't know the number of lines before the end, so hold back the
+    # last lines until we know how many of them we need
+    held = []
+
+    def write_row(rowno, line):
+        # egrep "^(i|o)" only checks the first character
+        direction = line[0:1]
+        if direction != 'i' and direction != 'o':
+            return
+        fields = line.split(',', 7)
+        if len(fields) < 7:
+            return
+        fname = '%s%s_%s_%s_%s.%s' % (split_dir, fields[3], fields[4],
+                                      fields[5], fields[6], direction)
+        writer.write(fname, '%i,%s\n' % (rowno, line))
+
+    f = gzip.open(siftr_file, 'rb')
+    try:
+        for line in f:
+            lines += 1
+            line = line.rstrip('\n')
+            if header is None:
+                header = line
+            elif second is None:
+                second = line
+            last = line
+
+            if 'enable' in line:
+                continue
+
+            held.append(line)
+            if len(held) > 3:
+                rowno += 1
+                write_row(rowno, held.pop(0))
+    finally:
+        f.close()
+
+    for line in held[:max(0, lines - 3 - rowno)]:
+        rowno += 1
+        write_row(rowno, line)
+
+    if check:
+        # check that file is complete, i.e. we have the disable line
+        if 'disable_time_secs' not in last:
+            abort('Incomplete siftr file %s' % siftr_file)
+
+        # check that we have patched siftr (27 columns)
+        if second is None or \
+           len(second.replace(',', ' ').split()) < SIFTR_MIN_COLS:
+            abort('siftr needs to be patched to output ertt estimates')
+
+    writer.close()
+
+    return header
+
+
+## Split web10g log. Lines with lower case letters (header and error
+## messages) and the last line, which can be incomplete, are not used. Rows
+## are suppressed if the key columns (3-8, 13 and 14) did not change, so
+## there is only output if data is flying around (comparable to siftr).
+## Like the old awk '!a[...]++' a row is dropped if its key has been seen
+## before, but only the most recent WEB10G_DEDUP_KEYS keys of each flow are
+## remembered, so memory use is bounded.
+#  @param web10g_file web10g log file name
+#  @param split_dir Split directory
+#  @param check If True warn about error messages in the log
+def _split_web10g(web10g_file, split_dir, check):
+
+    writer = DemuxWriter()
+    header = None
+    errors = []
+    seen = {}
+    rowno = 0
+    held = None
+
+    def write_row(rowno, line):
+        fields = line.split(',')
+        if len(fields) < 6:
+            return
+        name = '%s_%s_%s_%s' % (fields[2], fields[3], fields[4], fields[5])
+
+        # key is $2$3$4$5$6$7$8$9 of the awk input (cut -f 1,3-8,13,14)
+        key = ''.join(fields[2:8] + fields[12:14])
+        keys = seen.get(name)
+        if keys is None:
+            keys = seen[name] = OrderedDict()
+        if key in keys:
+            # refresh key
+            del keys[key]
+            keys[key] = True
+            return
+        keys[key] = True
+        if len(keys) > WEB10G_DEDUP_KEYS:
+            keys.popitem(last=False)
+
+        writer.write('%s%s.%s' % (split_dir, name, WEB10G_EXT),
+                     '%i,%s\n' % (rowno, line))
+
+    f = gzip.open(web10g_file, 'rb')
+    try:
+        for line in f:
+            line = line.rstrip('\n')
+            if header is None:
+                header = line
+
+            if WEB10G_NODATA_RE.search(line):
+                if 'runbg_wrapper.sh' not in line and 'Timestamp' not in line:
+                    errors.append(line)
+                continue
+
+            # hold back one line, cause the last line can be incomplete
+            if held is not None:
+                rowno += 1
+                write_row(rowno, held)
+            held = line
+    finally:
+        f.close()
+
+    if check and len(errors) > 0:
+        warn('Errors in %s:\n%s' % (web10g_file, '\n'.join(errors)))
+
+    writer.close()
+
+    return header
+
+
+## Check if split directory is complete and was created in this run,
+## possibly by another worker process
+#  @param split_dir Split directory name
+#  @return True if done in this run, False otherwise
+def _done_in_run(split_dir):
+
+    try:
+        with open(split_dir + SPLIT_META_FILE, 'r') as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return False
+
+    return len(lines) > 1 and lines[1] == RUN_ID
+
+
+## Split log unless already done in this run. If replot_only is '1' a
+## complete split directory from an earlier run is reused if it was split
+## from the same log file (see derivedcache). The split directory is
+## locked, so worker processes analysing the same experiment do not split
+## the same log concurrently
+#  @param log_file Log file name
+#  @param out_dirname Output directory
+#  @param replot_only '1' means reuse existing split directory
+#  @param split_func Function that splits the log
+#  @return Split directory name
+def _run_split(log_file, out_dirname, replot_only, split_func):
+
+    key = (log_file, out_dirname)
+    if key in log_splits:
+        return log_splits[key]
+
+    split_dir = get_split_dir(log_file, out_dirname)
+    lock = lock_dir(split_dir)
+    try:
+        if _done_in_run(split_dir) or \
+           (not must_derive(replot_only, [split_dir], split_func.__name__,
+                            [log_file]) and \
+            os.path.isfile(split_dir + SPLIT_META_FILE)):
+            log_splits[key] = split_dir
+            return split_dir
+
+        for fname in os.listdir(split_dir):
+            os.remove(split_dir + fname)
+
+        puts('Processing %s' % log_file)
+
+        header = split_func(log_file, split_dir, replot_only == '0') or ''
+
+        log_headers[log_file] = header
+        with open(split_dir + SPLIT_META_FILE, 'w') as f:
+            f.write(header + '\n')
+            f.write(RUN_ID + '\n')
+
+        record_derived([split_dir], split_func.__name__, [log_file])
+    finally:
+        os.close(lock)
+
+    log_splits[key] = split_dir
+
+    return split_dir
+
+
+## Split siftr log unless already done in this run. If replot_only is '1'
+## a complete split directory from an earlier run is reused
+#  @param siftr_file siftr log file name
+#  @param out_dirname Output directory
+#  @param replot_only '1' means reuse existing split directory
+#  @return Split directory name
+def split_siftr(siftr_file, out_dirname, replot_only='0'):
+    return _run_split(siftr_file, out_dirname, replot_only, _split_siftr)
+
+
+## Split web10g log unless already done in this run. If replot_only is '1'
+## a complete split directory from an earlier run is reused
+#  @param web10g_file web10g log file name
+#  @param out_dirname Output directory
+#  @param replot_only '1' means reuse existing split directory
+#  @return Split directory name
+def split_web10g(web10g_file, out_dirname, replot_only='0'):
+    return _run_split(web10g_file, out_dirname, replot_only, _split_web10g)
+
+
+## Get header (first line) of log file. Uses the split directory if the log
+## has been split, otherwise reads the first line of the log
+#  @param log_file Log file name
+#  @return First line of log
+def get_log_header(log_file):
+
+    if log_file in log_headers:
+        return log_headers[log_file]
+
+    header = None
+    for (fname, out_dirname), split_dir in log_splits.items():
+        if fname == log_file and \
+           os.path.isfile(split_dir + SPLIT_META_FILE):
+            with open(split_dir + SPLIT_META_FILE, 'r') as f:
+                header = f.readline().rstrip('\n')
+            break
+
+    if header is None:
+        f = gzip.open(log_file, 'rb')
+        try:
+            header = f.readline().rstrip('\n')
+        finally:
+            f.close()
+
+    log_headers[log_file] = header
+
+    return header
+
+
+## Get flows in split directory
+#  @param split_dir Split directory
+#  @param exts List of split file extensions, i.e. directions for siftr
+#              (see get_directions) or [WEB10G_EXT]
+#  @return Sorted list of unique flows <src>,<src_port>,<dst>,<dst_port>
+def get_split_flows(split_dir, exts):
+
+    flows = set()
+    for fname in os.listdir(split_dir):
+        name, ext = os.path.splitext(fname)
+        if ext[1:] in exts:
+            flows.add(name.replace('_', ','))
+
+    return sorted(flows)
+
+
+## Parse cut(1) field list
+#  @param spec Comma-separated list of field numbers or ranges (N, N-M, N-, -M)
+#  @return List of (first, last) tuples, last is None for open ranges
+def parse_field_list(spec):
+
+    ranges = []
+    for item in spec.split(','):
+        item = item.strip()
+        if item == '':
+            continue
+        try:
+            if '-' in item:
+                first, last = item.split('-', 1)
+                first = int(first) if first != '' else 1
+                last = int(last) if last != '' else None
+            else:
+                first = last = int(item)
+        except ValueError:
+            abort('Invalid field list %s' % spec)
+        ranges.append((first, last))
+
+    return ranges
+
+
+## Get field indices selected by field list, in ascending order like cut(1)
+#  @param ranges List of (first, last) tuples (see parse_field_list)
+#  @param num Number of fields of the line
+#  @return List of indices (starting with 0)
+def _select_fields(ranges, num):
+    sel = set()
+    for first, last in ranges:
+        if last is None or last > num:
+            last = num
+        sel.update(range(first - 1, last))
+
+    return sorted(sel)
+
+
+## Write selected columns of a flow from the split files. The output is the
+## same as 'cut -d, -f <base fields>,<attributes> | cut -d, -f 1,<n+1>-',
+## where n is the number of base fields, on the log lines of the flow. With
+## the usual base fields that is the time stamp followed by the attributes
+#  @param split_dir Split directory
+#  @param flow Flow <src>,<src_port>,<dst>,<dst_port>
+#  @param exts List of split file extensions (see get_split_flows)
+#  @param base_fields Comma-separated list of log columns always selected,
+#                     SIFTR_BASE_FIELDS or WEB10G_BASE_FIELDS
+#  @param attributes Comma-separated list of log columns
+#  @param out_file Output file name
+def write_split_fields(split_dir, flow, exts, base_fields, attributes,
+                       out_file):
+
+    base = parse_field_list(base_fields)
+    ranges = base + parse_field_list(attributes)
+    skip = len(_select_fields(base, max(last for first, last in base)))
+    name = flow.replace(',', '_')
+
+    def read(ext):
+        fname = '%s%s.%s' % (split_dir, name, ext)
+        if not os.path.isfile(fname):
+            return
+        with open(fname, 'r') as f:
+            for line in f:
+                rowno, line = line.rstrip('\n').split(',', 1)
+                yield (int(rowno), line)
+
+    rows = heapq.merge(*[read(ext) for ext in exts])
+
+    sel_cache = {}
+    with open(out_file, 'w') as f:
+        for rowno, line in rows:
+            fields = line.split(',')
+            num = len(fields)
+            sel = sel_cache.get(num)
+            if sel is None:
+                sel = sel_cache[num] = _select_fields(ranges, num)
+            out = [fields[i] for i in sel]
+            f.write(','.join(out[:1] + out[skip:]) + '\n')
@@ -0,0 +1,274 @@
+# Copyright (c) 2013-2018 Centre for Advanced Internet Architectures,
+# Swinburne University of Technology. All rights reserved.
+#
+# Author: Sebastian Zander (sebastian.zander@gmx.de)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+## @package pcapreader
+# Minimal reader for (gzipped) pcap files. Only decodes what the analysis
+# functions need: IPv4 plus TCP, UDP or ICMP headers.
+#
+# $Id$
+
+import gzip
+import socket
+import struct
+from collections import namedtuple
+from fabric.api import abort
+
+
+## Read block size (bytes)
+BLOCK_SIZE = 1048576
+
+## Link types we can decode
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+## DLT_RAW values used on some platforms
+LINKTYPE_RAW_ALT = (12, 14)
+
+## IP protocol numbers
+IPPROTO_ICMP = 1
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+
+## TCP flags
+TH_FIN = 0x01
+TH_SYN = 0x02
+TH_RST = 0x04
+TH_PUSH = 0x08
+TH_ACK = 0x10
+TH_URG = 0x20
+
+## ICMP types
+ICMP_ECHOREPLY = 0
+ICMP_ECHO = 8
+
+## Decoded TCP, UDP or ICMP packet
+#  ts_sec, ts_usec: capture time stamp (seconds, microseconds)
+#  link_len: on-wire frame length for Ethernet frames, None otherwise
+#  src, dst: IP addresses as dotted quad strings
+#  proto: 'tcp', 'udp' or 'icmp'
+#  ip_id, ip_len: IP identifier and IP total length
+#  sport, dport: ports, for ICMP type and code
+#  seq, ack, flags: TCP sequence, acknowledgement and flags (None for UDP).
+#                   For ICMP echo request and reply seq and ack are the echo
+#                   sequence number and identifier (None for other ICMP)
+#  payload: transport payload (only if requested, '' otherwise)
+#  record: raw pcap record including record header (only if requested,
+#          '' otherwise)
+Packet = namedtuple('Packet', ['ts_sec', 'ts_usec', 'link_len', 'src', 'dst',
+                               'proto', 'ip_id', 'ip_len', 'sport', 'dport',
+                               'seq', 'ack', 'flags', 'payload', 'record'])
+
+
+## Open a pcap file that may be gzipped
+#  @param fname File name
+#  @return File object
+def open_pcap(fname):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rb')
+    else:
+        return open(fname, 'rb')
+
+
+## Read pcap file header
+#  @param fname File name
+#  @return Raw pcap file header (24 bytes)
+def read_header(fname):
+    f = open_pcap(fname)
+    try:
+        return f.read(24)
+    finally:
+        f.close()
+
+
+## Format time stamp like tcpdump -tt does
+#  @param pkt Packet
+#  @return Time stamp string
+def ts_str(pkt):
+    return '%u.%06u' % (pkt.ts_sec, pkt.ts_usec)
+
+
+## Return time stamp as float (same as dpkt, i.e. sec + usec / 1e6)
+#  @param pkt Packet
+#  @return Time stamp
+def ts_float(pkt):
+    return pkt.ts_sec + pkt.ts_usec / 1E6
+
+
+## Iterate over all IPv4 TCP and UDP (optionally ICMP) packets in a pcap file.
+## Packets that are not IPv4, of other protocols, non-first fragments or
+## truncated before the end of the transport header are skipped.
+#  @param fname pcap file name (can be gzipped)
+#  @param want_payload If True return transport payload (capped at IP
+#                      total length) in Packet.payload
+#  @param want_record If True return raw pcap record in Packet.record
+#  @param want_icmp If True also return ICMP packets
+#  @return Generator of Packet tuples
+def read_packets(fname, want_payload=False, want_record=False,
+                 want_icmp=False):
+
+    f = open_pcap(fname)
+    try:
+        hdr = f.read(24)
+        if len(hdr) < 24:
+            return
+
+        magic = hdr[:4]
+        nano = False
+        if magic == '\xd4\xc3\xb2\xa1':
+            endian = '<'
+        elif magic == '\xa1\xb2\xc3\xd4':
+            endian = '>'
+        elif magic == '\x4d\x3c\xb2\xa1':
+            endian = '<'
+            nano = True
+        elif magic == '\xa1\xb2\x3c\x4d':
+            endian = '>'
+            nano = True
+        else:
+            abort('Unknown pcap file format: %s' % fname)
+
+        linktype = struct.unpack(endian + 'I', hdr[20:24])[0] & 0x0fffffff
+        if linktype not in (LINKTYPE_NULL, LINKTYPE_ETHERNET, LINKTYPE_RAW,
+                            LINKTYPE_LINUX_SLL) and \
+           linktype not in LINKTYPE_RAW_ALT:
+            abort('Unsupported pcap link type %i: %s' % (linktype, fname))
+
+        rec_hdr = struct.Struct(endian + 'IIII')
+        null_hdr = struct.Struct(endian + 'I')
+        ushort = struct.Struct('!H')
+        ip_hdr = struct.Struct('!BxHHHxB')
+        tcp_hdr = struct.Struct('!HHIIBB')
+        udp_hdr = struct.Struct('!HH')
+        icmp_hdr = struct.Struct('!BBxxHH')
+        addr_cache = {}
+
+        buf = ''
+        pos = 0
+        while True:
+            if len(buf) - pos < 16:
+                buf = buf[pos:] + f.read(BLOCK_SIZE)
+                pos = 0
+                if len(buf) < 16:
+                    break
+
+            sec, frac, caplen, wirelen = rec_hdr.unpack_from(buf, pos)
+            end = pos + 16 + caplen
+            if end > len(buf):
+                buf = buf[pos:] + f.read(max(BLOCK_SIZE, caplen + 16))
+                pos = 0
+                end = 16 + caplen
+                if end > len(buf):
+                    # truncated file
+                    break
+
+            start = pos
+            o = pos + 16
+            pos = end
+
+            # find IP header
+            link_len = None
+            if linktype == LINKTYPE_ETHERNET:
+                if caplen < 14:
+                    continue
+                etype = ushort.unpack_from(buf, o + 12)[0]
+                o += 14
+                if etype == 0x8100 and caplen >= 18:
+                    etype = ushort.unpack_from(buf, o + 2)[0]
+                    o += 4
+                if etype != 0x0800:
+                    continue
+                link_len = wirelen
+            elif linktype == LINKTYPE_LINUX_SLL:
+                if caplen < 16 or ushort.unpack_from(buf, o + 14)[0] != 0x0800:
+                    continue
+                o += 16
+            elif linktype == LINKTYPE_NULL:
+                if caplen < 4 or null_hdr.unpack_from(buf, o)[0] != socket.AF_INET:
+                    continue
+                o += 4
+
+            if end - o < 20:
+                continue
+            vhl, ip_len, ip_id, frag, p = ip_hdr.unpack_from(buf, o)
+            if vhl >> 4 != 4 or frag & 0x1fff != 0:
+                continue
+
+            raw_src = buf[o + 12:o + 16]
+            src = addr_cache.get(raw_src)
+            if src is None:
+                src = addr_cache[raw_src] = socket.inet_ntoa(raw_src)
+            raw_dst = buf[o + 16:o + 20]
+            dst = addr_cache.get(raw_dst)
+            if dst is None:
+                dst = addr_cache[raw_dst] = socket.inet_ntoa(raw_dst)
+
+            ip_end = min(o + ip_len, end)
+            o += (vhl & 0x0f) * 4
+
+            if p == IPPROTO_TCP:
+                if end - o < 20:
+                    continue
+                sport, dport, seq, ack, off, flags = tcp_hdr.unpack_from(buf, o)
+                proto = 'tcp'
+                o += (off >> 4) * 4
+            elif p == IPPROTO_UDP:
+                if end - o < 8:
+                    continue
+                sport, dport = udp_hdr.unpack_from(buf, o)
+                seq = ack = flags = None
+                proto = 'udp'
+                o += 8
+            elif p == IPPROTO_ICMP and want_icmp:
+                if end - o < 8:
+                    continue
+                sport, dport, ack, seq = icmp_hdr.unpack_from(buf, o)
+                if sport != ICMP_ECHO and sport != ICMP_ECHOREPLY:
+                    seq = ack = None
+                flags = None
+                proto = 'icmp'
+                o += 8
+            else:
+                continue
+
+            if want_payload and o < ip_end:
+                payload = buf[o:ip_end]
+            else:
+                payload = ''
+
+            if want_record:
+                record = buf[start:end]
+            else:
+                record = ''
+
+            if nano:
+                frac /= 1000
+
+            yield Packet(sec, frac, link_len, src, dst, proto, ip_id, ip_len,
+                         sport, dport, seq, ack, flags, payload, record)
+
+    finally:
+        f.close()
@@ -0,0 +1,144 @@
+# Copyright (c) 2013-2018 Centre for Advanced Internet Architectures,
+# Swinburne University of Technology. All rights reserved.
+#
+# Author: Sebastian Zander (sebastian.zander@gmx.de)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+## @package tpconfcache
+# Cache of the TPCONF variables of experiments used by the analysis
+# functions (host to internal IP map, host list, router and broadcast ping
+# address). The variables are read from <test_id_prefix>_tpconf_vars.log.gz
+# once and stored in an SQLite database keyed by the absolute path of that
+# file. Entries are only used if size and modification time of the file
+# still match, and concurrent analysis runs (or worker processes) can share
+# the database.
+#
+# $Id$
+
+import os
+import ast
+import gzip
+import sqlite3
+from fabric.api import warn
+from filefinder import find_files
+from internalutil import open_cache_db
+
+
+## Cache file name
+CACHE_FILE_NAME = 'teacup_tpconf_cache.db'
+## Seconds we wait for a lock held by another process
+CACHE_TIMEOUT = 60
+## TPCONF variables we keep
+TPCONF_VARS = ('TPCONF_host_internal_ip', 'TPCONF_hosts', 'TPCONF_router',
+               'TPCONF_bc_ping_address')
+## TPCONF variables cache. Index is the experiment directory, value is a map
+## of variable names to values or None if there is no tpconf_vars file
+tpconf_cache = {}
+## Database connection and ID of process that opened it (connections must
+## not be used by forked worker processes)
+cache_db = [None, None]
+
+
+## Create cache table
+#  @param conn Database connection
+def _create_cache_db(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS tpconf ('
+                 'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                 'vars TEXT)')
+
+
+## Open cache database if not open yet
+#  @return Database connection or None if cache cannot be opened
+def _get_cache_db():
+    return open_cache_db(cache_db, CACHE_FILE_NAME, CACHE_TIMEOUT,
+                         _create_cache_db)
+
+
+## Read TPCONF variables from tpconf_vars file. Each line of the file is
+## <name> = <repr of value> (see dump_config_vars), so values are parsed as
+## literals instead of executing the file
+#  @param var_file tpconf_vars file name
+#  @return Map of variable names to values
+def _read_tpconf_vars(var_file):
+
+    tpconf_vars = {}
+    with gzip.open(var_file, 'rb') as f:
+        for line in f:
+            fields = line.split('=', 1)
+            if len(fields) != 2 or fields[0].strip() not in TPCONF_VARS:
+                continue
+            try:
+                tpconf_vars[fields[0].strip()] = ast.literal_eval(
+                    fields[1].strip())
+            except (ValueError, SyntaxError):
+                warn('Cannot parse %s in %s' % (fields[0].strip(), var_file))
+
+    return tpconf_vars
+
+
+## Get TPCONF variables of experiment
+#  @param dir_name Experiment directory
+#  @return Map of variable names (see TPCONF_VARS) to values, or None if
+#          there is no tpconf_vars file in the directory (old experiments).
+#          Variables missing in the file are missing in the map
+def get_tpconf_vars(dir_name):
+
+    if dir_name in tpconf_cache:
+        return tpconf_cache[dir_name]
+
+    var_files = find_files(dir_name, '*tpconf_vars.log.gz')
+    if len(var_files) == 0:
+        tpconf_cache[dir_name] = None
+        return None
+
+    path = os.path.realpath(var_files[0])
+    st = os.stat(path)
+
+    conn = _get_cache_db()
+    row = None
+    if conn is not None:
+        try:
+            row = conn.execute('SELECT size, mtime, vars FROM tpconf '
+                               'WHERE path = ?', (path, )).fetchone()
+        except sqlite3.Error:
+            pass
+
+    if row is not None and row[0] == st.st_size and row[1] == st.st_mtime:
+        tpconf_vars = ast.literal_eval(row[2])
+    else:
+        tpconf_vars = _read_tpconf_vars(path)
+        if conn is not None:
+            try:
+                with conn:
+                    conn.execute('INSERT OR REPLACE INTO tpconf '
+                                 'VALUES (?, ?, ?, ?)',
+                                 (path, st.st_size, st.st_mtime,
+                                  repr(tpconf_vars)))
+            except sqlite3.Error:
+                # if we can't write to the file then bad luck, user needs
+                # to fix permission, but ensure we don't crash
+                pass
+
+    tpconf_cache[dir_name] = tpconf_vars
+
+    return tpconf_vars